@@ -0,0 +1,38 @@
+import os
+import hashlib
+import threading
+
+BLOBS_DB_PATH = "db/blobs/"
+
+# internal functions
+def _get_blob_path(blob_hash: str) -> str:
+    # Hashes also arrive from peers, anything but a sha256 hex digest could escape the store
+    if not isinstance(blob_hash, str) or len(blob_hash) != 64 or not all(c in "0123456789abcdef" for c in blob_hash):
+        raise ValueError(f"Invalid blob hash: {blob_hash!r}")
+    return os.path.join(BLOBS_DB_PATH, blob_hash)
+
+# api
+def hash_of(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def put_blob(data: bytes) -> str:
+    """Store `data` under its SHA-256 and return the hash. Storing the same content twice is a no-op."""
+    blob_hash = hash_of(data)
+    blob_path = _get_blob_path(blob_hash)
+    if not os.path.exists(blob_path):
+        os.makedirs(BLOBS_DB_PATH, exist_ok=True)
+        tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, blob_path)
+    return blob_hash
+
+def has_blob(blob_hash: str) -> bool:
+    return os.path.exists(_get_blob_path(blob_hash))
+
+def get_blob(blob_hash: str) -> bytes | None:
+    blob_path = _get_blob_path(blob_hash)
+    if not os.path.exists(blob_path):
+        return None
+    with open(blob_path, "rb") as f:
+        return f.read()
@@ -0,0 +1,210 @@
+import os
+import json
+import base64
+import sqlite3
+import time
+import threading
+from api import blob_store
+
+DATABASE_PATH = "db/enctalk.db"
+LEGACY_FRIENDS_DB_PATH = "db/friends.json"
+SCHEMA_VERSION = 11
+COMPACT_INTERVAL_S = 30
+COMPACT_WAL_BYTES = 4 * 1024 * 1024
+COMPACT_POLL_S = 2
+COMPACT_BUSY_WARN = 15 # blocked checkpoints in a row before it is reported
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = False
+
+# internal functions
+def _create_schema(conn: sqlite3.Connection):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS friends (
+            user_id TEXT NOT NULL,
+            friend_id TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            public_key TEXT NOT NULL,
+            profile_base64 TEXT,
+            double_ratchet_info TEXT,
+            PRIMARY KEY (user_id, friend_id)
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            friend_id TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            text TEXT,
+            enc_latent_size INTEGER,
+            enc_latent_path TEXT,
+            enc_seed_string TEXT,
+            seed_string TEXT,
+            timestamp REAL NOT NULL,
+            is_read INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+            ON messages (user_id, friend_id, timestamp);
+    """)
+
+def _migrate_from_json(conn: sqlite3.Connection):
+    # One-time import of the old full-rewrite JSON store, kept on disk as a backup
+    if not os.path.exists(LEGACY_FRIENDS_DB_PATH):
+        return
+    with open(LEGACY_FRIENDS_DB_PATH, "r") as f:
+        friends = json.load(f)
+
+    with conn:
+        for friend in friends:
+            conn.execute(
+                "INSERT OR IGNORE INTO friends (user_id, friend_id, ip, port, public_key, profile_base64, double_ratchet_info) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (friend["user_id"], friend["friend_id"], friend["ip"], friend["port"], friend["public_key"],
+                 friend.get("profile_base64"), friend.get("double_ratchet_info"))
+            )
+            conn.executemany(
+                "INSERT INTO messages (user_id, friend_id, sender_id, text, enc_latent_size, enc_latent_path, "
+                "enc_seed_string, seed_string, timestamp, is_read) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(friend["user_id"], friend["friend_id"], message["sender_id"], message.get("text"),
+                  message.get("enc_latent_size"), message.get("enc_latent_path"), message.get("enc_seed_string"),
+                  message.get("seed_string"), message["timestamp"], int(message["is_read"]))
+                 for message in friend["messages_list"]]
+            )
+    os.replace(LEGACY_FRIENDS_DB_PATH, f"{LEGACY_FRIENDS_DB_PATH}.migrated")
+
+def _migrate_profiles_to_blobs(conn: sqlite3.Connection):
+    # Inline base64 avatars move to the content-addressed blob store, rows keep only the hash
+    conn.execute("ALTER TABLE friends ADD COLUMN profile_hash TEXT")
+    rows = conn.execute("SELECT user_id, friend_id, profile_base64 FROM friends WHERE profile_base64 IS NOT NULL").fetchall()
+    for user_id, friend_id, profile_base64 in rows:
+        profile_hash = blob_store.put_blob(base64.b64decode(profile_base64))
+        conn.execute(
+            "UPDATE friends SET profile_hash = ?, profile_base64 = NULL WHERE user_id = ? AND friend_id = ?",
+            (profile_hash, user_id, friend_id)
+        )
+
+def _compact_loop():
+    # Appends only grow the WAL, folding it back into the main file happens here
+    # so no sender ever pays for a checkpoint
+    conn = sqlite3.connect(DATABASE_PATH, timeout=10)
+    wal_path = f"{DATABASE_PATH}-wal"
+    last_compact = time.monotonic()
+    busy_count = 0
+    while True:
+        time.sleep(COMPACT_POLL_S)
+        try:
+            wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+            if wal_size >= COMPACT_WAL_BYTES or (wal_size and time.monotonic() - last_compact >= COMPACT_INTERVAL_S):
+                # A blocked checkpoint is reported in the busy column, not raised. Autocheckpoints are off,
+                # so it is retried on the next poll and meanwhile as much as possible is copied back
+                busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+                if busy:
+                    conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+                    busy_count += 1
+                    if busy_count % COMPACT_BUSY_WARN == 0:
+                        print(f"[Database] Checkpoint blocked {busy_count} times in a row, WAL is {wal_size} bytes")
+                    continue
+                busy_count = 0
+                last_compact = time.monotonic()
+        except sqlite3.Error as e:
+            print(f"[Database] Compaction failed: {e}")
+
+def _initialize(conn: sqlite3.Connection):
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            _create_schema(conn)
+            _migrate_from_json(conn)
+        if version < 2:
+            # Read status is a per-conversation watermark instead of a flag rewritten on every row
+            conn.execute("ALTER TABLE friends ADD COLUMN read_upto INTEGER NOT NULL DEFAULT 0")
+        if version < 3:
+            # Latents are packed into one blob per conversation, located by offset/dtype/shape
+            conn.execute("ALTER TABLE messages ADD COLUMN enc_latent_offset INTEGER")
+            conn.execute("ALTER TABLE messages ADD COLUMN enc_latent_dtype TEXT")
+            conn.execute("ALTER TABLE messages ADD COLUMN enc_latent_shape TEXT")
+        if version < 4:
+            # Comma separated wire formats the friend announced in the friend handshake
+            conn.execute("ALTER TABLE friends ADD COLUMN wire_formats TEXT NOT NULL DEFAULT ''")
+        if version < 5:
+            # Frames waiting for delivery, sent in id order per peer by the outbox sender
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    friend_id TEXT,
+                    ip TEXT NOT NULL,
+                    port INTEGER NOT NULL,
+                    frame TEXT NOT NULL,
+                    binary BLOB,
+                    binary_type TEXT,
+                    chunked INTEGER NOT NULL DEFAULT 0,
+                    message_id INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL DEFAULT 0,
+                    created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_outbox_peer ON outbox (ip, port, id);
+                ALTER TABLE messages ADD COLUMN delivered INTEGER NOT NULL DEFAULT 1;
+            """)
+        if version < 6:
+            with conn:
+                _migrate_profiles_to_blobs(conn)
+        if version < 7:
+            # Consecutive batchable frames of a conversation may be coalesced into one batch frame
+            conn.execute("ALTER TABLE outbox ADD COLUMN batchable INTEGER NOT NULL DEFAULT 0")
+        if version < 8:
+            # Binary DoubleRatchet state, one row per conversation updated with every message.
+            # friends.double_ratchet_info is only read until a conversation has a row here.
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ratchet_states ("
+                "user_id TEXT NOT NULL, friend_id TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (user_id, friend_id))"
+            )
+        if version < 9:
+            # Acknowledged bytes of a chunked frame, so a resend after a restart or reconnect resumes there
+            conn.execute("ALTER TABLE outbox ADD COLUMN chunk_offset INTEGER NOT NULL DEFAULT 0")
+        if version < 10:
+            # Frames their peer keeps rejecting are dead-lettered instead of blocking the ones behind them.
+            # Delivery ids of received outbox frames are kept, a resend after a lost ack is only acked again.
+            conn.executescript("""
+                ALTER TABLE outbox ADD COLUMN rejections INTEGER NOT NULL DEFAULT 0;
+                ALTER TABLE outbox ADD COLUMN dead INTEGER NOT NULL DEFAULT 0;
+                CREATE TABLE IF NOT EXISTS received_deliveries (
+                    delivery_id TEXT PRIMARY KEY,
+                    received REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_received_deliveries_received ON received_deliveries (received);
+            """)
+        if version < 11:
+            # Frame type as its own column, superseded frames (e.g. profile updates) are dropped by index
+            conn.executescript("""
+                ALTER TABLE outbox ADD COLUMN frame_type TEXT;
+                UPDATE outbox SET frame_type = json_extract(frame, '$.type');
+                CREATE INDEX IF NOT EXISTS idx_outbox_frame_type ON outbox (user_id, frame_type);
+            """)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        threading.Thread(target=_compact_loop, daemon=True).start()
+        _initialized = True
+
+# api
+def get_connection() -> sqlite3.Connection:
+    """
+    Connection of the calling thread. The UI thread and the socket thread each get their own,
+    WAL mode lets them read while the other one writes.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+        conn = sqlite3.connect(DATABASE_PATH, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        # Every commit is one fsync'd WAL append, checkpoints are left to the compactor
+        conn.execute("PRAGMA synchronous = FULL")
+        conn.execute("PRAGMA wal_autocheckpoint = 0")
+        _initialize(conn)
+        _local.conn = conn
+    return conn
@@ -1,54 +1,89 @@
-import os
 import time
-import json
+import sqlite3
 import numpy as np
+from api import latent_store
+from api.database import get_connection
+from api.outbox_api import add_to_outbox
 
-FRIENDS_DB_PATH = "db/friends.json"
-LATENTS_DB_PATH = "db/latents/"
+HISTORY_PAGE_SIZE = 50
 
 # internal functions
-def _load_friends() -> list:
-    try:
-        with open(FRIENDS_DB_PATH, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+def _row_to_message(row, read_upto: int) -> dict:
+    is_read = bool(row["is_read"]) or row["id"] <= read_upto
+    if row["text"] is not None:
+        return {
+            "sender_id": row["sender_id"],
+            "text": row["text"],
+            "timestamp": row["timestamp"],
+            "is_read": is_read,
+            "delivered": bool(row["delivered"])
+        }
+    return {
+        "sender_id": row["sender_id"],
+        "enc_latent_size": row["enc_latent_size"],
+        "enc_latent_path": row["enc_latent_path"],
+        "enc_latent_offset": row["enc_latent_offset"],
+        "enc_latent_dtype": row["enc_latent_dtype"],
+        "enc_latent_shape": row["enc_latent_shape"],
+        "enc_seed_string": row["enc_seed_string"],
+        "seed_string": row["seed_string"],
+        "timestamp": row["timestamp"],
+        "is_read": is_read,
+        "delivered": bool(row["delivered"])
+    }
     
-def _save_friends(friends: list):
-    with open(FRIENDS_DB_PATH, "w") as f:
-        json.dump(friends, f, indent=2)
+def _get_messages_page(conn, user_id: str, friend_id: str, read_upto: int, before: list | None, limit: int) -> tuple:
+    # Newest first through the (user_id, friend_id, timestamp) index, one extra row tells if more remain
+    if before is None:
+        rows = conn.execute(
+            "SELECT * FROM messages WHERE user_id = ? AND friend_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (user_id, friend_id, limit + 1)
+        ).fetchall()
+    else:
+        timestamp, message_id = before
+        rows = conn.execute(
+            "SELECT * FROM messages WHERE user_id = ? AND friend_id = ? AND (timestamp < ? OR (timestamp = ? AND id < ?)) "
+            "ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (user_id, friend_id, timestamp, timestamp, message_id, limit + 1)
+        ).fetchall()
 
-def _get_latent_path(user_id: str, friend_id: str, enc_seed_string: str) -> str:
-    save_dir = os.path.join(LATENTS_DB_PATH, user_id, friend_id)
-    os.makedirs(save_dir, exist_ok=True)
+    rows = rows[::-1]
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[1:]
+        cursor = [rows[0]["timestamp"], rows[0]["id"]]
 
-    filename = f"{enc_seed_string[:10]}.npy"
-    full_path = os.path.join(save_dir, filename)
-    
-    return save_dir, full_path
-    
-# api
-def create_friend(user_id: str, ip:str, port: int, friend_id:str, public_key: str, profile_base64: str, double_ratchet_info) -> dict:
-    friends = _load_friends()
+    # Latents stay on disk as paths until they are displayed, see load_latent
+    return [_row_to_message(row, read_upto) for row in rows], cursor
 
-    for friend in friends:
-        if friend['user_id'] == user_id and friend['friend_id'] == friend_id:
-            return {
-                "status": "error", 
-                "message": "Friend already exists"
-            }
+def _save_ratchet_state(conn, user_id: str, friend_id: str, ratchet_state: bytes) -> bool:
+    # One small row per conversation, rewritten in place. False when the friend does not exist.
+    cursor = conn.execute(
+        "INSERT INTO ratchet_states (user_id, friend_id, state) "
+        "SELECT user_id, friend_id, ? FROM friends WHERE user_id = ? AND friend_id = ? "
+        "ON CONFLICT (user_id, friend_id) DO UPDATE SET state = excluded.state",
+        (ratchet_state, user_id, friend_id)
+    )
+    return cursor.rowcount > 0
 
-    friends.append({
-        "user_id": user_id,
-        "ip": ip,
-        "port": port,
-        "friend_id": friend_id,
-        "public_key": public_key,
-        "profile_base64": profile_base64,
-        "messages_list": [],
-        "double_ratchet_info" : double_ratchet_info
-    })
-    _save_friends(friends)
+# api
+def create_friend(user_id: str, ip:str, port: int, friend_id:str, public_key: str, profile_hash: str | None, ratchet_state: bytes,
+                  wire_formats: str = "") -> dict:
+    conn = get_connection()
+
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO friends (user_id, friend_id, ip, port, public_key, profile_hash, wire_formats) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, friend_id, ip, port, public_key, profile_hash, wire_formats)
+            )
+            _save_ratchet_state(conn, user_id, friend_id, ratchet_state)
+    except sqlite3.IntegrityError:
+        return {
+            "status": "error", 
+            "message": "Friend already exists"
+        }
 
     return {
         "status": "success", 
@@ -59,112 +94,163 @@ def create_friend(user_id: str, ip:str, port: int, friend_id:str, public_key: st
             "port": port,
             "friend_id": friend_id,
             "public_key": public_key,
-            "profile_base64": profile_base64,
+            "profile_hash": profile_hash,
             "messages_list": [],
-            "double_ratchet_info": double_ratchet_info
+            "ratchet_state": ratchet_state,
+            "wire_formats": wire_formats
         }
     }
 
-def create_text_message(user_id: str, friend_id: str, sender_id: str, text: str, double_ratchet_info: dict,
-                   timestamp: float = time.time(), is_read: bool = False) -> dict:
-    friends = _load_friends()
+def create_text_message(user_id: str, friend_id: str, sender_id: str, text: str, ratchet_state: bytes,
+                   timestamp: float | None = None, is_read: bool = False, outbox: dict | None = None) -> dict:
+    conn = get_connection()
+    timestamp = time.time() if timestamp is None else timestamp
+
+    # The message and the ratchet state that produced it are committed together
+    with conn:
+        if not _save_ratchet_state(conn, user_id, friend_id, ratchet_state):
+            return {
+                "status": "error", 
+                "message": "Friend not found"
+            }
+        cursor = conn.execute(
+            "INSERT INTO messages (user_id, friend_id, sender_id, text, timestamp, is_read, delivered) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, friend_id, sender_id, text, timestamp, int(is_read), int(outbox is None))
+        )
+        # The frame delivering an outgoing message is queued in the same transaction
+        if outbox is not None:
+            add_to_outbox(conn, user_id, friend_id, message_id=cursor.lastrowid, **outbox)
 
-    for friend in friends:
-        if  friend['user_id'] == user_id and friend['friend_id'] == friend_id:
-            message = {
+    return {
+        "status": "success", 
+        "message": "Message sent successfully",
+        "data": {
+            "sender_id": sender_id,
+            "text": text,
+            "timestamp" : timestamp,
+            "is_read": is_read
+        }
+    }
+
+def create_text_messages(user_id: str, friend_id: str, sender_id: str, messages: list, ratchet_state: bytes,
+                         is_read: bool = False) -> dict:
+    """Store a batch of received (text, timestamp) messages in one transaction."""
+    conn = get_connection()
+
+    with conn:
+        if not _save_ratchet_state(conn, user_id, friend_id, ratchet_state):
+            return {
+                "status": "error", 
+                "message": "Friend not found"
+            }
+        conn.executemany(
+            "INSERT INTO messages (user_id, friend_id, sender_id, text, timestamp, is_read) VALUES (?, ?, ?, ?, ?, ?)",
+            [(user_id, friend_id, sender_id, text, timestamp, int(is_read)) for text, timestamp in messages]
+        )
+
+    return {
+        "status": "success", 
+        "message": "Messages sent successfully",
+        "data": {
+            "messages": [{
                 "sender_id": sender_id,
                 "text": text,
                 "timestamp" : timestamp,
                 "is_read": is_read
-            }
-            friend['messages_list'].append(message)
-            friend['double_ratchet_info'] = double_ratchet_info
-            _save_friends(friends)
+            } for text, timestamp in messages]
+        }
+    }
+
+def update_ratchet_state(user_id: str, friend_id: str, ratchet_state: bytes, outbox: dict | None = None) -> dict:
+    conn = get_connection()
 
+    # A ratchet change without a message (a re-key), committed together with the frame announcing it
+    with conn:
+        if not _save_ratchet_state(conn, user_id, friend_id, ratchet_state):
             return {
-                "status": "success", 
-                "message": "Message sent successfully",
-                "data": {
-                    "sender_id": sender_id,
-                    "text": text,
-                    "timestamp" : timestamp,
-                    "is_read": is_read
-                }
+                "status": "error", 
+                "message": "Friend not found"
             }
-    
+        if outbox is not None:
+            add_to_outbox(conn, user_id, friend_id, **outbox)
+
     return {
-        "status": "error", 
-        "message": "Friend not found"
+        "status": "success", 
+        "message": "Ratchet state updated successfully"
     }
 
 def create_latent_message(user_id: str, friend_id: str, sender_id: str, enc_latent_size: int,
                    enc_latent_array: np.ndarray, enc_seed_string: str, seed_string: str,
-                   timestamp: float = time.time(), is_read: bool = False) -> dict:
-    friends = _load_friends()
+                   timestamp: float | None = None, is_read: bool = False, outbox: dict | None = None) -> dict:
+    conn = get_connection()
+    timestamp = time.time() if timestamp is None else timestamp
+
+    if conn.execute("SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?", (user_id, friend_id)).fetchone() is None:
+        return {
+            "status": "error", 
+            "message": "Friend not found"
+        }
 
-    for friend in friends:
-        if  friend['user_id'] == user_id and friend['friend_id'] == friend_id:
-            save_dir, enc_latent_path = _get_latent_path(user_id, friend_id, enc_seed_string)
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-            np.save(enc_latent_path, enc_latent_array)
+    latent_ref = latent_store.append_latent(user_id, friend_id, enc_latent_array)
 
-            message = {
-                "sender_id": sender_id,
-                "enc_latent_size": enc_latent_size,
-                "enc_latent_path": enc_latent_path,
-                "enc_seed_string": enc_seed_string,
-                "seed_string": seed_string,
-                "timestamp" : timestamp,
-                "is_read": is_read
-            }
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO messages (user_id, friend_id, sender_id, enc_latent_size, enc_latent_path, enc_latent_offset, "
+            "enc_latent_dtype, enc_latent_shape, enc_seed_string, seed_string, timestamp, is_read, delivered) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, friend_id, sender_id, enc_latent_size, latent_ref["enc_latent_path"], latent_ref["enc_latent_offset"],
+             latent_ref["enc_latent_dtype"], latent_ref["enc_latent_shape"], enc_seed_string, seed_string, timestamp, int(is_read),
+             int(outbox is None))
+        )
+        if outbox is not None:
+            add_to_outbox(conn, user_id, friend_id, message_id=cursor.lastrowid, **outbox)
 
-            friend['messages_list'].append(message)
-            _save_friends(friends)
+    # Hand out a view of the stored copy so the caller's array can be released
+    enc_latent_array = latent_store.load_latent(**latent_ref)
 
-            return {
-                "status": "success", 
-                "message": "Message sent successfully",
-                "data": {
-                    "sender_id": sender_id,
-                    "enc_latent_size": enc_latent_size,
-                    "enc_latent_array": enc_latent_array,
-                    "enc_seed_string": enc_seed_string,
-                    "seed_string": seed_string,
-                    "timestamp" : timestamp,
-                    "is_read": is_read
-                }
-            }
-    
     return {
-        "status": "error", 
-        "message": "Friend not found"
+        "status": "success", 
+        "message": "Message sent successfully",
+        "data": {
+            "sender_id": sender_id,
+            "enc_latent_size": enc_latent_size,
+            "enc_latent_array": enc_latent_array,
+            "enc_seed_string": enc_seed_string,
+            "seed_string": seed_string,
+            "timestamp" : timestamp,
+            "is_read": is_read
+        }
     }
 
 def delete_friend(user_id: str, friend_id: str) -> dict:
-    friends = _load_friends()
+    conn = get_connection()
 
-    friends = [friend for friend in friends if friend['user_id'] != user_id and friend['friend_id'] != friend_id]
-    _save_friends(friends)
+    with conn:
+        conn.execute("DELETE FROM messages WHERE user_id = ? AND friend_id = ?", (user_id, friend_id))
+        conn.execute("DELETE FROM outbox WHERE user_id = ? AND friend_id = ?", (user_id, friend_id))
+        conn.execute("DELETE FROM ratchet_states WHERE user_id = ? AND friend_id = ?", (user_id, friend_id))
+        conn.execute("DELETE FROM friends WHERE user_id = ? AND friend_id = ?", (user_id, friend_id))
 
     return {
         "status": "success", 
         "message": "Friend deleted successfully"
     }
 
-def get_friends(user_id: str) -> dict:
-    friends = _load_friends()
+def get_friends(user_id: str, limit: int = HISTORY_PAGE_SIZE) -> dict:
+    conn = get_connection()
 
-    user_friends = [friend for friend in friends if friend['user_id'] == user_id]
-
-    for friend in user_friends:
-        for message in friend['messages_list']:
-            if 'enc_latent_path' in message:
-                enc_latent_path = message['enc_latent_path']
-                if os.path.exists(enc_latent_path):
-                    message['enc_latent_array'] = np.load(enc_latent_path)
-                else:
-                    message['enc_latent_array'] = None
+    user_friends = []
+    # ratchet_state is None for friends still on the JSON double_ratchet_info of older versions
+    rows = conn.execute(
+        "SELECT f.*, r.state AS ratchet_state FROM friends f "
+        "LEFT JOIN ratchet_states r ON r.user_id = f.user_id AND r.friend_id = f.friend_id WHERE f.user_id = ?",
+        (user_id,)
+    ).fetchall()
+    for row in rows:
+        friend = dict(row)
+        read_upto = friend.pop("read_upto")
+        friend["messages_list"], friend["cursor"] = _get_messages_page(conn, user_id, friend["friend_id"], read_upto, None, limit)
+        user_friends.append(friend)
     
     return {
         "status": "success", 
@@ -174,45 +260,74 @@ def get_friends(user_id: str) -> dict:
         }
     }
 
-def update_friend_profile(user_id:str, friend_id: str, profile_base64: str | None) -> dict:
-    friends = _load_friends()
+def get_messages(user_id: str, friend_id: str, before: list | None = None, limit: int = HISTORY_PAGE_SIZE) -> dict:
+    conn = get_connection()
+
+    row = conn.execute("SELECT read_upto FROM friends WHERE user_id = ? AND friend_id = ?", (user_id, friend_id)).fetchone()
+    if row is None:
+        return {
+            "status": "error",
+            "message": "Friend not found"
+        }
+
+    messages, cursor = _get_messages_page(conn, user_id, friend_id, row["read_upto"], before, limit)
 
-    for friend in friends:
-        if friend["user_id"] == user_id and friend['friend_id'] == friend_id:
-            friend['profile_base64'] = profile_base64
-            _save_friends(friends)
-            return {
-                "status": "success", 
-                "message": "Friend profile updated successfully",
-                "data": {
-                    "user_id": user_id,
-                    "friend_id": friend_id,
-                    "profile_base64": profile_base64
-                }
-            }
-    
     return {
-        "status": "error",
-        "message": "Friend not found"
+        "status": "success",
+        "message": "Messages retrieved successfully",
+        "data": {
+            "messages": messages,
+            "cursor": cursor
+        }
+    }
+
+def load_latent(enc_latent_path: str, enc_latent_offset: int | None = None,
+                enc_latent_dtype: str | None = None, enc_latent_shape: str | None = None) -> np.ndarray | None:
+    return latent_store.load_latent(enc_latent_path, enc_latent_offset, enc_latent_dtype, enc_latent_shape)
+
+def update_friend_profile(user_id:str, friend_id: str, profile_hash: str | None) -> dict:
+    conn = get_connection()
+
+    with conn:
+        cursor = conn.execute(
+            "UPDATE friends SET profile_hash = ? WHERE user_id = ? AND friend_id = ?",
+            (profile_hash, user_id, friend_id)
+        )
+
+    if cursor.rowcount == 0:
+        return {
+            "status": "error",
+            "message": "Friend not found"
+        }
+
+    return {
+        "status": "success", 
+        "message": "Friend profile updated successfully",
+        "data": {
+            "user_id": user_id,
+            "friend_id": friend_id,
+            "profile_hash": profile_hash
+        }
     }
 
 def read_messages(user_id: str, friend_id: str) -> dict:
-    friends = _load_friends()
-
-    for friend in friends:
-        if friend['user_id'] == user_id and friend['friend_id'] == friend_id:
-            for message in friend['messages_list'][::-1]:
-                if not message['is_read']:
-                    message['is_read'] = True
-                else:
-                    break
-            _save_friends(friends)
-            return {
-                "status": "success",
-                "message": "Messages marked as read",
-            }
-    
+    conn = get_connection()
+
+    if conn.execute("SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?", (user_id, friend_id)).fetchone() is None:
+        return {
+            "status": "error",
+            "message": "Friend not found"
+        }
+
+    # Only the watermark moves, message rows are never rewritten
+    with conn:
+        conn.execute(
+            "UPDATE friends SET read_upto = (SELECT COALESCE(MAX(id), 0) FROM messages WHERE user_id = ? AND friend_id = ?) "
+            "WHERE user_id = ? AND friend_id = ?",
+            (user_id, friend_id, user_id, friend_id)
+        )
+
     return {
-        "status": "error",
-        "message": "Friend not found"
-    }
\ No newline at end of file
+        "status": "success",
+        "message": "Messages marked as read",
+    }
@@ -0,0 +1,65 @@
+import os
+import mmap
+import threading
+import numpy as np
+
+LATENTS_DB_PATH = "db/latents/"
+BLOB_ALIGNMENT = 64 # every latent starts on a cache-line boundary
+
+_lock = threading.Lock()
+_maps = {} # blob path -> read-only mmap of the whole file
+
+# internal functions
+def _get_blob_path(user_id: str, friend_id: str) -> str:
+    save_dir = os.path.join(LATENTS_DB_PATH, user_id)
+    os.makedirs(save_dir, exist_ok=True)
+    return os.path.join(save_dir, f"{friend_id}.bin")
+
+def _get_map(blob_path: str, end: int) -> mmap.mmap:
+    # The blob only grows, so a map is reopened once it no longer covers the requested range.
+    # Views into an old map keep it alive until they are released.
+    with _lock:
+        mapped = _maps.get(blob_path)
+        if mapped is None or len(mapped) < end:
+            with open(blob_path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _maps[blob_path] = mapped
+        return mapped
+
+# api
+def append_latent(user_id: str, friend_id: str, latent_array: np.ndarray) -> dict:
+    """Append a latent to the conversation blob and return where it was written."""
+    blob_path = _get_blob_path(user_id, friend_id)
+    latent_array = np.ascontiguousarray(latent_array)
+
+    with _lock:
+        with open(blob_path, "ab") as f:
+            offset = f.tell()
+            padding = -offset % BLOB_ALIGNMENT
+            f.write(b"\0" * padding)
+            f.write(memoryview(latent_array).cast("B"))
+            f.flush()
+            os.fsync(f.fileno())
+
+    return {
+        "enc_latent_path": blob_path,
+        "enc_latent_offset": offset + padding,
+        "enc_latent_dtype": latent_array.dtype.str,
+        "enc_latent_shape": ",".join(str(dim) for dim in latent_array.shape)
+    }
+
+def load_latent(enc_latent_path: str, enc_latent_offset: int | None = None,
+                enc_latent_dtype: str | None = None, enc_latent_shape: str | None = None) -> np.ndarray | None:
+    """Read-only view of a stored latent, paged in from the blob by the OS on access."""
+    if not os.path.exists(enc_latent_path):
+        return None
+
+    # Messages stored before the blob format are single .npy files
+    if enc_latent_offset is None:
+        return np.load(enc_latent_path, mmap_mode="r")
+
+    dtype = np.dtype(enc_latent_dtype)
+    shape = tuple(int(dim) for dim in enc_latent_shape.split(",")) if enc_latent_shape else ()
+    count = int(np.prod(shape))
+    mapped = _get_map(enc_latent_path, enc_latent_offset + count * dtype.itemsize)
+    return np.frombuffer(mapped, dtype=dtype, count=count, offset=enc_latent_offset).reshape(shape)
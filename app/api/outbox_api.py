@@ -0,0 +1,211 @@
+import json
+import time
+import uuid
+import sqlite3
+from api.database import get_connection
+
+RECEIVED_DELIVERY_TTL_S = 30 * 24 * 3600 # delivery ids of received frames are remembered this long
+
+# internal functions
+def _row_to_item(row) -> dict:
+    item = dict(row)
+    item["json_dict"] = json.loads(item.pop("frame"))
+    item["chunked"] = bool(item["chunked"])
+    item["batchable"] = bool(item["batchable"])
+    return item
+
+# api
+def add_to_outbox(conn: sqlite3.Connection, user_id: str, friend_id: str, ip: str, port: int, json_dict: dict,
+                  binary_bytes: bytes | None = None, binary_type: str | None = None, chunked: bool = False,
+                  message_id: int | None = None, batchable: bool = False) -> int:
+    """
+    Queue a frame inside the caller's transaction, so it commits together with the message it delivers.
+    The frame gets a delivery_id, the peer uses it to ack a resent frame without handling it twice.
+    """
+    json_dict = {**json_dict, "delivery_id": uuid.uuid4().hex}
+    cursor = conn.execute(
+        "INSERT INTO outbox (user_id, friend_id, ip, port, frame, frame_type, binary, binary_type, chunked, message_id, batchable, "
+        "created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, friend_id, ip, port, json.dumps(json_dict), json_dict.get("type"), binary_bytes, binary_type, int(chunked),
+         message_id, int(batchable), time.time())
+    )
+    return cursor.lastrowid
+
+def enqueue(user_id: str, friend_id: str, ip: str, port: int, json_dict: dict,
+            binary_bytes: bytes | None = None, binary_type: str | None = None, chunked: bool = False) -> dict:
+    conn = get_connection()
+
+    with conn:
+        outbox_id = add_to_outbox(conn, user_id, friend_id, ip, port, json_dict, binary_bytes, binary_type, chunked)
+
+    return {
+        "status": "success",
+        "message": "Frame queued successfully",
+        "data": {
+            "outbox_id": outbox_id
+        }
+    }
+
+def replace_queued(user_id: str, frame_type: str, frames: list) -> dict:
+    """
+    Drop every queued frame of `frame_type`, superseded by a newer one (e.g. a profile update),
+    and queue `frames`, (friend_id, ip, port, json_dict) tuples, in the same transaction.
+    """
+    conn = get_connection()
+
+    with conn:
+        cursor = conn.execute("DELETE FROM outbox WHERE user_id = ? AND frame_type = ?", (user_id, frame_type))
+        for friend_id, ip, port, json_dict in frames:
+            add_to_outbox(conn, user_id, friend_id, ip, port, json_dict)
+
+    return {
+        "status": "success",
+        "message": "Queued frames replaced",
+        "data": {
+            "count": cursor.rowcount
+        }
+    }
+
+def get_due_peers(now: float) -> dict:
+    # A peer is due when its oldest queued frame is, later frames never overtake it. Dead-lettered frames are skipped.
+    conn = get_connection()
+
+    rows = conn.execute(
+        "SELECT DISTINCT o.ip, o.port FROM outbox o "
+        "WHERE o.id = (SELECT MIN(id) FROM outbox WHERE ip = o.ip AND port = o.port AND dead = 0) AND o.next_attempt <= ?",
+        (now,)
+    ).fetchall()
+
+    return {
+        "status": "success",
+        "message": "Due peers retrieved successfully",
+        "data": {
+            "peers": [(row["ip"], row["port"]) for row in rows]
+        }
+    }
+
+def get_peer_batch(ip: str, port: int, limit: int) -> dict:
+    """
+    Oldest queued frame of a peer. When it is batchable, the batchable frames of the same
+    conversation and binary type queued right behind it come with it, up to `limit` frames.
+    A frame the peer rejected before goes alone, so one bad frame cannot fail a whole batch again.
+    """
+    conn = get_connection()
+
+    rows = conn.execute("SELECT * FROM outbox WHERE ip = ? AND port = ? AND dead = 0 ORDER BY id LIMIT ?",
+                        (ip, port, limit)).fetchall()
+
+    items = []
+    for row in rows:
+        item = _row_to_item(row)
+        if items and not (item["batchable"] and (item["user_id"], item["friend_id"], item["binary_type"]) ==
+                          (items[0]["user_id"], items[0]["friend_id"], items[0]["binary_type"])):
+            break
+        items.append(item)
+        if not item["batchable"] or item["rejections"]:
+            break
+
+    return {
+        "status": "success",
+        "message": "Outbox batch retrieved successfully",
+        "data": {
+            "items": items
+        }
+    }
+
+def mark_delivered(outbox_ids: list, message_ids: list) -> dict:
+    conn = get_connection()
+
+    # The peer's ack is the delivery receipt, for every frame of a batch at once
+    with conn:
+        conn.executemany("DELETE FROM outbox WHERE id = ?", [(outbox_id,) for outbox_id in outbox_ids])
+        conn.executemany("UPDATE messages SET delivered = 1 WHERE id = ?",
+                         [(message_id,) for message_id in message_ids if message_id is not None])
+
+    return {
+        "status": "success",
+        "message": "Frame delivered"
+    }
+
+def reschedule(outbox_id: int, attempts: int, next_attempt: float, rejections: int = 0) -> dict:
+    conn = get_connection()
+
+    with conn:
+        conn.execute("UPDATE outbox SET attempts = ?, next_attempt = ?, rejections = ? WHERE id = ?",
+                     (attempts, next_attempt, rejections, outbox_id))
+
+    return {
+        "status": "success",
+        "message": "Frame rescheduled"
+    }
+
+def dead_letter(outbox_id: int) -> dict:
+    conn = get_connection()
+
+    # Kept for inspection, but no longer sent and no longer holding back the peer's later frames
+    with conn:
+        conn.execute("UPDATE outbox SET dead = 1 WHERE id = ?", (outbox_id,))
+
+    return {
+        "status": "success",
+        "message": "Frame dead-lettered"
+    }
+
+def get_received(delivery_ids: list) -> dict:
+    conn = get_connection()
+
+    placeholders = ", ".join("?" * len(delivery_ids))
+    rows = conn.execute(f"SELECT delivery_id FROM received_deliveries WHERE delivery_id IN ({placeholders})",
+                        delivery_ids).fetchall() if delivery_ids else []
+
+    return {
+        "status": "success",
+        "message": "Received deliveries retrieved successfully",
+        "data": {
+            "delivery_ids": {row["delivery_id"] for row in rows}
+        }
+    }
+
+def record_received(delivery_ids: list) -> dict:
+    conn = get_connection()
+
+    # A peer only resends while its frame is queued, ids older than the TTL are dropped on the way
+    now = time.time()
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO received_deliveries (delivery_id, received) VALUES (?, ?)",
+                         [(delivery_id, now) for delivery_id in delivery_ids])
+        conn.execute("DELETE FROM received_deliveries WHERE received < ?", (now - RECEIVED_DELIVERY_TTL_S,))
+
+    return {
+        "status": "success",
+        "message": "Received deliveries recorded"
+    }
+
+def set_chunk_offset(outbox_id: int, chunk_offset: int) -> dict:
+    conn = get_connection()
+
+    # Bytes of a chunked frame the peer acknowledged, a later attempt resumes there
+    with conn:
+        conn.execute("UPDATE outbox SET chunk_offset = ? WHERE id = ?", (chunk_offset, outbox_id))
+
+    return {
+        "status": "success",
+        "message": "Chunk offset updated"
+    }
+
+def wake_peer(user_id: str, friend_id: str) -> dict:
+    conn = get_connection()
+
+    with conn:
+        cursor = conn.execute(
+            "UPDATE outbox SET next_attempt = 0 WHERE user_id = ? AND friend_id = ? AND next_attempt > 0 AND dead = 0",
+            (user_id, friend_id)
+        )
+
+    return {
+        "status": "success",
+        "message": "Peer woken",
+        "data": {
+            "count": cursor.rowcount
+        }
+    }
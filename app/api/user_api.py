@@ -1,8 +1,10 @@
 import os
 import json
+import base64
 import hashlib
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
+from api import blob_store
 
 USER_DB_PATH = "db/users.json"
 
@@ -26,6 +28,14 @@ def _save_users(users: list):
     with open(USER_DB_PATH, "w") as f:
         json.dump(users, f, indent=2)
 
+def _migrate_profile(user: dict) -> bool:
+    # Older users.json entries carry the avatar inline as base64, it moves to the blob store
+    if "profile_base64" not in user:
+        return False
+    profile_base64 = user.pop("profile_base64")
+    user["profile_hash"] = blob_store.put_blob(base64.b64decode(profile_base64)) if profile_base64 else None
+    return True
+
 # api
 def authenticate_user(user_id: str, password: str) -> dict:
     users = _load_users()
@@ -33,6 +43,8 @@ def authenticate_user(user_id: str, password: str) -> dict:
     hashed = _hash_password(password)
     for user in users:
         if user["user_id"] == user_id and user["password"] == hashed:
+            if _migrate_profile(user):
+                _save_users(users)
             return {
                 "status": "success",
                 "message": "Authentication successful",
@@ -41,7 +53,7 @@ def authenticate_user(user_id: str, password: str) -> dict:
                     "password": user["password"],
                     "private_key": user["private_key"],
                     "public_key": user["public_key"],
-                    "profile_base64": user["profile_base64"]
+                    "profile_hash": user["profile_hash"]
                 }
             }
         
@@ -77,7 +89,7 @@ def create_user(user_id: str, password: str) -> dict:
         "password": _hash_password(password),
         "private_key": private_key,
         "public_key": public_key,
-        "profile_base64": None
+        "profile_hash": None
     })
     _save_users(users)
 
@@ -88,23 +100,25 @@ def create_user(user_id: str, password: str) -> dict:
             "user_id": user_id,
             "private_key": private_key,
             "public_key": public_key,
-            "profile_base64": None
+            "profile_hash": None
         }
     }
 
-def update_user_profile(user_id: str, profile_base64: str | None) -> dict:
+def update_user_profile(user_id: str, profile_bytes: bytes | None) -> dict:
     users = _load_users()
     
     for user in users:
         if user["user_id"] == user_id:
-            user["profile_base64"] = profile_base64
+            profile_hash = blob_store.put_blob(profile_bytes) if profile_bytes else None
+            user.pop("profile_base64", None)
+            user["profile_hash"] = profile_hash
             _save_users(users)
             return {
                 "status": "success",
                 "message": "Profile updated successfully",
                 "data": {
                     "user_id": user_id,
-                    "profile_base64": profile_base64
+                    "profile_hash": profile_hash
                 }
             }
         
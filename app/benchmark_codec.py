@@ -0,0 +1,88 @@
+"""
+Sweep the latent wire codecs (quality against size).
+
+Every image is encoded to a latent, encrypted, sent through each codec, decrypted and decoded again.
+Quality is the PSNR of that image against the image decoded from the lossless latent, using
+core/utils/basic.calculate_psnr. Run from app/:
+
+    python benchmark_codec.py path/to/image.png [more images...]
+"""
+import os
+import io
+import time
+import argparse
+import importlib.util
+import numpy as np
+import torch
+from PIL import Image
+from utils.core.onnx_encoding import encode_image_to_latent, decode_latent_to_image
+from utils.core.onnx_encryption import encrypt_latent, decrypt_latent
+from utils.core.latent_codec import ENTROPY_CODERS
+from utils.socket.latent_frame import encode_latent_frame, decode_latent_frame
+
+BASIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../core/utils/basic.py")
+SEED_STRING = "benchmark-seed"
+ENC_SEED_BYTES = bytes(256) # size of an RSA-2048 ciphertext
+
+def _load_calculate_psnr():
+    # core/ is not a package importable from app/, load the module from its path
+    spec = importlib.util.spec_from_file_location("core_basic", BASIC_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.calculate_psnr
+
+def _to_tensor(image: Image.Image) -> torch.Tensor:
+    # [-1, 1] range, as calculate_psnr expects
+    array = np.asarray(image.convert("RGB"), dtype=np.float32) / 127.5 - 1.0
+    return torch.from_numpy(array)
+
+def _configurations() -> list:
+    configurations = [("npy", None, None, None), ("raw", "float32", "raw", None), ("raw", "float16", "raw", None)]
+    for codec in ("int8", "int4"):
+        for entropy in ENTROPY_CODERS:
+            configurations.append((codec, "float32", codec, entropy))
+    return configurations
+
+def benchmark(image_paths: list, num_rounds: int = 8):
+    calculate_psnr = _load_calculate_psnr()
+    results = {configuration: {"size": [], "psnr": [], "time": []} for configuration in _configurations()}
+
+    for image_path in image_paths:
+        latent = encode_image_to_latent(Image.open(image_path))
+        reference = _to_tensor(decode_latent_to_image(latent))
+        enc_latent = encrypt_latent(latent, SEED_STRING, num_rounds)
+
+        for configuration in results:
+            name, dtype, codec, entropy = configuration
+            start = time.perf_counter()
+            if name == "npy":
+                buffer = io.BytesIO()
+                np.save(buffer, enc_latent)
+                payload = buffer.getvalue()
+                received = np.load(io.BytesIO(payload))
+            else:
+                payload = encode_latent_frame(enc_latent, ENC_SEED_BYTES, 0.0, dtype=dtype, codec=codec, entropy=entropy or "zlib")
+                received = decode_latent_frame(payload)["enc_latent_array"]
+            elapsed = time.perf_counter() - start
+
+            decrypted = decrypt_latent(received.astype(np.float32), SEED_STRING, num_rounds).astype(np.float32)
+            image = _to_tensor(decode_latent_to_image(decrypted))
+            results[configuration]["size"].append(len(payload))
+            results[configuration]["psnr"].append(calculate_psnr(image, reference))
+            results[configuration]["time"].append(elapsed)
+
+    baseline = np.mean(results[_configurations()[0]]["size"])
+    print(f"{'codec':<22}{'bytes':>10}{'ratio':>8}{'PSNR dB':>10}{'ms':>8}")
+    for (name, dtype, codec, entropy), result in results.items():
+        label = name if name == "npy" else f"{codec}/{dtype}" if codec == "raw" else f"{codec}+{entropy}"
+        size = np.mean(result["size"])
+        print(f"{label:<22}{size:>10.0f}{baseline / size:>8.1f}{np.mean(result['psnr']):>10.2f}{1000 * np.mean(result['time']):>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Latent codec benchmark')
+    parser.add_argument('image_paths', nargs='+', help='Images to encode and send through every codec')
+    parser.add_argument('--rounds', type=int, default=8, help='Number of encryption rounds (default: 8)')
+    args = parser.parse_args()
+
+    benchmark(args.image_paths, args.rounds)
@@ -0,0 +1,93 @@
+"""
+Microbenchmark of DoubleRatchet throughput (messages per second).
+
+Compares one call per message, in the JSON and the dr-v1 envelope form, against the batch
+encrypt_many/decrypt_many API. Every round uses a fresh pair of ratchets and stays within one
+sending chain, so only the receiver's first message pays for a DH ratchet step. Before timing, a
+longer conversation with replies and reordered messages checks that both sides stay in step across
+DH ratchet steps. Run from app/:
+
+    python benchmark_ratchet.py --rounds 200 --size 64
+"""
+import os
+import time
+import argparse
+from utils.DoubleRatchet import DoubleRatchet
+
+ROOT_KEY = b"benchmark-rootky"
+NUM_MESSAGES = 99 # per round
+CHECK_TURNS = 6 # alternating senders in the conversation check, each turn is a DH ratchet step
+CHECK_MESSAGES = 150 # per turn, more than one sending chain used to hold
+
+def _pair() -> tuple:
+    # Both ends start from the same root key, as after the friend handshake
+    return DoubleRatchet(ROOT_KEY, initiator=True), DoubleRatchet(ROOT_KEY, initiator=False)
+
+def _single(encrypt: str, decrypt: str):
+    def run(plaintexts: list, batch_size: int) -> tuple:
+        sender, receiver = _pair()
+        start = time.perf_counter()
+        messages = [getattr(sender, encrypt)(plaintext) for plaintext in plaintexts]
+        encrypted = time.perf_counter()
+        decrypted = [getattr(receiver, decrypt)(message) for message in messages]
+        return encrypted - start, time.perf_counter() - encrypted, decrypted
+    return run
+
+def _batch(plaintexts: list, batch_size: int) -> tuple:
+    sender, receiver = _pair()
+    batches = [plaintexts[i:i + batch_size] for i in range(0, len(plaintexts), batch_size)]
+    start = time.perf_counter()
+    envelope_batches = [sender.encrypt_many(batch) for batch in batches]
+    encrypted = time.perf_counter()
+    decrypted = [plaintext for envelopes in envelope_batches for plaintext in receiver.decrypt_many(envelopes)]
+    return encrypted - start, time.perf_counter() - encrypted, decrypted
+
+def check_conversation(size: int):
+    """Raises unless a conversation with replies and out-of-order messages decrypts on both sides."""
+    ends = _pair()
+    for turn in range(CHECK_TURNS):
+        sender, receiver = ends[turn % 2], ends[1 - turn % 2]
+        plaintexts = [os.urandom(size) for _ in range(CHECK_MESSAGES)]
+        envelopes = [sender.encrypt_bytes(plaintext) for plaintext in plaintexts]
+        # The first two messages of every turn arrive swapped
+        order = [1, 0, *range(2, CHECK_MESSAGES)]
+        decrypted = {i: receiver.decrypt_bytes(envelopes[i]) for i in order}
+        if [decrypted[i] for i in range(CHECK_MESSAGES)] != plaintexts:
+            raise RuntimeError(f"Conversation check failed in turn {turn}")
+
+PATHS = {
+    "json": _single("encrypt", "decrypt"),
+    "dr-v1": _single("encrypt_bytes", "decrypt_bytes"),
+    "dr-v1 batch": _batch,
+}
+
+def benchmark(num_rounds: int, size: int, batch_size: int):
+    num_messages = NUM_MESSAGES
+    rounds = [[os.urandom(size) for _ in range(num_messages)] for _ in range(num_rounds)]
+    check_conversation(size)
+
+    print(f"{'path':<14}{'encrypt/s':>12}{'decrypt/s':>12}{'enc vs json':>13}{'dec vs json':>13}")
+    baseline = None
+    for name, run in PATHS.items():
+        encrypt_time = decrypt_time = 0.0
+        for plaintexts in rounds:
+            encrypt_elapsed, decrypt_elapsed, decrypted = run(plaintexts, batch_size)
+            if decrypted != plaintexts:
+                raise RuntimeError(f"{name} did not return the original messages")
+            encrypt_time += encrypt_elapsed
+            decrypt_time += decrypt_elapsed
+
+        total = num_rounds * num_messages
+        rates = (total / encrypt_time, total / decrypt_time)
+        baseline = baseline or rates
+        print(f"{name:<14}{rates[0]:>12.0f}{rates[1]:>12.0f}{rates[0] / baseline[0]:>12.1f}x{rates[1] / baseline[1]:>12.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DoubleRatchet throughput benchmark')
+    parser.add_argument('--rounds', type=int, default=200, help='Number of fresh ratchet pairs (default: 200)')
+    parser.add_argument('--size', type=int, default=64, help='Plaintext size in bytes (default: 64)')
+    parser.add_argument('--batch', type=int, default=33, help='Messages per encrypt_many/decrypt_many call (default: 33)')
+    args = parser.parse_args()
+
+    benchmark(args.rounds, args.size, args.batch)
@@ -1,21 +1,38 @@
 import io
+import os
+import time
 import base64
 import random
 import string
 import numpy as np
 from PIL import Image
-from api import friend_api
+from api import friend_api, outbox_api, blob_store
 from utils.network import get_my_ip, get_my_port
 from utils.core.encryption import encrypt_with_RSAKey, decrypt_with_RSAKey
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
-from utils.DoubleRatchet import DoubleRatchet
+from utils.DoubleRatchet import DoubleRatchet, ENVELOPE_TYPE
+from utils.key_pair_pool import KeyPairPool
 from utils.socket.server_socket import ServerSocket
 from utils.socket.client_socket import ClientSocket
-from utils.image import base64_to_image, image_to_base64
+from utils.socket.outbox_sender import OutboxSender, BATCH_FORMAT
+from utils.socket.latent_frame import LATENT_FRAME_TYPE, LATENT_CODEC_FORMAT, latent_wire_codec, encode_latent_frame, decode_latent_frame
+from utils.core.latent_codec import ENTROPY_CODERS
+from utils.socket.chunked_transfer import CHUNKED_FORMAT, CHUNK_THRESHOLD, PARTIAL_DB_PATH, receive_chunk, finish_transfer
+from utils.image import base64_to_image, bytes_to_image, image_to_bytes, npy_bytes_to_array
 from states.user_store import UserStore
 from states.friends_store import FriendsStore, Friend
 
+AVATAR_HASH_FORMAT = "avatar-hash" # peer sends avatars as blob store hashes and serves them on blob_request
+BLOB_BINARY_TYPE = "blob"
+FRAME_TYPES = ("request_friend", "response_friend", "blob_request", "blob_response", "text_message", "batch",
+               "latent_chunk", "latent_message", "rekey", "rekey_ack") # frames handled here, profile_update is left to UserController
+REKEY_ROOT_KEY_SIZE = 32
+
+# Optional frame formats this client understands, announced in the friend handshake
+WIRE_FORMATS = [LATENT_FRAME_TYPE, LATENT_CODEC_FORMAT, *ENTROPY_CODERS, CHUNKED_FORMAT, AVATAR_HASH_FORMAT, BATCH_FORMAT,
+                ENVELOPE_TYPE]
+
 class FriendController:
     _instance = None
     _initialized = False
@@ -33,8 +50,11 @@ class FriendController:
 
     def _init_state(self):
         ServerSocket().add_callback(self._handle_socket_response)
+        OutboxSender() # starts delivering frames left over from the last session
+        KeyPairPool() # starts generating ratchet key pairs ahead of time
 
-    def add_friend(self, user_id: str, ip: str, port: int, friend_id: str, public_key: RSAPublicKey, profile_image: Image.Image | None, root_key: bytes) -> dict:
+    def add_friend(self, user_id: str, ip: str, port: int, friend_id: str, public_key: RSAPublicKey, profile_image: Image.Image | None, root_key: bytes,
+                   wire_formats: list | None = None, profile_hash: str | None = None) -> dict:
         if not isinstance(ip, str):
             raise ValueError("IP address must be a string")
         if not isinstance(port, int):
@@ -47,6 +67,10 @@ class FriendController:
             raise ValueError("Public key must be a RSAPublicKey object")
         if not isinstance(profile_image, Image.Image | None):
             raise ValueError("Profile image must be a PIL Image object")
+        if not isinstance(wire_formats, list | None):
+            raise ValueError("Wire formats must be a list")
+        if not isinstance(profile_hash, str | None):
+            raise ValueError("Profile hash must be a string")
         
         userStore = UserStore()
 
@@ -56,31 +80,26 @@ class FriendController:
                 "message": "User is not authenticated"
             }
         
-        # Create key bytes
-        priv_bytes = userStore.private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        )
-        pub_bytes = public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        doubleRatchet = DoubleRatchet(root_key, priv_bytes, pub_bytes)
+        doubleRatchet = DoubleRatchet(root_key, initiator=self._initiates(public_key))
         
         # Serialize
-        public_key = pub_bytes.decode('utf-8')
-        profile_base64 = image_to_base64(profile_image) if profile_image else None
-        double_ratchet_info = doubleRatchet.to_json()
+        public_key = public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode('utf-8')
+        if profile_hash is None and profile_image is not None:
+            profile_hash = blob_store.put_blob(image_to_bytes(profile_image))
+        ratchet_state = doubleRatchet.to_bytes()
+        wire_formats = ",".join(wire_formats or [])
 
-        response = friend_api.create_friend(user_id, ip, port, friend_id, public_key, profile_base64, double_ratchet_info)
+        response = friend_api.create_friend(user_id, ip, port, friend_id, public_key, profile_hash, ratchet_state, wire_formats)
 
         if response.get("status") == "success":
             data = response.get("data")
 
             # Deserialize profile image
             public_key = serialization.load_pem_public_key(data["public_key"].encode('utf-8'))
-            profile_image = base64_to_image(data.get("profile_base64")) if data.get("profile_base64") else None
+            profile_image = self._load_profile_image(data["profile_hash"])
 
             # Update FriendsStore
             friend = Friend(
@@ -91,7 +110,8 @@ class FriendController:
                 public_key=public_key,
                 profile_image=profile_image,
                 messages_list=[],
-                doubleRatchet = doubleRatchet
+                doubleRatchet = doubleRatchet,
+                wire_formats=[wire_format for wire_format in data["wire_formats"].split(",") if wire_format]
             )
             FriendsStore().add_friend(friend)            
             return {
@@ -104,6 +124,52 @@ class FriendController:
                 "message": response.get("message", "Failed to add friend")
             }
         
+    def _initiates(self, public_key: RSAPublicKey) -> bool:
+        # Both sides order the two identity keys the same way, so exactly one of them initiates the ratchet
+        my_pub_bytes = UserStore().public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        pub_bytes = public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        return my_pub_bytes < pub_bytes
+
+    def _start_rekey(self, friend: Friend) -> dict:
+        # Conversations from before the X25519 ratchet never take a DH step. The side that would initiate
+        # a new ratchet sends a fresh root key and keeps it pending, both sides switch to a ratchet of it
+        # once the friend has it. Friends on an older version ignore the frame and stay on the legacy chain.
+        userStore = UserStore()
+        root_key = os.urandom(REKEY_ROOT_KEY_SIZE)
+
+        def step(doubleRatchet):
+            doubleRatchet.pending_root_key = root_key
+            outbox = {
+                "ip": friend.ip,
+                "port": friend.port,
+                "json_dict": {
+                    "type": "rekey",
+                    "data": {
+                        "sender_id": userStore.user_id,
+                        "root_key": base64.b64encode(encrypt_with_RSAKey(root_key, friend.public_key)).decode('utf-8')
+                    }
+                }
+            }
+            return friend_api.update_ratchet_state(userStore.user_id, friend.friend_id, doubleRatchet.to_bytes(), outbox=outbox)
+        response = self._ratchet_step(friend, step)
+        if response.get("status") == "success":
+            OutboxSender().notify()
+        return response
+
+    def _switch_ratchet(self, friend: Friend, switch, outbox: dict | None = None) -> dict:
+        # Replaces the conversation's ratchet by `switch(doubleRatchet)`, under its lock like any other step
+        def step(doubleRatchet):
+            friend.doubleRatchet = switch(doubleRatchet)
+            return friend_api.update_ratchet_state(UserStore().user_id, friend.friend_id, friend.doubleRatchet.to_bytes(),
+                                                   outbox=outbox)
+        return self._ratchet_step(friend, step)
+
     def delete_friend(self, user_id: str, friend_id: str) -> dict:
         if not isinstance(user_id, str):
             raise ValueError("User ID must be a string")
@@ -146,28 +212,12 @@ class FriendController:
             friends_list = []
             for friend in data["friends"]:
                 friend["public_key"] = serialization.load_pem_public_key(friend["public_key"].encode('utf-8'))
-                friend["profile_image"] = base64_to_image(friend["profile_base64"])
-                messages_list = []
-                for message in friend["messages_list"]:
-                    if message.get("text"):
-                        messages_list.append({
-                            "sender_id": message['sender_id'],
-                            "text": message['text'],
-                            "timestamp": message['timestamp'],
-                            "is_read": message['is_read']
-                        })
-                        continue     
-                    enc_seed_bytes = base64.b64decode(message["enc_seed_string"].encode('utf-8'))
-                    messages_list.append({
-                        "sender_id": message['sender_id'],
-                        "enc_latent_size": message['enc_latent_size'],
-                        "enc_latent_array": message['enc_latent_array'],
-                        "enc_seed_bytes": enc_seed_bytes,
-                        "seed_string": message['seed_string'],
-                        "timestamp": message['timestamp'],
-                        "is_read": message['is_read']
-                    })
-                doubleRatchet = DoubleRatchet.from_json(friend["double_ratchet_info"])
+                friend["profile_image"] = self._load_profile_image(friend["profile_hash"])
+                messages_list = [self._deserialize_message(message) for message in friend["messages_list"]]
+                if friend["ratchet_state"] is not None:
+                    doubleRatchet = DoubleRatchet.from_bytes(friend["ratchet_state"])
+                else:
+                    doubleRatchet = DoubleRatchet.from_json(friend["double_ratchet_info"])
                 friends_list.append(Friend(
                     user_id=friend["user_id"],
                     ip=friend["ip"],
@@ -176,12 +226,19 @@ class FriendController:
                     public_key=friend["public_key"],
                     profile_image=friend["profile_image"],
                     messages_list= messages_list,
-                    doubleRatchet=doubleRatchet
+                    doubleRatchet=doubleRatchet,
+                    history_cursor=friend["cursor"],
+                    wire_formats=[wire_format for wire_format in friend["wire_formats"].split(",") if wire_format]
                 ))
             
             # Update FriendsStore
             FriendsStore().friends_list = friends_list
 
+            for friend in friends_list:
+                if friend.doubleRatchet.is_legacy and friend.doubleRatchet.pending_root_key is None \
+                        and self._initiates(friend.public_key):
+                    self._start_rekey(friend)
+
             return {
                 "status": "success",
                 "message": "Friends loaded successfully"
@@ -192,6 +249,99 @@ class FriendController:
                 "message": response.get("message", "Failed to load friends")
             }
 
+    def load_older_messages(self, friend_id: str) -> dict:
+        if not isinstance(friend_id, str):
+            raise ValueError("Friend ID must be a string")
+
+        userStore = UserStore()
+        if not userStore.is_authenticated:
+            return {
+                "status": "error",
+                "message": "User is not authenticated"
+            }
+
+        friend = FriendsStore().get_friend(friend_id)
+        if not friend:
+            return {
+                "status": "error",
+                "message": "Friend not found"
+            }
+        if friend.history_cursor is None:
+            return {
+                "status": "success",
+                "message": "No older messages"
+            }
+
+        response = friend_api.get_messages(userStore.user_id, friend_id, before=friend.history_cursor)
+
+        if response.get("status") == "success":
+            data = response.get("data")
+
+            # Update FriendsStore
+            older_messages = [self._deserialize_message(message) for message in data["messages"]]
+            friend.history_cursor = data["cursor"]
+            friend.messages_list = [*older_messages, *friend.messages_list]
+
+            return {
+                "status": "success",
+                "message": "Older messages loaded successfully"
+            }
+        else:
+            return {
+                "status": "error",
+                "message": response.get("message", "Failed to load older messages")
+            }
+
+    def get_latent_array(self, message: dict) -> np.ndarray | None:
+        """Latent of a message, loaded from disk the first time it is displayed."""
+        if "enc_latent_array" not in message:
+            message["enc_latent_array"] = friend_api.load_latent(message["enc_latent_path"], message.get("enc_latent_offset"),
+                                                                 message.get("enc_latent_dtype"), message.get("enc_latent_shape"))
+        return message["enc_latent_array"]
+
+    def _load_profile_image(self, profile_hash: str | None) -> Image.Image | None:
+        # None until a blob announced by a friend has been fetched
+        return bytes_to_image(blob_store.get_blob(profile_hash)) if profile_hash else None
+
+    def _fetch_profile_blob(self, friend_id: str, profile_hash: str | None):
+        # Only avatars missing from the blob store are requested, the friend answers with a blob_response
+        if profile_hash is None or blob_store.has_blob(profile_hash):
+            return
+        userStore = UserStore()
+        friend = FriendsStore().get_friend(friend_id)
+        if not friend:
+            return
+        outbox_api.enqueue(userStore.user_id, friend_id, friend.ip, friend.port, {
+            "type": "blob_request",
+            "data": {
+                "user_id": userStore.user_id,
+                "hash": profile_hash
+            }
+        })
+        OutboxSender().notify()
+
+    def _deserialize_message(self, message: dict) -> dict:
+        if message.get("text"):
+            return {
+                "sender_id": message['sender_id'],
+                "text": message['text'],
+                "timestamp": message['timestamp'],
+                "is_read": message['is_read']
+            }
+        enc_seed_bytes = base64.b64decode(message["enc_seed_string"].encode('utf-8'))
+        return {
+            "sender_id": message['sender_id'],
+            "enc_latent_size": message['enc_latent_size'],
+            "enc_latent_path": message['enc_latent_path'],
+            "enc_latent_offset": message['enc_latent_offset'],
+            "enc_latent_dtype": message['enc_latent_dtype'],
+            "enc_latent_shape": message['enc_latent_shape'],
+            "enc_seed_bytes": enc_seed_bytes,
+            "seed_string": message['seed_string'],
+            "timestamp": message['timestamp'],
+            "is_read": message['is_read']
+        }
+
     def request_friend(self, ip: str, port: int) -> dict:
         if not isinstance(ip, str):
             raise ValueError("IP address must be a string")
@@ -210,7 +360,6 @@ class FriendController:
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
         ).decode('utf-8')
-        profile_base64 = image_to_base64(userStore.profile_image)
 
         # Send request
         request_socket = ClientSocket(ip, port)
@@ -221,7 +370,9 @@ class FriendController:
                 "port": get_my_port(),
                 "user_id": userStore.user_id,
                 "public_key": public_key,
-                "profile_base64": profile_base64 if userStore.profile_image else None,
+                "profile_hash": userStore.profile_hash,
+                "profile_base64": None, # read by clients without avatar-hash, they show no avatar
+                "wire_formats": WIRE_FORMATS
                 }
             })
 
@@ -230,7 +381,29 @@ class FriendController:
             "message": "Friend request sent successfully"
         }
     
-    def receive_text_message(self, friend_id: str, dr_message: str, timestamp: float) -> None:
+    def _ratchet_step(self, friend: Friend, step) -> dict:
+        # `step(doubleRatchet)` advances the ratchet and commits its state, returning the api response.
+        # Sends (UI thread) and receives (socket threads) of one friend run one at a time from the step
+        # to the commit, so an older state can never be committed over a newer one. A step that raises
+        # or is not stored leaves the ratchet as it was.
+        with friend.ratchet_lock:
+            snapshot = friend.doubleRatchet.to_bytes()
+            try:
+                response = step(friend.doubleRatchet)
+            except Exception:
+                friend.doubleRatchet = DoubleRatchet.from_bytes(snapshot)
+                raise
+            if response.get("status") != "success":
+                friend.doubleRatchet = DoubleRatchet.from_bytes(snapshot)
+            return response
+
+    def _decrypt_text(self, friend: Friend, dr_message: str | bytes) -> str:
+        # dr-v1 envelopes arrive as the frame's binary section, the JSON form as a string
+        if isinstance(dr_message, str):
+            return friend.doubleRatchet.decrypt(dr_message).decode()
+        return friend.doubleRatchet.decrypt_bytes(dr_message).decode()
+
+    def receive_text_message(self, friend_id: str, dr_message: str | bytes, timestamp: float) -> None:
         userStore = UserStore()
         if not userStore.is_authenticated:
             return {
@@ -246,11 +419,13 @@ class FriendController:
                 "message": "Friend not found"
             }
         
-        text = friend.doubleRatchet.decrypt(dr_message).decode()
-        double_ratchet_info = friend.doubleRatchet.to_json()
-        is_read = friendStore.selected_friend and friendStore.selected_friend.friend_id == friend_id
-        response = friend_api.create_text_message(userStore.user_id, friend_id, friend_id, text, double_ratchet_info,
-                                             timestamp=timestamp, is_read=is_read)
+        is_read = bool(friendStore.selected_friend and friendStore.selected_friend.friend_id == friend_id)
+
+        def step(doubleRatchet):
+            text = self._decrypt_text(friend, dr_message)
+            return friend_api.create_text_message(userStore.user_id, friend_id, friend_id, text, doubleRatchet.to_bytes(),
+                                                  timestamp=timestamp, is_read=is_read)
+        response = self._ratchet_step(friend, step)
 
         if response.get("status") == "success":
             data = response.get("data")
@@ -275,6 +450,53 @@ class FriendController:
                 "message": response.get("message", "Failed to send message")
             }
 
+    def receive_text_messages(self, friend_id: str, dr_messages: list) -> None:
+        """Decrypt and store a batch of (dr_message, timestamp) with one transaction and one store update."""
+        userStore = UserStore()
+        if not userStore.is_authenticated:
+            return {
+                "status": "error",
+                "message": "User is not authenticated"
+            }
+        
+        friendStore = FriendsStore()
+        friend = friendStore.get_friend(friend_id)
+        if not friend:
+            return {
+                "status": "error",
+                "message": "Friend not found"
+            }
+        
+        is_read = bool(friendStore.selected_friend and friendStore.selected_friend.friend_id == friend_id)
+
+        def step(doubleRatchet):
+            if all(not isinstance(dr_message, str) for dr_message, _ in dr_messages):
+                # A batch of dr-v1 envelopes walks the chain in one pass
+                plaintexts = doubleRatchet.decrypt_many([dr_message for dr_message, _ in dr_messages])
+                messages = [(plaintext.decode(), timestamp) for plaintext, (_, timestamp) in zip(plaintexts, dr_messages)]
+            else:
+                messages = [(self._decrypt_text(friend, dr_message), timestamp) for dr_message, timestamp in dr_messages]
+            return friend_api.create_text_messages(userStore.user_id, friend_id, friend_id, messages, doubleRatchet.to_bytes(),
+                                                   is_read=is_read)
+        response = self._ratchet_step(friend, step)
+
+        if response.get("status") == "success":
+            data = response.get("data")
+
+            # Update FriendsStore
+            friend.messages_list = [*friend.messages_list, *data["messages"]]
+            
+            return {
+                "status": response.get("status", "success"),
+                "message": response.get("message", "Messages received successfully"),
+            }
+        
+        else:
+            return {
+                "status": response.get("status", "error"),
+                "message": response.get("message", "Failed to receive messages")
+            }
+
     def receive_latent_message(self, friend_id: str,  enc_latent_size: int, enc_latent_array: np.ndarray, enc_seed_string: str, seed_string: str, timestamp: float) -> None:
         userStore = UserStore()
         if not userStore.is_authenticated:
@@ -291,7 +513,7 @@ class FriendController:
                 "message": "Friend not found"
             }
         
-        is_read = friendStore.selected_friend and friendStore.selected_friend.friend_id == friend_id
+        is_read = bool(friendStore.selected_friend and friendStore.selected_friend.friend_id == friend_id)
         response = friend_api.create_latent_message(userStore.user_id, friend_id, friend_id, enc_latent_size,
                                                 enc_latent_array, enc_seed_string, seed_string,
                                                 timestamp=timestamp, is_read=is_read)
@@ -303,7 +525,7 @@ class FriendController:
             enc_seed_bytes = base64.b64decode(enc_seed_string.encode('utf-8'))
             message = {
                 "sender_id": data['sender_id'],
-                "enc_latent_array": enc_latent_array,
+                "enc_latent_array": data['enc_latent_array'],
                 "enc_latent_size": data['enc_latent_size'],
                 "enc_seed_bytes": enc_seed_bytes,
                 "seed_string": data['seed_string'],
@@ -385,9 +607,37 @@ class FriendController:
                 "message": "Friend not found"
             }
         
-        dr_message = friend.doubleRatchet.encrypt(text.encode('utf-8'))
-        double_ratchet_info = friend.doubleRatchet.to_json()
-        response = friend_api.create_text_message(user_id, friend_id, user_id, text, double_ratchet_info, is_read=True)
+        # Binary envelope in the frame's binary section when the friend supports it, JSON otherwise
+        timestamp = time.time()
+
+        def step(doubleRatchet):
+            text_data = {
+                "sender_id": user_id,
+                "timestamp": timestamp,
+            }
+            if ENVELOPE_TYPE in friend.wire_formats:
+                envelope = doubleRatchet.encrypt_bytes(text.encode('utf-8'))
+                binary_type = ENVELOPE_TYPE
+            else:
+                text_data["dr_message"] = doubleRatchet.encrypt(text.encode('utf-8'))
+                envelope, binary_type = None, None
+
+            # Delivered by the outbox sender, the message is committed together with its frame.
+            # A burst of texts may go out as one batch frame.
+            outbox = {
+                "ip": friend.ip,
+                "port": friend.port,
+                "json_dict": {
+                    "type": "text_message",
+                    "data": text_data
+                },
+                "binary_bytes": envelope,
+                "binary_type": binary_type,
+                "batchable": BATCH_FORMAT in friend.wire_formats
+            }
+            return friend_api.create_text_message(user_id, friend_id, user_id, text, doubleRatchet.to_bytes(),
+                                                  timestamp=timestamp, is_read=True, outbox=outbox)
+        response = self._ratchet_step(friend, step)
 
         if response.get("status") == "success":
             data = response.get("data")
@@ -403,15 +653,7 @@ class FriendController:
             friend.messages_list = [*friend.messages_list, message]
 
             # Propagation event
-            socket = ClientSocket(friend.ip, friend.port)
-            socket.send({
-                "type": "text_message",
-                "data": {
-                    "sender_id": data["sender_id"],
-                    "dr_message": dr_message,
-                    "timestamp": data['timestamp'],
-                }
-            })
+            OutboxSender().notify()
 
             return {
                 "status": response.get("status", "success"),
@@ -451,15 +693,51 @@ class FriendController:
                 "message": "Friend not found"
             }
         
-        # Serialize
-        buffer = io.BytesIO()
-        np.save(buffer, enc_latent_array)
-        enc_latent_bytes = buffer.getvalue()
+        # Serialize, as a compact latent-v1 frame when the friend supports it and as .npy otherwise
+        timestamp = time.time()
+        if LATENT_FRAME_TYPE in friend.wire_formats:
+            codec = latent_wire_codec if LATENT_CODEC_FORMAT in friend.wire_formats else "raw"
+            entropy = "zstd" if "zstd" in friend.wire_formats and "zstd" in ENTROPY_CODERS else "zlib"
+            enc_latent_bytes = encode_latent_frame(enc_latent_array, enc_seed_bytes, timestamp, codec=codec, entropy=entropy)
+            binary_type = LATENT_FRAME_TYPE
+        else:
+            buffer = io.BytesIO()
+            np.save(buffer, enc_latent_array)
+            enc_latent_bytes = buffer.getvalue()
+            binary_type = "pt"
         enc_latent_size = len(enc_latent_bytes)
 
         enc_seed_string = base64.b64encode(enc_seed_bytes).decode('utf-8')
 
-        response = friend_api.create_latent_message(user_id, friend_id, user_id, enc_latent_size, enc_latent_array, enc_seed_string, seed_string, is_read=True)
+        # latent-v1 frames carry the seed and timestamp in their header
+        if binary_type == LATENT_FRAME_TYPE:
+            latent_data = {
+                "sender_id": user_id,
+                "enc_latent_size": enc_latent_size,
+            }
+        else:
+            latent_data = {
+                "sender_id": user_id,
+                "enc_latent_size": enc_latent_size,
+                "enc_seed_string": enc_seed_string,
+                "seed_string": None,
+                "timestamp": timestamp,
+            }
+
+        # Delivered by the outbox sender, the message is committed together with its frame
+        outbox = {
+            "ip": friend.ip,
+            "port": friend.port,
+            "json_dict": {
+                "type": "latent_message",
+                "data": latent_data
+            },
+            "binary_bytes": enc_latent_bytes,
+            "binary_type": binary_type,
+            "chunked": CHUNKED_FORMAT in friend.wire_formats and enc_latent_size > CHUNK_THRESHOLD
+        }
+        response = friend_api.create_latent_message(user_id, friend_id, user_id, enc_latent_size, enc_latent_array, enc_seed_string, seed_string,
+                                                    timestamp=timestamp, is_read=True, outbox=outbox)
 
         if response.get("status") == "success":
             data = response.get("data")
@@ -468,7 +746,7 @@ class FriendController:
 
             message = {
                 "sender_id": data['sender_id'],
-                "enc_latent_array": enc_latent_array,
+                "enc_latent_array": data['enc_latent_array'],
                 "enc_latent_size": enc_latent_size,
                 "enc_seed_bytes": enc_seed_bytes,
                 "seed_string": data['seed_string'],
@@ -480,17 +758,7 @@ class FriendController:
             friend.messages_list = [*friend.messages_list, message]
 
             # Propagation event
-            socket = ClientSocket(friend.ip, friend.port)
-            socket.send({
-                "type": "latent_message",
-                "data": {
-                    "sender_id": data["sender_id"],
-                    "enc_latent_size": enc_latent_size,
-                    "enc_seed_string": enc_seed_string,
-                    "seed_string": None,
-                    "timestamp": data['timestamp'],
-                }
-            }, binary_bytes=enc_latent_bytes, binary_type="pt")
+            OutboxSender().notify()
 
             return {
                 "status": response.get("status", "success"),
@@ -517,11 +785,14 @@ class FriendController:
             "message": "Friend unselected successfully"
         }
 
-    def update_friend_profile(self, user_id: str, friend_id: str, profile_image: Image.Image | None) -> dict:
+    def update_friend_profile(self, user_id: str, friend_id: str, profile_image: Image.Image | None,
+                              profile_hash: str | None = None) -> dict:
         if not isinstance(friend_id, str):
             raise ValueError("Friend ID must be a string")
         if not isinstance(profile_image, Image.Image | None):
             raise ValueError("Profile image must be a PIL Image object")
+        if not isinstance(profile_hash, str | None):
+            raise ValueError("Profile hash must be a string")
         
         if not UserStore().is_authenticated:
             return {
@@ -530,19 +801,21 @@ class FriendController:
             }
         
         # Serialize
-        profile_base64 = image_to_base64(profile_image)
+        if profile_hash is None and profile_image is not None:
+            profile_hash = blob_store.put_blob(image_to_bytes(profile_image))
 
-        response = friend_api.update_friend_profile(user_id, friend_id, profile_base64)
+        response = friend_api.update_friend_profile(user_id, friend_id, profile_hash)
 
         if response.get("status") == "success":
             data = response.get("data")
 
             # Deserialize
-            profile_image = base64_to_image(data["profile_base64"])
+            profile_image = self._load_profile_image(data["profile_hash"])
 
             # Update FriendsStore
             friend = FriendsStore().get_friend(friend_id)
             friend.profile_image = profile_image
+            self._fetch_profile_blob(friend_id, data["profile_hash"])
 
             return {
                 "status": response.get("status", "success"),
@@ -561,10 +834,28 @@ class FriendController:
 
         userStore = UserStore()
 
+        # Any frame from a friend means it is reachable again, flush what is queued for it
+        if userStore.is_authenticated and type in ("text_message", "batch", "latent_message", "latent_chunk", "profile_update",
+                                                   "blob_request", "blob_response", "rekey", "rekey_ack"):
+            sender_id = data.get("sender_id") or data.get("user_id") or data.get("frame", {}).get("data", {}).get("sender_id")
+            if sender_id:
+                OutboxSender().wake_peer(userStore.user_id, sender_id)
+
+        if type not in FRAME_TYPES:
+            return
+        if not userStore.is_authenticated:
+            # Acked "BY", the peer keeps the frame queued instead of marking it delivered
+            raise ConnectionRefusedError(f"Received a {type} frame while logged out")
+
+        # Outbox frames carry a delivery_id, one resent after a lost ack is acked again but not handled twice
+        delivery_id = json_dict.get("delivery_id")
+        if delivery_id and outbox_api.get_received([delivery_id])["data"]["delivery_ids"]:
+            return
+
         if type == "request_friend":
             # Accept friend request
             public_key = serialization.load_pem_public_key(data["public_key"].encode('utf-8'))
-            profile_image = base64_to_image(data["profile_base64"])
+            profile_image = base64_to_image(data.get("profile_base64"))
             root_key =  ''.join(random.choices(string.ascii_letters + string.digits, k=16)).encode('utf-8')
             result = self.add_friend(
                 user_id=userStore.user_id,
@@ -573,7 +864,9 @@ class FriendController:
                 friend_id=data["user_id"],
                 public_key=public_key,
                 profile_image=profile_image,
-                root_key=root_key
+                root_key=root_key,
+                wire_formats=data.get("wire_formats", []),
+                profile_hash=data.get("profile_hash")
             )
             if result["status"] == "success":
                 root_key = encrypt_with_RSAKey(root_key, public_key)
@@ -582,7 +875,12 @@ class FriendController:
                     encoding=serialization.Encoding.PEM,
                     format=serialization.PublicFormat.SubjectPublicKeyInfo
                 ).decode('utf-8')
-                profile_base64 = image_to_base64(userStore.profile_image) if userStore.profile_image else None
+                # Friends without avatar-hash still get the image inline
+                if AVATAR_HASH_FORMAT in data.get("wire_formats", []):
+                    profile = {"profile_hash": userStore.profile_hash}
+                else:
+                    profile_bytes = blob_store.get_blob(userStore.profile_hash) if userStore.profile_hash else None
+                    profile = {"profile_base64": base64.b64encode(profile_bytes).decode('utf-8') if profile_bytes else None}
 
                 response_socket = ClientSocket(data["ip"], data["port"])
                 response_socket.send({
@@ -592,15 +890,18 @@ class FriendController:
                         "port": get_my_port(),
                         "user_id": userStore.user_id,
                         "public_key": public_key,
-                        "profile_base64": profile_base64,
-                        "root_key": root_key
+                        **profile,
+                        "root_key": root_key,
+                        "wire_formats": WIRE_FORMATS
                     }
                 })
+                # Requested only now, the friend has to know us before it serves the blob
+                self._fetch_profile_blob(data["user_id"], data.get("profile_hash"))
 
         elif type == "response_friend":
             # Accept friend request
             public_key = serialization.load_pem_public_key(data["public_key"].encode('utf-8'))
-            profile_image = base64_to_image(data["profile_base64"])
+            profile_image = base64_to_image(data.get("profile_base64"))
             root_key = base64.b64decode(data['root_key'])
             root_key = decrypt_with_RSAKey(root_key, userStore.private_key)
 
@@ -611,20 +912,127 @@ class FriendController:
                 friend_id=data["user_id"],
                 public_key=public_key,
                 profile_image=profile_image,
-                root_key=root_key
+                root_key=root_key,
+                wire_formats=data.get("wire_formats", []),
+                profile_hash=data.get("profile_hash")
             )
+            if result["status"] == "success":
+                self._fetch_profile_blob(data["user_id"], data.get("profile_hash"))
+
+        elif type == "rekey":
+            # The friend re-keys our legacy conversation, we switch right away and ack through the outbox,
+            # after anything we queued on the legacy chain. Its legacy messages still decrypt until it switched too.
+            friend = FriendsStore().get_friend(data["sender_id"])
+            if not friend:
+                raise ValueError("Friend not found")
+            if not friend.doubleRatchet.is_legacy and friend.doubleRatchet.legacy is None:
+                raise ValueError(f"Conversation with {friend.friend_id} is not on the legacy chain")
+            root_key = decrypt_with_RSAKey(base64.b64decode(data["root_key"]), userStore.private_key)
+            response = self._switch_ratchet(friend, lambda doubleRatchet: DoubleRatchet.rekeyed(doubleRatchet, root_key), outbox={
+                "ip": friend.ip,
+                "port": friend.port,
+                "json_dict": {
+                    "type": "rekey_ack",
+                    "data": {
+                        "sender_id": userStore.user_id
+                    }
+                }
+            })
+            if response["status"] != "success":
+                raise ValueError(response["message"])
+            OutboxSender().notify()
+
+        elif type == "rekey_ack":
+            # Everything the friend sent on the legacy chain came before this
+            friend = FriendsStore().get_friend(data["sender_id"])
+            if not friend:
+                raise ValueError("Friend not found")
+            root_key = friend.doubleRatchet.pending_root_key
+            if root_key is not None:
+                response = self._switch_ratchet(friend, lambda _: DoubleRatchet(root_key, initiator=True))
+                if response["status"] != "success":
+                    raise ValueError(response["message"])
+
+        elif type == "blob_request":
+            # Only our own current avatar is served, queued so this handler does not wait on the friend
+            friend = FriendsStore().get_friend(data["user_id"])
+            if friend and data["hash"] == userStore.profile_hash:
+                outbox_api.enqueue(userStore.user_id, friend.friend_id, friend.ip, friend.port, {
+                    "type": "blob_response",
+                    "data": {
+                        "user_id": userStore.user_id,
+                        "hash": data["hash"]
+                    }
+                }, blob_store.get_blob(data["hash"]), BLOB_BINARY_TYPE)
+                OutboxSender().notify()
+
+        elif type == "blob_response":
+            if binary_type != BLOB_BINARY_TYPE or blob_store.hash_of(binary_bytes) != data["hash"]:
+                raise ValueError(f"Blob does not match its hash {data['hash']}")
+            blob_store.put_blob(bytes(binary_bytes))
+            response = self.update_friend_profile(userStore.user_id, data["user_id"], None, profile_hash=data["hash"])
+            if response["status"] != "success":
+                raise ValueError(response["message"])
     
         elif type == "text_message":
             sender_id = data["sender_id"]
-            dr_message = data["dr_message"]
+            dr_message = binary_bytes if binary_type == ENVELOPE_TYPE else data["dr_message"]
             timestamp = data["timestamp"]
-            self.receive_text_message(sender_id, dr_message, timestamp)
+            response = self.receive_text_message(sender_id, dr_message, timestamp)
+            if response["status"] != "success":
+                raise ValueError(response["message"])
+
+        elif type == "batch":
+            # Only text messages are batched, they are stored together and notify observers once.
+            # A resent batch may hold frames that were already handled, those are skipped by delivery_id.
+            view = memoryview(binary_bytes) if binary_bytes else None
+            binary_sizes = data.get("binary_sizes") or [0] * len(data["frames"])
+            delivery_ids = [frame["delivery_id"] for frame in data["frames"] if frame.get("delivery_id")]
+            received = outbox_api.get_received(delivery_ids)["data"]["delivery_ids"]
+            dr_messages = []
+            offset = 0
+            for frame, size in zip(data["frames"], binary_sizes):
+                if frame.get("type") == "text_message" and frame.get("delivery_id") not in received:
+                    dr_message = view[offset:offset + size] if binary_type == ENVELOPE_TYPE else frame["data"]["dr_message"]
+                    dr_messages.append((dr_message, frame["data"]["timestamp"]))
+                offset += size
+            if dr_messages:
+                # Raised so the batch is acked "ER" and stays queued, none of its frames were stored
+                response = self.receive_text_messages(data["sender_id"], dr_messages)
+                if response["status"] != "success":
+                    raise ValueError(response["message"])
+            outbox_api.record_received([delivery_id for delivery_id in delivery_ids if delivery_id not in received])
+
+        elif type == "latent_chunk":
+            # Chunks are spooled to disk, the reassembled frame is handled like a direct one
+            spool_dir = os.path.join(PARTIAL_DB_PATH, userStore.user_id)
+            completed = receive_chunk(data, binary_bytes, spool_dir)
+            if completed:
+                self._handle_socket_response(*completed)
+                finish_transfer(data["transfer_id"], spool_dir)
+
+        elif type == "latent_message" and binary_type == LATENT_FRAME_TYPE:
+            frame = decode_latent_frame(binary_bytes)
+            sender_id = data["sender_id"]
+            enc_latent_size = data["enc_latent_size"]
+            enc_latent_array = frame["enc_latent_array"]
+            enc_seed_string = base64.b64encode(frame["enc_seed_bytes"]).decode('utf-8')
+            timestamp = frame["timestamp"]
+            response = self.receive_latent_message(sender_id, enc_latent_size, enc_latent_array, enc_seed_string, None, timestamp)
+            if response["status"] != "success":
+                raise ValueError(response["message"])
 
         elif type == "latent_message":
             sender_id = data["sender_id"]
             enc_latent_size = data["enc_latent_size"]
-            enc_latent_array = np.load(io.BytesIO(binary_bytes)) if binary_bytes else None
+            # Viewed in place over the receive buffer and written from there to the latent store
+            enc_latent_array = npy_bytes_to_array(binary_bytes) if binary_bytes else None
             enc_seed_string = data["enc_seed_string"]
             seed_string = data.get("seed_string", None)
             timestamp = data["timestamp"]
-            self.receive_latent_message(sender_id, enc_latent_size, enc_latent_array, enc_seed_string, seed_string, timestamp)
\ No newline at end of file
+            response = self.receive_latent_message(sender_id, enc_latent_size, enc_latent_array, enc_seed_string, seed_string, timestamp)
+            if response["status"] != "success":
+                raise ValueError(response["message"])
+
+        if delivery_id:
+            outbox_api.record_received([delivery_id])
\ No newline at end of file
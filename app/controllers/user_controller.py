@@ -1,12 +1,17 @@
+import time
+import base64
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from cryptography.hazmat.primitives import serialization
-from api import user_api
-from utils.image import base64_to_image, image_to_base64
+from api import user_api, blob_store
+from utils.image import base64_to_image, bytes_to_image, image_to_bytes
 from states.user_store import UserStore
 from states.friends_store import FriendsStore
 from utils.socket.server_socket import ServerSocket
-from utils.socket.client_socket import ClientSocket
-from controllers.friend_controller import FriendController
+from utils.socket.client_socket import broadcast
+from utils.socket.outbox_sender import OutboxSender
+from api import outbox_api
+from controllers.friend_controller import FriendController, AVATAR_HASH_FORMAT
 
 class UserController:
     _instance = None
@@ -25,6 +30,8 @@ class UserController:
 
     def _init_state(self):
         ServerSocket().add_callback(self._handle_socket_response)
+        # Profile updates go out one at a time and off the UI thread, a newer one never overtakes an older one
+        self._profile_executor = ThreadPoolExecutor(max_workers=1)
 
     def login(self, user_id: str, password:str) -> dict:
         if not isinstance(user_id, str) or user_id == "":
@@ -45,7 +52,8 @@ class UserController:
             public_key = serialization.load_pem_public_key(
                 data["public_key"].encode('utf-8')
             )
-            profile_image = base64_to_image(data.get("profile_base64"))
+            profile_hash = data.get("profile_hash")
+            profile_image = bytes_to_image(blob_store.get_blob(profile_hash)) if profile_hash else None
 
             # Update UserStore
             userStore = UserStore()
@@ -53,6 +61,7 @@ class UserController:
             userStore.private_key = private_key
             userStore.public_key = public_key
             userStore.profile_image = profile_image
+            userStore.profile_hash = profile_hash
 
             # Propagation event
             FriendController().load_friends()
@@ -107,25 +116,18 @@ class UserController:
                 "message": "User is not authenticated"
             }
         
-        profile_base64 = image_to_base64(profile_image)
-        response = user_api.update_user_profile(user_id, profile_base64)
+        response = user_api.update_user_profile(user_id, image_to_bytes(profile_image))
         
         if response.get("status") == "success":
             data = response.get("data")
 
             # Update UserStore
-            userStore.profile_image = base64_to_image(data["profile_base64"])
+            userStore.profile_image = profile_image
+            userStore.profile_hash = data["profile_hash"]
             
-            # Propagation event
-            for friend in FriendsStore().friends_list:
-                friend_socket = ClientSocket(friend.ip, friend.port)
-                friend_socket.send({
-                    "type": "profile_update",
-                    "data": {
-                        "user_id": data["user_id"],
-                        "profile_base64": data["profile_base64"],
-                        }
-                    })
+            # Propagation event, fanned out in the background
+            self._profile_executor.submit(self._propagate_profile_update, user_id, list(FriendsStore().friends_list),
+                                          data["profile_hash"], time.time())
                 
             return {
                 "status": response.get("status", "success"),
@@ -137,6 +139,44 @@ class UserController:
                 "message": response.get("message", "Profile update failed")
             }
         
+    def _propagate_profile_update(self, user_id: str, friends: list, profile_hash: str | None, updated: float):
+        # Only the hash is sent, friends fetch the blob if they do not have it yet.
+        # Friends without avatar-hash still get the image inline.
+        # Sent to every friend at once, the ones that cannot be reached get it through the outbox.
+        # An older update still queued or in flight may arrive after this one, friends ignore it by `updated`.
+        hash_friends = [friend for friend in friends if AVATAR_HASH_FORMAT in friend.wire_formats]
+        legacy_friends = [friend for friend in friends if AVATAR_HASH_FORMAT not in friend.wire_formats]
+        updates = [(hash_friends, {"profile_hash": profile_hash})]
+        if legacy_friends:
+            profile_bytes = blob_store.get_blob(profile_hash) if profile_hash else None
+            profile_base64 = base64.b64encode(profile_bytes).decode('utf-8') if profile_bytes else None
+            updates.append((legacy_friends, {"profile_base64": profile_base64}))
+
+        queued = []
+        for group, profile in updates:
+            if not group:
+                continue
+            profile_update = {
+                "type": "profile_update",
+                "data": {
+                    "user_id": user_id,
+                    "updated": updated,
+                    **profile
+                    }
+                }
+            failed = set(broadcast([(friend.ip, friend.port) for friend in group], profile_update))
+            queued += [(friend.friend_id, friend.ip, friend.port, profile_update) for friend in group
+                       if (friend.ip, friend.port) in failed]
+
+        # Updates still queued from before are stale now, dropped and replaced in one transaction
+        try:
+            outbox_api.replace_queued(user_id, "profile_update", queued)
+        except Exception as e:
+            print(f"[UserController] Failed to queue the profile update: {e}")
+            return
+        if queued:
+            OutboxSender().notify()
+
     def _handle_socket_response(self, json_data: dict, binary_bytes: bytes | None = None, binary_type: str | None = None):
         userStore = UserStore()
 
@@ -144,11 +184,35 @@ class UserController:
         data = json_data.get("data")
 
         if type == "profile_update":
+            if not userStore.is_authenticated:
+                # Acked "BY", the friend keeps the update queued
+                raise ConnectionRefusedError("Received a profile_update frame while logged out")
+            # A resent update is acked again but not applied twice
+            delivery_id = json_data.get("delivery_id")
+            if delivery_id and outbox_api.get_received([delivery_id])["data"]["delivery_ids"]:
+                return
+
             user_id =  userStore.user_id
             friend_id = data.get("user_id")
+            friend = FriendsStore().get_friend(friend_id)
+            updated = data.get("updated", 0.0)
+            if friend and updated and updated <= friend.profile_updated:
+                # Superseded by a newer update that arrived first
+                if delivery_id:
+                    outbox_api.record_received([delivery_id])
+                return
+
+            # Inline images come from friends without avatar-hash
             profile_image = base64_to_image(data.get("profile_base64"))
-            FriendController().update_friend_profile(
+            response = FriendController().update_friend_profile(
                 user_id,
                 friend_id,
-                profile_image
-            )
\ No newline at end of file
+                profile_image,
+                profile_hash=data.get("profile_hash")
+            )
+            if response["status"] != "success":
+                raise ValueError(response["message"])
+            if friend and updated:
+                friend.profile_updated = updated
+            if delivery_id:
+                outbox_api.record_received([delivery_id])
\ No newline at end of file
@@ -1,9 +1,10 @@
+import threading
 from PIL import Image
 from states.observable import Observable
 from utils.DoubleRatchet import DoubleRatchet
 
 class Friend(Observable):
-    def __init__(self, user_id: str, ip: str, port: int, friend_id: str, public_key: str, profile_image: Image.Image | None, messages_list: list, doubleRatchet: DoubleRatchet):
+    def __init__(self, user_id: str, ip: str, port: int, friend_id: str, public_key: str, profile_image: Image.Image | None, messages_list: list, doubleRatchet: DoubleRatchet, history_cursor: list | None = None, wire_formats: list | None = None):
         super().__init__()
         self.ip = ip
         self.port = port
@@ -13,6 +14,10 @@ class Friend(Observable):
         self._profile_image = profile_image
         self._messages_list = messages_list
         self.doubleRatchet = doubleRatchet
+        self.ratchet_lock = threading.Lock() # held from a ratchet step until its state is committed
+        self.history_cursor = history_cursor # None once the oldest message is loaded
+        self.wire_formats = wire_formats or [] # optional frame formats the friend can receive
+        self.profile_updated = 0.0 # friend's timestamp of the last profile_update applied, older ones are ignored
 
     @property
     def profile_image(self):
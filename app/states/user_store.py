@@ -21,6 +21,7 @@ class UserStore(Observable):
         self.private_key = None
         self.public_key = None
         self._profile_image = None
+        self.profile_hash = None # blob store hash of the avatar, what peers are sent instead of the image
 
     @property
     def user_id(self):
@@ -18,6 +18,26 @@ class Button(ctk.CTkButton):
             border_width=style["border_width"],
             **kwargs
         )
+        self._progress_job = None
+
+    def start_progress(self, text: str):
+        """Show `text` with animated trailing dots until stop_progress() is called."""
+        self._progress_text = text
+        self._progress_step = 0
+        if self._progress_job is None:
+            self._tick_progress()
+
+    def stop_progress(self, text: str):
+        if self._progress_job is not None:
+            self.after_cancel(self._progress_job)
+            self._progress_job = None
+        self.configure(text=text)
+
+    def _tick_progress(self):
+        dots = "." * (self._progress_step % 3 + 1)
+        self.configure(text=f"{self._progress_text}{dots}")
+        self._progress_step += 1
+        self._progress_job = self.after(400, self._tick_progress)
 
     def _get_style(self, type: str):
         if type == "white":
@@ -3,7 +3,9 @@ import string
 import customtkinter as ctk
 import tkinter.filedialog as fd
 from ui.atoms.button import Button
+from ui.atoms.toast import Toast
 from utils.image import path_to_image
+from utils.inference_executor import InferenceExecutor, on_future_done
 from utils.core.onnx_encoding import encode_image_to_latent
 from utils.core.onnx_encryption import encrypt_latent
 from utils.core.encryption import encrypt_with_RSAKey
@@ -37,39 +39,69 @@ class ChatInput(ctk.CTkFrame):
         self.send_button.grid(row=2, column=1, sticky="e", padx=10, pady=10)
 
         self.selected_file = None
+        self._encode_future = None
 
     def pick_file(self):
         path = fd.askopenfilename(filetypes=[("Image Files", "*.png *.jpg *.jpeg")])
+
+        # A new pick supersedes any encoding that is still queued or running
+        if self._encode_future:
+            self._encode_future.cancel()
+            self._encode_future = None
+
         if path:
             self.selected_file = path
 
             friend = FriendsStore().selected_friend
 
-            # encode
+            # encode in the background
             self.is_encoding = True
-            self.file_button.configure(text="Encoding...")
+            self.file_button.start_progress("Encoding")
             self.send_button.configure(state='disabled')
-            
-            image = path_to_image(self.selected_file)
-            latent_array = encode_image_to_latent(image)
-            
-            # encrypt latent
-            self.seed_string = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-            self.enc_latent_array = encrypt_latent(latent_array, self.seed_string)
-            
-            # encrypt_seed
-            self.enc_seed_bytes = encrypt_with_RSAKey(self.seed_string.encode('utf-8'), friend.public_key)
-
-            self.is_encoding = False
-            self.file_button.configure(text="File chosen")
-            self.send_button.configure(state='normal')
+
+            self._encode_future = InferenceExecutor().submit(self._encode_file, path, friend.public_key)
+            on_future_done(self, self._encode_future, self._on_file_encoded)
         else:
-            self.selected_file = None
-            self.enc_latent_array = None
-            self.enc_seed_string = None
-            self.seed_string = None
-            self.file_button.configure(text="Choose file")
-            self.send_button.configure(state='normal')
+            self._reset_file()
+
+    def _encode_file(self, path, public_key):
+        # Runs on an inference worker thread, must not touch any widget
+        image = path_to_image(path)
+        latent_array = encode_image_to_latent(image)
+
+        # encrypt latent
+        seed_string = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+        enc_latent_array = encrypt_latent(latent_array, seed_string)
+
+        # encrypt_seed
+        enc_seed_bytes = encrypt_with_RSAKey(seed_string.encode('utf-8'), public_key)
+        return seed_string, enc_latent_array, enc_seed_bytes
+
+    def _on_file_encoded(self, future):
+        # Result of a pick that has since been replaced
+        if future is not self._encode_future:
+            return
+        self._encode_future = None
+        self.is_encoding = False
+
+        try:
+            self.seed_string, self.enc_latent_array, self.enc_seed_bytes = future.result()
+        except Exception as e:
+            self._reset_file()
+            Toast(self, f"Error: {str(e)}", type="error", duration=2000)
+            return
+
+        self.file_button.stop_progress("File chosen")
+        self.send_button.configure(state='normal')
+
+    def _reset_file(self):
+        self.is_encoding = False
+        self.selected_file = None
+        self.enc_latent_array = None
+        self.enc_seed_string = None
+        self.seed_string = None
+        self.file_button.stop_progress("Choose file")
+        self.send_button.configure(state='normal')
 
     def send_message(self):
         text = self.textbox.get("0.0", "end").strip()
@@ -11,8 +11,10 @@ from utils.core.onnx_encryption import encrypt_latent, decrypt_latent
 from utils.core.encryption import decrypt_with_RSAKey
 from utils.mac import get_mac_address
 from utils.image import latent_to_gray_image
+from utils.inference_executor import InferenceExecutor, on_future_done
 from states.user_store import UserStore
 from controllers.user_controller import UserController
+from controllers.friend_controller import FriendController
 
 MAC_ADDRESS = get_mac_address()
 
@@ -23,8 +25,9 @@ class DecryptImage(ctk.CTkFrame):
         self.grid_rowconfigure(0, weight=1)
         self.grid_columnconfigure(0, weight=1)
         self.message = message
+        self._decrypt_future = None
 
-        latent_image = latent_to_gray_image(message["enc_latent_array"])
+        latent_image = latent_to_gray_image(FriendController().get_latent_array(message))
         self.latent_image_label = ImageFrame( master=self, image=latent_image, width=256, height=256, border_radius=5)
         self.latent_image_label.pack(padx=40, pady=(20, 10))
 
@@ -60,23 +63,47 @@ class DecryptImage(ctk.CTkFrame):
                 enc_seed_bytes = self.message["enc_seed_bytes"]
                 seed_bytes = decrypt_with_RSAKey(enc_seed_bytes, UserStore().private_key)
                 seed_string = seed_bytes.decode('utf-8')  # Ensure seed is a string
+        except Exception as e:
+            Toast(self, f"Authentication failed: {str(e)}", type="error", duration=2000)
+            return
+
+        # decrypt and decode latent tensor in the background
+        if self._decrypt_future:
+            self._decrypt_future.cancel()
+        self.decrypt_button.start_progress("Decrypting")
+        self.decrypt_button.configure(state='disabled')
+        self._decrypt_future = InferenceExecutor().submit(self._decrypt_and_decode, FriendController().get_latent_array(self.message), seed_string)
+        on_future_done(self, self._decrypt_future, self._on_decrypted)
+
+    def _decrypt_and_decode(self, enc_latent_array, seed_string):
+        # Runs on an inference worker thread, must not touch any widget
+        latent_array = decrypt_latent(enc_latent_array, seed_string)
+        decoded_image = decode_latent_to_image(latent_array)
 
-            # decrypt latent tensor
-            latent_array = decrypt_latent(self.message['enc_latent_array'], seed_string)
-            decoded_image = decode_latent_to_image(latent_array)
-            
-            self.latent_image_label.update_image(decoded_image)
-            self.latent_image_label.pack(pady=(20, 10))
-
-            # update image size
-            buffer = io.BytesIO()
-            decoded_image.save(buffer, format="PNG")
-            size_kb = len(buffer.getvalue()) / 1024  # size in KB
-            self.size_label.configure(text=f"Size: {size_kb:.0f} KB")
+        buffer = io.BytesIO()
+        decoded_image.save(buffer, format="PNG")
+        return decoded_image, len(buffer.getvalue())
+
+    def _on_decrypted(self, future):
+        if future is not self._decrypt_future:
+            return
+        self._decrypt_future = None
+        self.decrypt_button.stop_progress("Decrypt")
+        self.decrypt_button.configure(state='normal')
+
+        try:
+            decoded_image, size_bytes = future.result()
         except Exception as e:
             Toast(self, f"Authentication failed: {str(e)}", type="error", duration=2000)
             return
 
+        self.latent_image_label.update_image(decoded_image)
+        self.latent_image_label.pack(pady=(20, 10))
+
+        # update image size
+        size_kb = size_bytes / 1024  # size in KB
+        self.size_label.configure(text=f"Size: {size_kb:.0f} KB")
+
     def save_image(self):
         try:
             file_path = fd.asksaveasfilename(
@@ -84,9 +111,24 @@ class DecryptImage(ctk.CTkFrame):
                 filetypes=[("NumPy Array", "*.npy"), ("All Files", "*.*")],
                 title="Save Array As"
             )
-            if file_path:
-                latent_array = encode_image_to_latent(self.latent_image_label.image)
-                enc_latent_array = encrypt_latent(latent_array, MAC_ADDRESS)
-                np.save(file_path, enc_latent_array)
+        except Exception as e:
+            Toast(self, f"Error saving image: {str(e)}", type="error", duration=2000)
+            return
+
+        if file_path:
+            self.save_button.start_progress("Saving")
+            future = InferenceExecutor().submit(self._encode_and_save, self.latent_image_label.image, file_path)
+            on_future_done(self, future, self._on_saved)
+
+    def _encode_and_save(self, image, file_path):
+        # Runs on an inference worker thread, must not touch any widget
+        latent_array = encode_image_to_latent(image)
+        enc_latent_array = encrypt_latent(latent_array, MAC_ADDRESS)
+        np.save(file_path, enc_latent_array)
+
+    def _on_saved(self, future):
+        self.save_button.stop_progress("Save Image")
+        try:
+            future.result()
         except Exception as e:
             Toast(self, f"Error saving image: {str(e)}", type="error", duration=2000)
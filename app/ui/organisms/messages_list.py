@@ -1,4 +1,9 @@
+import sys
+import queue
+import tkinter
 import customtkinter as ctk
+from bisect import bisect_right
+from collections import defaultdict
 from PIL import Image
 from states.friends_store import FriendsStore
 from states.user_store import UserStore
@@ -6,33 +11,55 @@ from ui.atoms.profile import Profile
 from ui.atoms.modal import Modal
 from ui.atoms.image_frame import ImageFrame
 from utils.image import latent_to_gray_image
+from utils.image_cache import get_decoded_image, peek_decoded_image
+from utils.inference_executor import InferenceExecutor, on_future_done
 from utils.core.onnx_encoding import decode_latent_to_image
 from utils.core.onnx_encryption import decrypt_latent
 from ui.organisms.decrypt_image import DecryptImage
+from controllers.friend_controller import FriendController
+
+OVERSCAN_PX = 300 # rows this far outside the viewport are still materialized
+ROW_PADDING = 2
+ESTIMATED_HEIGHTS = {"text": 34, "image": 132, "empty": 4}
+ESTIMATED_PROFILE_HEIGHT = 40
+DECODE_RETRY_MS = 250 # a visible row whose decode found the queue full asks again after this long
+
+def _decrypt_and_decode(enc_latent_array, seed_string) -> Image.Image:
+    latent_array = decrypt_latent(enc_latent_array, seed_string)
+    return decode_latent_to_image(latent_array)
+
+def _content_kind(message) -> str:
+    if message.get('enc_latent_array') is not None or message.get('enc_latent_path'):
+        return "image"
+    elif 'text' in message and message['text']:
+        return "text"
+    return "empty"
+
 
 class FriendMessage(ctk.CTkFrame):
-    def __init__(self, master, message, friend_id: str, profile_image: Image.Image | None, show_profile: bool):
+    def __init__(self, master, kind: str, show_profile: bool):
         super().__init__(master, fg_color="transparent")
         self.columnconfigure(1, weight=1)
-        self.message = message
+        self.kind = kind
+        self.show_profile = show_profile
+        self.message = None
 
         # Show profile image and name
         if show_profile:
-            img_label = Profile(self, image=profile_image, size=60)
-            img_label.grid(row=0, column=0, rowspan=2, padx=(5, 10), pady=5, sticky="nw")
+            self.img_label = Profile(self, image=None, size=60)
+            self.img_label.grid(row=0, column=0, rowspan=2, padx=(5, 10), pady=5, sticky="nw")
 
-            name_label = ctk.CTkLabel(self, text=friend_id, font=ctk.CTkFont(weight="bold"), text_color="black")
-            name_label.grid(row=0, column=1, sticky="nw", padx=(2, 0), pady=(7, 0))
+            self.name_label = ctk.CTkLabel(self, text="", font=ctk.CTkFont(weight="bold"), text_color="black")
+            self.name_label.grid(row=0, column=1, sticky="nw", padx=(2, 0), pady=(7, 0))
 
         # Show message content
         message_frame = ctk.CTkFrame(self, fg_color="transparent")
         message_frame.grid(row=1 if show_profile else 0, column=1, sticky="w", padx=(0, 2) if show_profile else (74, 2), pady=(5, 0))
 
-        if 'enc_latent_array' in message and message['enc_latent_array'] is not None:
-            latent_image = latent_to_gray_image(message["enc_latent_array"])
+        if kind == "image":
             self.latent_image_frame = ImageFrame(
                 master=message_frame,
-                image=latent_image,
+                image=None,
                 width=128,
                 height=128,
                 border_radius=5
@@ -40,41 +67,57 @@ class FriendMessage(ctk.CTkFrame):
             self.latent_image_frame.pack(anchor="w", padx=0, pady=0)
             self.latent_image_frame.bind("<Button-1>", self._on_click_image)
 
-        elif 'text' in message and message['text']:
-            msg_label = ctk.CTkLabel(
+        elif kind == "text":
+            self.msg_label = ctk.CTkLabel(
                 message_frame,
-                text=message["text"],
+                text="",
                 font=ctk.CTkFont(size=15),
                 text_color="black",
                 fg_color="white",
                 corner_radius=6,
                 height=30
             )
-            msg_label.pack(anchor="w", padx=0, pady=0)
+            self.msg_label.pack(anchor="w", padx=0, pady=0)
+
+    def set_message(self, message, friend_id: str, profile_image: Image.Image | None):
+        self.message = message
+
+        if self.show_profile:
+            self.img_label.update_image(profile_image)
+            self.name_label.configure(text=friend_id)
+
+        if self.kind == "image":
+            # The latent is read from disk and previewed only once the row is shown
+            enc_latent_array = FriendController().get_latent_array(message)
+            self.latent_image_frame.update_image(latent_to_gray_image(enc_latent_array) if enc_latent_array is not None else None)
+        elif self.kind == "text":
+            self.msg_label.configure(text=message["text"])
 
     def _on_click_image(self, event):
         Modal(self, lambda *args, **kwargs: DecryptImage(*args, message=self.message, **kwargs))
 
 
 class MyMessage(ctk.CTkFrame):
-    def __init__(self, master, message):
+    def __init__(self, master, kind: str):
         super().__init__(master, fg_color="transparent")
-        if 'enc_latent_array' in message and message['enc_latent_array'] is not None:
-            latent_array = decrypt_latent(message["enc_latent_array"], message["seed_string"])
-            latent_image = decode_latent_to_image(latent_array)
+        self.kind = kind
+        self.message = None
+        self._decode_future = None
+
+        if kind == "image":
             self.latent_image_frame = ImageFrame(
                 master=self,
-                image=latent_image,
+                image=None,
                 width=128,
                 height=128,
                 border_radius=5
             )
             self.latent_image_frame.pack(anchor="e", padx=0, pady=0)
-            
-        elif 'text' in message and message['text']:
-            msg_label = ctk.CTkLabel(
+
+        elif kind == "text":
+            self.msg_label = ctk.CTkLabel(
                 self,
-                text=message["text"],
+                text="",
                 font=ctk.CTkFont(size=15),
                 text_color="white",
                 fg_color="#3366cc",
@@ -86,69 +129,119 @@ class MyMessage(ctk.CTkFrame):
                 padx=10,
                 pady=6
             )
-            msg_label.pack(anchor="e", padx=0, pady=0)
+            self.msg_label.pack(anchor="e", padx=0, pady=0)
+
+    def set_message(self, message):
+        self.message = message
+
+        if self._decode_future:
+            self._decode_future.cancel()
+            self._decode_future = None
+
+        if self.kind == "image":
+            enc_latent_array, seed_string = FriendController().get_latent_array(message), message["seed_string"]
+            if enc_latent_array is None:
+                self.latent_image_frame.update_image(None)
+                return
+            latent_image = peek_decoded_image(enc_latent_array, seed_string)
+            if latent_image is not None:
+                self.latent_image_frame.update_image(latent_image)
+                return
+
+            # Show a placeholder and decode in the background
+            self.latent_image_frame.update_image(None)
+            self._decode_future = InferenceExecutor().submit_background(get_decoded_image, enc_latent_array, seed_string, _decrypt_and_decode)
+            on_future_done(self, self._decode_future, self._on_image_decoded)
+        elif self.kind == "text":
+            self.msg_label.configure(text=message["text"])
 
+    def release(self):
+        # The row scrolled out of view, its queued decode is dropped to make room for visible rows
+        if self._decode_future:
+            self._decode_future.cancel()
+            self._decode_future = None
+        self.message = None
 
-class MessagesList(ctk.CTkScrollableFrame):
+    def _on_image_decoded(self, future):
+        # The row was recycled for another message in the meantime
+        if future is not self._decode_future:
+            return
+        self._decode_future = None
+        try:
+            self.latent_image_frame.update_image(future.result())
+        except queue.Full:
+            message = self.message
+            self.after(DECODE_RETRY_MS, lambda: self.message is message and self.set_message(message))
+        except Exception as e:
+            print(f"[MessagesList] Failed to decode image: {e}")
+
+
+class MessagesList(ctk.CTkFrame):
+    """
+    Windowed list of chat messages.
+
+    Only rows that intersect the viewport (plus OVERSCAN_PX) exist as widgets.
+    Rows that scroll out of view go back to a per-kind pool and are reused,
+    and row heights are estimated until a row has been measured once.
+    """
     def __init__(self, master):
         super().__init__(master, fg_color="transparent", corner_radius=0)
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
 
-        userStore = UserStore()
-        friendStore = FriendsStore()
-        self.selected_friend = friendStore.selected_friend
-
-        self.rendered_count = 0
-
-        prev_sender = None 
-        if self.selected_friend:
-            for message in friendStore.selected_friend.messages_list:
-                sender = message["sender_id"]
-                show_profile = sender != userStore.user_id and sender != prev_sender
-
-                if sender == userStore.user_id:
-                    item = MyMessage(self, message)
-                else:
-                    item = FriendMessage(
-                        self,
-                        message,
-                        self.selected_friend.friend_id,
-                        self.selected_friend.profile_image,
-                        show_profile
-                    )
-                item.pack(fill="x", anchor="w", pady=2, padx=5)
-                prev_sender = sender
-                self.rendered_count += 1
+        self._canvas = tkinter.Canvas(self, highlightthickness=0, bd=0, bg=self._apply_appearance_mode(self._bg_color))
+        self._canvas.grid(row=0, column=0, sticky="nsew")
+        self._scrollbar = ctk.CTkScrollbar(self, command=self._canvas.yview)
+        self._scrollbar.grid(row=0, column=1, sticky="ns")
+        self._canvas.configure(yscrollcommand=self._on_yview_change)
+        if sys.platform.startswith("win"):
+            self._canvas.configure(yscrollincrement=1)
+        elif sys.platform == "darwin":
+            self._canvas.configure(yscrollincrement=8)
+        else:
+            self._canvas.configure(yscrollincrement=30)
 
+        self._canvas.bind("<Configure>", self._on_canvas_configure)
+        self._canvas.bind_all("<MouseWheel>", self._on_mouse_wheel, add="+")
+        self._canvas.bind_all("<Button-4>", self._on_mouse_wheel, add="+")
+        self._canvas.bind_all("<Button-5>", self._on_mouse_wheel, add="+")
+
+        self._messages = []
+        self._rows = []       # (is_mine, kind, show_profile) per message, also the pool key
+        self._heights = []    # measured or estimated height per message
+        self._measured = []
+        self._offsets = [0]   # top y of every row, followed by the total height
+        self._visible = {}    # message index -> (widget, canvas item id)
+        self._pool = defaultdict(list)
+        self._render_pending = False
+        self._loading_older = False
+
+        self.selected_friend = None
         FriendsStore().add_observer("selected_friend", self._on_selected_friend_change)
+        self._on_selected_friend_change()
 
     def _on_messages_list_change(self):
         if not self.selected_friend:
             return
 
         messages = self.selected_friend.messages_list
-        new_messages = messages[self.rendered_count:]
-
-        prev_sender = messages[self.rendered_count - 1]["sender_id"] if self.rendered_count > 0 else None
-        for message in new_messages:
-            sender = message["sender_id"]
-            show_profile = sender != UserStore().user_id and sender != prev_sender
-
-            if sender == UserStore().user_id:
-                item = MyMessage(self, message)
-            else:
-                item = FriendMessage(
-                    self,
-                    message,
-                    self.selected_friend.friend_id,
-                    self.selected_friend.profile_image,
-                    show_profile
-                )
-            item.pack(fill="x", anchor="w", pady=1, padx=5)
-            prev_sender = sender
-            self.rendered_count += 1
+        old_count = len(self._messages)
+        if old_count and len(messages) > old_count and messages[-1] is self._messages[-1] and messages[-old_count] is self._messages[0]:
+            # Older history was prepended, keep the rows on screen where they are
+            view_top = self._canvas.canvasy(0)
+            self._reset_rows(messages)
+            added_height = self._offsets[len(messages) - old_count]
+            self._canvas.yview_moveto((view_top + added_height) / max(self._offsets[-1], 1))
+            return
+        elif old_count and len(messages) >= old_count and messages[old_count - 1] is self._messages[-1]:
+            # Appended messages only need new rows
+            self._messages = list(messages)
+            self._append_rows(old_count)
+        else:
+            self._reset_rows(messages)
 
         # Scroll to the bottom
-        self.after(0, lambda: self._parent_canvas.yview_moveto(1.0))
+        self._scroll_to_bottom()
 
     def _on_selected_friend_change(self):
         new_friend = FriendsStore().selected_friend
@@ -161,8 +254,169 @@ class MessagesList(ctk.CTkScrollableFrame):
                 new_friend.add_observer("messages_list", self._on_messages_list_change)
             self.selected_friend = new_friend
 
-        # Update messages
-        for widget in self.winfo_children():
-            widget.destroy()
-        self.rendered_count = 0 
-        self._on_messages_list_change()
+        # Update messages, widgets are recycled instead of destroyed
+        self._reset_rows(new_friend.messages_list if new_friend else [])
+        self._scroll_to_bottom()
+
+    def _reset_rows(self, messages):
+        for index in list(self._visible):
+            self._release(index)
+        self._messages = list(messages)
+        self._rows, self._heights, self._measured = [], [], []
+        self._offsets = [0]
+        self._append_rows(0)
+
+    def _append_rows(self, start):
+        my_id = UserStore().user_id
+        prev_sender = self._messages[start - 1]["sender_id"] if start > 0 else None
+        for message in self._messages[start:]:
+            sender = message["sender_id"]
+            is_mine = sender == my_id
+            show_profile = not is_mine and sender != prev_sender
+            kind = _content_kind(message)
+
+            height = ESTIMATED_HEIGHTS[kind] + (ESTIMATED_PROFILE_HEIGHT if show_profile else 0) + 2 * ROW_PADDING
+            self._rows.append((is_mine, kind, show_profile))
+            self._heights.append(height)
+            self._measured.append(False)
+            self._offsets.append(self._offsets[-1] + height)
+            prev_sender = sender
+
+        self._update_scrollregion()
+        self._schedule_render()
+
+    def _recompute_offsets(self, start):
+        for index in range(start, len(self._heights)):
+            self._offsets[index + 1] = self._offsets[index] + self._heights[index]
+
+    def _update_scrollregion(self):
+        height = max(self._offsets[-1], self._canvas.winfo_height())
+        self._canvas.configure(scrollregion=(0, 0, self._canvas.winfo_width(), height))
+
+    def _schedule_render(self):
+        if not self._render_pending:
+            self._render_pending = True
+            self.after_idle(self._render)
+
+    def _render(self):
+        self._render_pending = False
+        if not self.winfo_exists():
+            return
+
+        view_top = self._canvas.canvasy(0)
+        first = max(bisect_right(self._offsets, view_top - OVERSCAN_PX) - 1, 0)
+        last = min(bisect_right(self._offsets, view_top + self._canvas.winfo_height() + OVERSCAN_PX), len(self._rows))
+
+        # Recycle rows that left the window
+        for index in [i for i in self._visible if i < first or i >= last]:
+            self._release(index)
+
+        # Materialize rows that entered it
+        created = [index for index in range(first, last) if index not in self._visible]
+        for index in created:
+            self._acquire(index)
+
+        # Measure new rows once and shift everything below them if the estimate was off
+        new_rows = [index for index in created if not self._measured[index]]
+        if not new_rows:
+            return
+        self._canvas.update_idletasks()
+
+        changed_from = None
+        for index in new_rows:
+            widget, _ = self._visible[index]
+            height = widget.winfo_reqheight() + 2 * ROW_PADDING
+            self._measured[index] = True
+            if height != self._heights[index]:
+                self._heights[index] = height
+                changed_from = index if changed_from is None else min(changed_from, index)
+        if changed_from is None:
+            return
+
+        # Keep the row at the top of the viewport in place while offsets move
+        at_bottom = self._canvas.yview()[1] >= 1.0
+        anchor = max(bisect_right(self._offsets, view_top) - 1, 0)
+        anchor_delta = view_top - self._offsets[anchor]
+
+        self._recompute_offsets(changed_from)
+        for index, (_, item) in self._visible.items():
+            self._canvas.coords(item, 5, self._offsets[index] + ROW_PADDING)
+        self._update_scrollregion()
+
+        if at_bottom:
+            self._canvas.yview_moveto(1.0)
+        elif anchor < len(self._rows):
+            total = max(self._offsets[-1], 1)
+            self._canvas.yview_moveto((self._offsets[anchor] + anchor_delta) / total)
+        self._schedule_render()
+
+    def _acquire(self, index):
+        is_mine, kind, show_profile = self._rows[index]
+        message = self._messages[index]
+
+        pool = self._pool[self._rows[index]]
+        if pool:
+            widget = pool.pop()
+        elif is_mine:
+            widget = MyMessage(self._canvas, kind)
+        else:
+            widget = FriendMessage(self._canvas, kind, show_profile)
+
+        if is_mine:
+            widget.set_message(message)
+        else:
+            widget.set_message(message, self.selected_friend.friend_id, self.selected_friend.profile_image)
+
+        item = self._canvas.create_window(5, self._offsets[index] + ROW_PADDING, window=widget, anchor="nw",
+                                          width=max(self._canvas.winfo_width() - 10, 1))
+        self._visible[index] = (widget, item)
+
+    def _release(self, index):
+        widget, item = self._visible.pop(index)
+        self._canvas.delete(item)
+        if isinstance(widget, MyMessage):
+            widget.release()
+        self._pool[self._rows[index]].append(widget)
+
+    def _scroll_to_bottom(self):
+        self.after(0, lambda: self._canvas.yview_moveto(1.0))
+
+    def _on_yview_change(self, first, last):
+        self._scrollbar.set(first, last)
+        self._schedule_render()
+
+        # Fetch the previous page of history once the top is reached
+        if float(first) <= 0.0 and float(last) < 1.0 and not self._loading_older \
+                and self.selected_friend and self.selected_friend.history_cursor is not None:
+            self._loading_older = True
+            self.after_idle(self._load_older_messages)
+
+    def _load_older_messages(self):
+        try:
+            if self.selected_friend:
+                FriendController().load_older_messages(self.selected_friend.friend_id)
+        finally:
+            self._loading_older = False
+
+    def _on_canvas_configure(self, event):
+        for _, item in self._visible.values():
+            self._canvas.itemconfigure(item, width=max(event.width - 10, 1))
+        self._update_scrollregion()
+        self._schedule_render()
+
+    def _on_mouse_wheel(self, event):
+        if not self._contains(event.widget):
+            return
+        if sys.platform.startswith("win"):
+            self._canvas.yview_scroll(-int(event.delta / 6), "units")
+        elif sys.platform == "darwin":
+            self._canvas.yview_scroll(-event.delta, "units")
+        else:
+            self._canvas.yview_scroll(-1 if event.num == 4 else 1, "units")
+
+    def _contains(self, widget):
+        while widget is not None:
+            if widget == self._canvas:
+                return True
+            widget = getattr(widget, "master", None)
+        return False
@@ -4,6 +4,7 @@ import tkinter.filedialog as fd
 from ui.atoms.button import Button
 from ui.atoms.image_frame import ImageFrame
 from utils.mac import get_mac_address
+from utils.inference_executor import InferenceExecutor, on_future_done
 from utils.core.onnx_encryption import decrypt_latent
 from utils.core.onnx_encoding import decode_latent_to_image
 
@@ -32,18 +33,45 @@ class ViewerPage(ctk.CTkFrame):
         self.file_button = Button(self.center_frame, type="white", text="Choose file", command=self.pick_file, width=100)
         self.file_button.pack(pady=(0, 20))
 
+        self._decode_future = None
+
     # when a file is selected
     def pick_file(self):
         path = fd.askopenfilename(
             filetypes=[("NumPy Array", "*.npy"), ("All Files", "*.*")],
         )
         
+        # A new pick supersedes any decoding that is still queued or running
+        if self._decode_future:
+            self._decode_future.cancel()
+            self._decode_future = None
+            self.file_button.stop_progress("Choose file")
+
         if path:
             self.selected_file = path
-            self.file_button.configure(text="File Selected")
+            self.file_button.start_progress("Decoding")
             
-            # Load and display the image
-            enc_latent_array = np.load(path)
-            latent_array = decrypt_latent(enc_latent_array, MAC_ADDRESS)
-            latent_image = decode_latent_to_image(latent_array)
-            self.image_frame.update_image(latent_image)
+            # Load and display the image in the background
+            self._decode_future = InferenceExecutor().submit(self._load_image, path)
+            on_future_done(self, self._decode_future, self._on_image_loaded)
+
+    def _load_image(self, path):
+        # Runs on an inference worker thread, must not touch any widget
+        enc_latent_array = np.load(path)
+        latent_array = decrypt_latent(enc_latent_array, MAC_ADDRESS)
+        return decode_latent_to_image(latent_array)
+
+    def _on_image_loaded(self, future):
+        if future is not self._decode_future:
+            return
+        self._decode_future = None
+
+        try:
+            latent_image = future.result()
+        except Exception:
+            self.file_button.stop_progress("Choose file")
+            self.image_frame.update_image(None)
+            return
+
+        self.file_button.stop_progress("File Selected")
+        self.image_frame.update_image(latent_image)
@@ -2,53 +2,167 @@ import os
 import hmac
 import hashlib
 import json
+import struct
+import threading
+from collections import OrderedDict
 from base64 import b64encode, b64decode
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from utils.key_pair_pool import KeyPairPool
+
+MAX_SKIP = 1000 # most message keys one message may skip ahead in a chain
+MAX_SKIPPED_KEYS = 2000 # skipped keys kept for late messages, the oldest are evicted first
+
+# version, send_count, recv_count and the lengths of root_key, dh_priv, dh_pub, dh_pub_remote,
+# send_chain_key and recv_chain_key, followed by the keys themselves
+_STATE_V1 = struct.Struct("<BII6H")
+# version 2 adds prev_send_count, the length of recv_dh_pub (after the other keys) and the number
+# of skipped message keys, each stored as (dh_pub length, msg_num, message key, dh_pub).
+# Version 3 has the same layout with raw X25519 keys, an empty key is one not known yet.
+# Version 4 appends the re-key of a legacy conversation: the length of a pending root key and the
+# key, then the length of the legacy ratchet's own state record and that record.
+_STATE = struct.Struct("<BIII7HI")
+_SKIPPED_KEY = struct.Struct("<HI32s")
+_REKEY_ROOT = struct.Struct("<H")
+_REKEY_LEGACY = struct.Struct("<I")
+_STATE_VERSION = 4
+
+ENVELOPE_TYPE = "dr-v1" # binary_type of a binary envelope in a socket frame
+# version, dh_pub length, pn, msg_num; then dh_pub, the 12 byte nonce and the AES-GCM ciphertext
+_ENVELOPE = struct.Struct("<BBII")
+_ENVELOPE_VERSION = 1
+_NONCE_SIZE = 12
+
+_HMAC_BLOCK_SIZE = 64
+_HMAC_IPAD = bytes(x ^ 0x36 for x in range(256))
+_HMAC_OPAD = bytes(x ^ 0x5c for x in range(256))
 
 class DoubleRatchet:
-    def __init__(self, root_key: bytes, dh_priv: bytes, dh_pub_remote: bytes):
+    """
+    X25519 double ratchet. Exactly one side of a conversation is the initiator. Both sides derive the
+    responder's first ratchet key pair from the shared root key, so the initiator can take the first
+    DH step right away and the responder can send before it has heard from the initiator.
+    After that, each side takes a DH step whenever a message brings a new key of the other side.
+    """
+    def __init__(self, root_key: bytes, initiator: bool, max_skip: int = MAX_SKIP):
         self.root_key = root_key
-        self.dh_priv = dh_priv
-        self.dh_pub = self._derive_pub(dh_priv)
-        self.dh_pub_remote = dh_pub_remote
+        responder_priv = X25519PrivateKey.from_private_bytes(self._derive(root_key, b"responder-ratchet-key"))
+        responder_pair = (responder_priv.private_bytes_raw(), responder_priv.public_key().public_bytes_raw())
+        # Responder messages sent before the first DH step use a chain of the root key alone
+        responder_chain_key = self._derive(root_key, b"responder-chain")
 
-        self.send_chain_key = root_key
-        self.recv_chain_key = root_key
         self.send_count = 0
         self.recv_count = 0
+        self.prev_send_count = 0
+        if initiator:
+            self.dh_pub_remote = self.recv_dh_pub = responder_pair[1]
+            self.recv_chain_key = responder_chain_key
+            self.dh_priv, self.dh_pub = KeyPairPool().take()
+            self.root_key, self.send_chain_key = self._kdf_root(self.root_key, self._dh(self.dh_priv, self.dh_pub_remote))
+        else:
+            self.dh_priv, self.dh_pub = responder_pair
+            self.send_chain_key = responder_chain_key
+            # dh_pub of the chain being received, None until the initiator's first message
+            self.dh_pub_remote = self.recv_dh_pub = None
+            self.recv_chain_key = None
+
+        self.max_skip = max_skip
+        self.skipped = OrderedDict() # (dh_pub, msg_num) -> message key
+        self.pending_root_key = None # root key of a re-key sent to the friend, until it is acked
+        self.legacy = None # legacy ratchet of a re-keyed conversation, for messages sent before the friend switched
+        self._lock = threading.Lock() # messages may be decrypted from several connections at once
 
-    def _derive_pub(self, priv: bytes) -> bytes:
-        if not isinstance(priv, bytes):
-            raise TypeError("Private key must be bytes")
-        return hashlib.sha256(priv).digest()
+    @staticmethod
+    def rekeyed(legacy, root_key: bytes):
+        """
+        Responder ratchet from a re-key of the legacy conversation `legacy`. Messages the friend
+        sent on the legacy chain before it switched too still decrypt, until its first new one arrives.
+        """
+        obj = DoubleRatchet(root_key, initiator=False, max_skip=legacy.max_skip)
+        obj.legacy = legacy.legacy or legacy
+        return obj
+
+    @property
+    def is_legacy(self) -> bool:
+        # Conversations from before the X25519 ratchet have hash-derived keys and share one chain
+        # without ever taking a DH step, a re-key moves them to this ratchet
+        if not isinstance(self.dh_priv, bytes) or len(self.dh_priv) != 32:
+            return True
+        return self.dh_pub != X25519PrivateKey.from_private_bytes(self.dh_priv).public_key().public_bytes_raw()
+
+    def _derive(self, key: bytes, label: bytes) -> bytes:
+        return hmac.digest(key, label, "sha256")
 
     def _dh(self, priv: bytes, pub: bytes) -> bytes:
         if not isinstance(priv, bytes) or not isinstance(pub, bytes):
             raise TypeError("DH inputs must be bytes")
-        return hashlib.sha256(priv + pub).digest()
+        return X25519PrivateKey.from_private_bytes(priv).exchange(X25519PublicKey.from_public_bytes(pub))
+
+    def _kdf_root(self, root_key: bytes, shared_secret: bytes) -> tuple:
+        # New root key and chain key from the root key and a DH output
+        output = HKDF(algorithm=hashes.SHA256(), length=64, salt=root_key, info=b"DoubleRatchet").derive(shared_secret)
+        return output[:32], output[32:]
 
     def _kdf_chain(self, chain_key: bytes) -> tuple:
-        new_chain_key = hmac.new(chain_key, b"chain", hashlib.sha256).digest()
-        msg_key = hmac.new(chain_key, b"msg", hashlib.sha256).digest()[:32]
-        return new_chain_key, msg_key
-
-    def _ratchet(self):
-        self.dh_priv = os.urandom(32)
-        self.dh_pub = self._derive_pub(self.dh_priv)
-        shared_secret = self._dh(self.dh_priv, self.dh_pub_remote)
-        self.root_key = hashlib.sha256(self.root_key + shared_secret).digest()
-        self.send_chain_key = self.root_key
+        # HMAC-SHA256 of b"chain" and b"msg" under chain_key. The padded key is hashed once and
+        # the two digests continue from copies, half the work of two separate HMACs.
+        if len(chain_key) > _HMAC_BLOCK_SIZE:
+            chain_key = hashlib.sha256(chain_key).digest()
+        chain_key = chain_key.ljust(_HMAC_BLOCK_SIZE, b"\0")
+        inner_chain = hashlib.sha256(chain_key.translate(_HMAC_IPAD))
+        outer_chain = hashlib.sha256(chain_key.translate(_HMAC_OPAD))
+        inner_msg, outer_msg = inner_chain.copy(), outer_chain.copy()
+        inner_chain.update(b"chain")
+        inner_msg.update(b"msg")
+        outer_chain.update(inner_chain.digest())
+        outer_msg.update(inner_msg.digest())
+        return outer_chain.digest(), outer_msg.digest()[:32]
+
+    def _ratchet(self, dh_pub_remote: bytes):
+        # Receiving chain of the new remote key, then a new sending chain with a pooled key pair,
+        # so neither the send nor the receive path waits for a key generation
+        self.dh_pub_remote = self.recv_dh_pub = dh_pub_remote
+        self.root_key, self.recv_chain_key = self._kdf_root(self.root_key, self._dh(self.dh_priv, dh_pub_remote))
+        self.recv_count = 0
+
+        self.dh_priv, self.dh_pub = KeyPairPool().take()
+        self.root_key, self.send_chain_key = self._kdf_root(self.root_key, self._dh(self.dh_priv, dh_pub_remote))
+        self.prev_send_count = self.send_count
         self.send_count = 0
 
-    def encrypt(self, plaintext: bytes) -> dict:
-        if self.send_count > 0 and self.send_count % 100 == 0:
-            self._ratchet()
+    def _ratchet_state(self) -> tuple:
+        return (self.root_key, self.dh_priv, self.dh_pub, self.dh_pub_remote, self.recv_dh_pub, self.send_chain_key,
+                self.recv_chain_key, self.send_count, self.recv_count, self.prev_send_count)
+
+    def _restore_ratchet_state(self, state: tuple):
+        (self.root_key, self.dh_priv, self.dh_pub, self.dh_pub_remote, self.recv_dh_pub, self.send_chain_key,
+         self.recv_chain_key, self.send_count, self.recv_count, self.prev_send_count) = state
+
+    def _skip_message_keys(self, until: int, skipped: dict):
+        # Keys of messages not received yet are kept, so they still decrypt when they arrive late
+        if until - self.recv_count > self.max_skip:
+            raise ValueError(f"Too many skipped messages: {until - self.recv_count}")
+        while self.recv_count < until:
+            self.recv_chain_key, msg_key = self._kdf_chain(self.recv_chain_key)
+            self.recv_count += 1
+            skipped[(self.recv_dh_pub, self.recv_count)] = msg_key
 
+    def _encrypt_locked(self, plaintext: bytes, nonce: bytes) -> tuple:
         self.send_chain_key, msg_key = self._kdf_chain(self.send_chain_key)
-        nonce = os.urandom(12)
         aesgcm = AESGCM(msg_key)
         ciphertext = aesgcm.encrypt(nonce, plaintext, None)
         self.send_count += 1
+        return self.dh_pub, self.prev_send_count, self.send_count, nonce, ciphertext
+
+    def _encrypt(self, plaintext: bytes) -> tuple:
+        with self._lock:
+            return self._encrypt_locked(plaintext, os.urandom(_NONCE_SIZE))
+
+    def encrypt(self, plaintext: bytes) -> dict:
+        """JSON message with base64 fields, for peers that do not take the dr-v1 envelope."""
+        dh_pub, pn, msg_num, nonce, ciphertext = self._encrypt(plaintext)
 
         def encode(b): return b64encode(b).decode()
 
@@ -56,66 +170,196 @@ class DoubleRatchet:
             "ciphertext": encode(ciphertext),
             "nonce": encode(nonce),
             "header": {
-                "dh_pub": encode(self.dh_pub),
-                "msg_num": self.send_count
+                "dh_pub": encode(dh_pub),
+                "pn": pn,
+                "msg_num": msg_num
             }
         })
 
+    def encrypt_bytes(self, plaintext: bytes) -> bytes:
+        """Binary dr-v1 envelope, sent as the binary section of a frame."""
+        return self._pack_envelope(*self._encrypt(plaintext))
+
+    def encrypt_many(self, plaintexts: list) -> list:
+        """
+        dr-v1 envelopes of several messages, in order. The chain is walked once under one lock
+        and the nonces come from a single urandom call.
+        """
+        nonces = os.urandom(_NONCE_SIZE * len(plaintexts))
+        with self._lock:
+            return [self._pack_envelope(*self._encrypt_locked(plaintext, nonces[i * _NONCE_SIZE:(i + 1) * _NONCE_SIZE]))
+                    for i, plaintext in enumerate(plaintexts)]
+
+    def _pack_envelope(self, dh_pub: bytes, pn: int, msg_num: int, nonce: bytes, ciphertext: bytes) -> bytes:
+        return b"".join((_ENVELOPE.pack(_ENVELOPE_VERSION, len(dh_pub), pn, msg_num), dh_pub, nonce, ciphertext))
+
 
     def decrypt(self, json_str: dict) -> bytes:
         def decode(s): return b64decode(s.encode())
 
         message = json.loads(json_str)
+        header = message["header"]
+        return self._decrypt(decode(header["dh_pub"]), header.get("pn", 0), header["msg_num"],
+                             decode(message["nonce"]), decode(message["ciphertext"]))
 
-        if message["header"]["msg_num"] > 0 and message["header"]["msg_num"] % 20 == 0:
-            self.dh_pub_remote = decode(message["header"]["dh_pub"])
-            shared_secret = self._dh(self.dh_priv, self.dh_pub_remote)
-            self.root_key = hashlib.sha256(self.root_key + shared_secret).digest()
-            self.recv_chain_key = self.root_key
-            self.recv_count = 0
+    def decrypt_bytes(self, envelope: bytes) -> bytes:
+        return self._decrypt(*self._unpack_envelope(envelope))
 
-        self.recv_chain_key, msg_key = self._kdf_chain(self.recv_chain_key)
-        aesgcm = AESGCM(msg_key)
-        plaintext = aesgcm.decrypt(
-            decode(message["nonce"]),
-            decode(message["ciphertext"]),
-            None
-        )
-        self.recv_count += 1
+    def decrypt_many(self, envelopes: list) -> list:
+        """
+        Plaintexts of several dr-v1 envelopes, under one lock. All or nothing: when one of them
+        raises, the ratchet is left as before the batch, so the whole batch can be retried.
+        """
+        with self._lock:
+            state, skipped, legacy = self._ratchet_state(), self.skipped.copy(), self.legacy
+            legacy_state = legacy.to_bytes() if legacy is not None else None
+            try:
+                return [self._decrypt_locked(*self._unpack_envelope(envelope)) for envelope in envelopes]
+            except Exception:
+                self._restore_ratchet_state(state)
+                self.skipped = skipped
+                self.legacy = DoubleRatchet.from_bytes(legacy_state, self.max_skip) if legacy is not None else None
+                raise
+
+    def _unpack_envelope(self, envelope: bytes) -> tuple:
+        view = memoryview(envelope)
+        version, dh_pub_len, pn, msg_num = _ENVELOPE.unpack_from(view, 0)
+        if version != _ENVELOPE_VERSION:
+            raise ValueError(f"Unsupported envelope version: {version}")
+        offset = _ENVELOPE.size
+        dh_pub = bytes(view[offset:offset + dh_pub_len])
+        offset += dh_pub_len
+        nonce = bytes(view[offset:offset + _NONCE_SIZE])
+        return dh_pub, pn, msg_num, nonce, view[offset + _NONCE_SIZE:]
+
+    def _decrypt(self, dh_pub: bytes, pn: int, msg_num: int, nonce: bytes, ciphertext: bytes) -> bytes:
+        with self._lock:
+            return self._decrypt_locked(dh_pub, pn, msg_num, nonce, ciphertext)
+
+    def _decrypt_locked(self, dh_pub: bytes, pn: int, msg_num: int, nonce: bytes, ciphertext: bytes) -> bytes:
+        if self.legacy is None:
+            return self._decrypt_current(dh_pub, pn, msg_num, nonce, ciphertext)
+        try:
+            plaintext = self._decrypt_current(dh_pub, pn, msg_num, nonce, ciphertext)
+        except Exception:
+            # Sent before the friend had the re-key ack, still on the legacy chain
+            with self.legacy._lock:
+                return self.legacy._decrypt_locked(dh_pub, pn, msg_num, nonce, ciphertext)
+        # The friend switched, it sends nothing on the legacy chain any more
+        self.legacy = None
         return plaintext
 
+    def _decrypt_current(self, dh_pub: bytes, pn: int, msg_num: int, nonce: bytes, ciphertext: bytes) -> bytes:
+        # A message that arrived after later ones of its chain
+        msg_key = self.skipped.pop((dh_pub, msg_num), None)
+        if msg_key is not None:
+            try:
+                return AESGCM(msg_key).decrypt(nonce, ciphertext, None)
+            except Exception:
+                self.skipped[(dh_pub, msg_num)] = msg_key
+                raise
 
-    def to_json(self) -> str:
-        def encode(b):
-            if isinstance(b, str):
-                b = b.encode()
-            return b64encode(b).decode()
+        # Ratchet state is only kept when the message authenticates
+        state = self._ratchet_state()
+        skipped = {}
+        try:
+            if self.recv_dh_pub is None and self.recv_chain_key is not None:
+                # Conversations from before the X25519 ratchet share one chain, they never take a DH step
+                self.recv_dh_pub = dh_pub
+            elif dh_pub != self.recv_dh_pub:
+                # The sender ratcheted, the rest of the old chain (pn messages) is skipped first
+                if self.recv_chain_key is not None:
+                    self._skip_message_keys(pn, skipped)
+                self._ratchet(dh_pub)
+            if msg_num <= self.recv_count:
+                raise ValueError(f"Message key {msg_num} was already used or evicted")
+            self._skip_message_keys(msg_num - 1, skipped)
 
-        return json.dumps({
-            "root_key": encode(self.root_key),
-            "dh_priv": encode(self.dh_priv),
-            "dh_pub": encode(self.dh_pub),
-            "dh_pub_remote": encode(self.dh_pub_remote),
-            "send_chain_key": encode(self.send_chain_key),
-            "recv_chain_key": encode(self.recv_chain_key),
-            "send_count": self.send_count,
-            "recv_count": self.recv_count
-        })
+            self.recv_chain_key, msg_key = self._kdf_chain(self.recv_chain_key)
+            self.recv_count += 1
+            plaintext = AESGCM(msg_key).decrypt(nonce, ciphertext, None)
+        except Exception:
+            self._restore_ratchet_state(state)
+            raise
+
+        self.skipped.update(skipped)
+        while len(self.skipped) > MAX_SKIPPED_KEYS:
+            self.skipped.popitem(last=False)
+        return plaintext
+
+
+    def to_bytes(self) -> bytes:
+        """Compact binary state record, what is persisted after every message."""
+        with self._lock:
+            keys = [key.encode() if isinstance(key, str) else key or b"" for key in
+                    (self.root_key, self.dh_priv, self.dh_pub, self.dh_pub_remote, self.send_chain_key, self.recv_chain_key,
+                     self.recv_dh_pub)]
+            header = _STATE.pack(_STATE_VERSION, self.send_count, self.recv_count, self.prev_send_count,
+                                 *(len(key) for key in keys), len(self.skipped))
+            skipped = [part for (dh_pub, msg_num), msg_key in self.skipped.items()
+                       for part in (_SKIPPED_KEY.pack(len(dh_pub), msg_num, msg_key), dh_pub)]
+            pending_root_key = self.pending_root_key or b""
+            legacy = self.legacy.to_bytes() if self.legacy is not None else b""
+            return b"".join((header, *keys, *skipped, _REKEY_ROOT.pack(len(pending_root_key)), pending_root_key,
+                             _REKEY_LEGACY.pack(len(legacy)), legacy))
+
+    @staticmethod
+    def from_bytes(state: bytes, max_skip: int = MAX_SKIP):
+        version = state[0]
+        if version == 1:
+            _, send_count, recv_count, *lengths = _STATE_V1.unpack_from(state, 0)
+            prev_send_count, num_skipped = 0, 0
+            offset = _STATE_V1.size
+        elif version in (2, 3, _STATE_VERSION):
+            _, send_count, recv_count, prev_send_count, *lengths, num_skipped = _STATE.unpack_from(state, 0)
+            offset = _STATE.size
+        else:
+            raise ValueError(f"Unsupported ratchet state version: {version}")
+
+        keys = []
+        for length in lengths:
+            keys.append(bytes(state[offset:offset + length]) or None)
+            offset += length
+        root_key, dh_priv, dh_pub, dh_pub_remote, send_chain_key, recv_chain_key, *recv_dh_pub = keys
+
+        obj = DoubleRatchet._restore((root_key, dh_priv, dh_pub, dh_pub_remote, recv_dh_pub[0] if recv_dh_pub else None,
+                                      send_chain_key, recv_chain_key, send_count, recv_count, prev_send_count), max_skip)
+        for _ in range(num_skipped):
+            dh_pub_len, msg_num, msg_key = _SKIPPED_KEY.unpack_from(state, offset)
+            offset += _SKIPPED_KEY.size
+            obj.skipped[(bytes(state[offset:offset + dh_pub_len]), msg_num)] = msg_key
+            offset += dh_pub_len
+        if version == _STATE_VERSION:
+            length, = _REKEY_ROOT.unpack_from(state, offset)
+            offset += _REKEY_ROOT.size
+            obj.pending_root_key = bytes(state[offset:offset + length]) or None
+            offset += length
+            length, = _REKEY_LEGACY.unpack_from(state, offset)
+            offset += _REKEY_LEGACY.size
+            if length:
+                obj.legacy = DoubleRatchet.from_bytes(state[offset:offset + length], max_skip)
+        return obj
+
+    @staticmethod
+    def _restore(state: tuple, max_skip: int = MAX_SKIP):
+        # A stored ratchet, without deriving the initial keys again
+        obj = DoubleRatchet.__new__(DoubleRatchet)
+        obj._restore_ratchet_state(state)
+        obj.max_skip = max_skip
+        obj.skipped = OrderedDict()
+        obj.pending_root_key = None
+        obj.legacy = None
+        obj._lock = threading.Lock()
+        return obj
 
     @staticmethod
     def from_json(json_str: str):
+        """Ratchet of the JSON double_ratchet_info of older versions, it is only ever stored with to_bytes."""
         def decode(s):
-            return b64decode(s.encode())
+            return b64decode(s.encode()) if s is not None else None
 
         data = json.loads(json_str)
-        obj = DoubleRatchet(
-            root_key=decode(data["root_key"]),
-            dh_priv=decode(data["dh_priv"]),
-            dh_pub_remote=decode(data["dh_pub_remote"])
-        )
-        obj.dh_pub = decode(data["dh_pub"])
-        obj.send_chain_key = decode(data["send_chain_key"])
-        obj.recv_chain_key = decode(data["recv_chain_key"])
-        obj.send_count = data["send_count"]
-        obj.recv_count = data["recv_count"]
-        return obj
\ No newline at end of file
+        return DoubleRatchet._restore((
+            decode(data["root_key"]), decode(data["dh_priv"]), decode(data["dh_pub"]), decode(data["dh_pub_remote"]),
+            None, decode(data["send_chain_key"]), decode(data["recv_chain_key"]), data["send_count"], data["recv_count"], 0
+        ))
@@ -4,23 +4,40 @@ from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey, RSAPrivateKey
 
+def _round_seeds(key: str, num_rounds: int) -> list:
+    # Every round seed is derived up front from the same SHA-256 schedule
+    return [int(hashlib.sha256(f"{key}_{i}".encode()).hexdigest(), 16) % (2**32) for i in range(num_rounds)]
+
+def _apply_keystream(buffer: torch.Tensor, key: str, num_rounds: int, sign: int) -> torch.Tensor:
+    # Draw each round into one reusable scratch tensor with a single re-seeded
+    # generator and add/subtract it in place, in the original round order
+    seeds = _round_seeds(key, num_rounds)
+    if sign < 0:
+        seeds = seeds[::-1]
+
+    scratch = torch.empty(buffer.shape, device=buffer.device)
+    g = torch.Generator(device=buffer.device)
+    for seed in seeds:
+        g.manual_seed(seed)
+        torch.randn(buffer.shape, generator=g, out=scratch)
+        buffer.add_(scratch, alpha=sign)
+    return buffer
+
+def generate_keystream(key: str, shape: tuple, num_rounds: int = 8, device: str = "cpu", out: torch.Tensor | None = None) -> torch.Tensor:
+    """Sum of all round noises for `key`, accumulated into a (preallocated) float32 buffer."""
+    if out is None:
+        out = torch.zeros(shape, dtype=torch.float32, device=device)
+    else:
+        out.zero_()
+    return _apply_keystream(out, key, num_rounds, 1)
+
 def encrypt_latent(latent: torch.Tensor, key: str, num_rounds: int = 8) -> torch.Tensor:
     encrypted = latent.clone()
-    for i in range(num_rounds):
-        seed = int(hashlib.sha256(f"{key}_{i}".encode()).hexdigest(), 16) % (2**32)
-        g = torch.Generator(device=latent.device).manual_seed(seed)
-        noise = torch.randn(latent.shape, generator=g, device=latent.device)
-        encrypted += noise
-    return encrypted
+    return _apply_keystream(encrypted, key, num_rounds, 1)
 
 def decrypt_latent(encrypted_latent: torch.Tensor, key: str, num_rounds: int = 8) -> torch.Tensor:
     decrypted = encrypted_latent.clone()
-    for i in reversed(range(num_rounds)):
-        seed = int(hashlib.sha256(f"{key}_{i}".encode()).hexdigest(), 16) % (2**32)
-        g = torch.Generator(device=decrypted.device).manual_seed(seed)
-        noise = torch.randn(decrypted.shape, generator=g, device=decrypted.device)
-        decrypted -= noise
-    return decrypted
+    return _apply_keystream(decrypted, key, num_rounds, -1)
 
 def encrypt_with_RSAKey(data: bytes, public_key: RSAPublicKey) -> bytes:
     encrypted_data = public_key.encrypt(
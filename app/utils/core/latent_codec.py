@@ -0,0 +1,104 @@
+import zlib
+import struct
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Quantizing codecs, "raw" (no codec) is handled by the latent frame itself
+CODEC_BITS = {"int8": 8, "int4": 4}
+ENTROPY_CODERS = ["zlib", "zstd"] if zstandard is not None else ["zlib"]
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+
+_ENTROPY_IDS = {"none": 0, "zlib": 1, "zstd": 2}
+_ENTROPY_NAMES = {entropy_id: name for name, entropy_id in _ENTROPY_IDS.items()}
+_HEADER = struct.Struct("<BBH") # entropy coder, bits, channels
+
+def _channels_first(latent: np.ndarray) -> np.ndarray:
+    # (1, C, H, W) -> (C, N), other shapes are treated as a single channel
+    if latent.ndim >= 2:
+        return np.moveaxis(latent, 1, 0).reshape(latent.shape[1], -1)
+    return latent.reshape(1, -1)
+
+def quantize(latent: np.ndarray, bits: int) -> tuple:
+    """Per-channel affine quantization to `bits` bits. Returns (codes, mins, scales)."""
+    channels = _channels_first(np.asarray(latent, dtype=np.float32))
+    levels = (1 << bits) - 1
+    mins = channels.min(axis=1)
+    scales = (channels.max(axis=1) - mins) / levels
+    scales[scales == 0] = 1.0
+    codes = np.rint((channels - mins[:, None]) / scales[:, None])
+    return np.clip(codes, 0, levels).astype(np.uint8), mins.astype(np.float32), scales.astype(np.float32)
+
+def dequantize(codes: np.ndarray, mins: np.ndarray, scales: np.ndarray, shape: tuple) -> np.ndarray:
+    channels = codes.astype(np.float32) * scales[:, None] + mins[:, None]
+    if len(shape) >= 2:
+        moved = (shape[1], shape[0], *shape[2:])
+        return np.moveaxis(channels.reshape(moved), 0, 1)
+    return channels.reshape(shape)
+
+def _pack(codes: np.ndarray, bits: int) -> bytes:
+    flat = codes.reshape(-1)
+    if bits == 4:
+        if flat.size % 2:
+            flat = np.append(flat, np.uint8(0))
+        flat = (flat[0::2] << 4) | flat[1::2]
+    return flat.tobytes()
+
+def _unpack(data: bytes, bits: int, count: int) -> np.ndarray:
+    packed = np.frombuffer(data, dtype=np.uint8)
+    if bits == 4:
+        codes = np.empty(packed.size * 2, dtype=np.uint8)
+        codes[0::2] = packed >> 4
+        codes[1::2] = packed & 0x0F
+        return codes[:count]
+    return packed[:count]
+
+def _compress(data: bytes, entropy: str) -> bytes:
+    if entropy == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd is not available, install the zstandard package")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if entropy == "zlib":
+        return zlib.compress(data, ZLIB_LEVEL)
+    return data
+
+def _decompress(data: bytes, entropy: str) -> bytes:
+    if entropy == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd is not available, install the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if entropy == "zlib":
+        return zlib.decompress(data)
+    return bytes(data)
+
+def encode_latent(latent: np.ndarray, codec: str, entropy: str = "zlib") -> bytes:
+    """Quantize and entropy-code a latent. The shape travels separately, in the frame header."""
+    if codec not in CODEC_BITS:
+        raise ValueError(f"Unknown latent codec: {codec}")
+    if entropy not in _ENTROPY_IDS:
+        raise ValueError(f"Unknown entropy coder: {entropy}")
+    bits = CODEC_BITS[codec]
+
+    codes, mins, scales = quantize(latent, bits)
+    header = _HEADER.pack(_ENTROPY_IDS[entropy], bits, mins.size)
+    return b"".join((header, mins.tobytes(), scales.tobytes(), _compress(_pack(codes, bits), entropy)))
+
+def decode_latent(payload: bytes | memoryview, shape: tuple) -> np.ndarray:
+    """Inverse of encode_latent, always returns float32."""
+    view = memoryview(payload)
+    entropy_id, bits, channels = _HEADER.unpack_from(view, 0)
+    if entropy_id not in _ENTROPY_NAMES or bits not in CODEC_BITS.values():
+        raise ValueError("Corrupt latent codec payload")
+
+    offset = _HEADER.size
+    mins = np.frombuffer(view, dtype=np.float32, count=channels, offset=offset)
+    scales = np.frombuffer(view, dtype=np.float32, count=channels, offset=offset + 4 * channels)
+    data = _decompress(view[offset + 8 * channels:], _ENTROPY_NAMES[entropy_id])
+
+    count = int(np.prod(shape))
+    codes = _unpack(data, bits, count).reshape(channels, -1)
+    return dequantize(codes, mins, scales, tuple(shape))
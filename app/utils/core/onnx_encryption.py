@@ -1,21 +1,74 @@
 import numpy as np
 import hashlib
+from utils.lru_cache import LRUCache
+
+KEYSTREAM_CACHE_MAX_BYTES = 64 * 1024 * 1024 # ~250 keystreams of a 256px latent (8 float64 rounds, 256 KB each)
+
+# Round noises keyed by (key, shape, num_rounds), bounded by their total nbytes
+_keystream_cache = LRUCache(KEYSTREAM_CACHE_MAX_BYTES, sizeof=lambda keystream: keystream.nbytes)
+
+def _round_seeds(key: str, num_rounds: int) -> list:
+    # Every round seed is derived up front from the same SHA-256 schedule
+    return [int(hashlib.sha256(f"{key}_{i}".encode()).hexdigest(), 16) % (2**32) for i in range(num_rounds)]
+
+def _apply_keystream(buffer: np.ndarray, key: str, num_rounds: int, sign: int) -> np.ndarray:
+    # Draw each round into one reusable float64 scratch array and add/subtract it
+    # in place, in the original round order, so results stay bit-identical
+    seeds = _round_seeds(key, num_rounds)
+    op = np.add if sign > 0 else np.subtract
+    if sign < 0:
+        seeds = seeds[::-1]
+
+    scratch = np.empty(buffer.shape, dtype=np.float64)
+    for seed in seeds:
+        np.random.default_rng(seed).standard_normal(out=scratch)
+        op(buffer, scratch, out=buffer, casting="same_kind")
+    return buffer
+
+def generate_keystream(key: str, shape: tuple, num_rounds: int = 8, out: np.ndarray | None = None) -> np.ndarray:
+    """Sum of all round noises for `key`, accumulated into a (preallocated) float32 buffer."""
+    if out is None:
+        out = np.zeros(shape, dtype=np.float32)
+    else:
+        out.fill(0)
+    return _apply_keystream(out, key, num_rounds, 1)
+
+def configure_keystream_cache(max_bytes: int):
+    """Set the memory budget of the keystream cache (0 disables caching)."""
+    _keystream_cache.resize(max_bytes)
+
+def keystream_cache_stats() -> dict:
+    """Hit/miss counters and current size of the keystream cache."""
+    return _keystream_cache.stats()
+
+def _cached_rounds(key: str, shape: tuple, num_rounds: int) -> np.ndarray:
+    # Every round is kept as drawn (float64, in decryption order) rather than summed,
+    # a single summed subtraction would differ from the per-round path in the last ulp
+    cache_key = (key, tuple(shape), num_rounds)
+    rounds = _keystream_cache.get(cache_key)
+    if rounds is None:
+        rounds = np.empty((num_rounds, *shape), dtype=np.float64)
+        for noise, seed in zip(rounds, _round_seeds(key, num_rounds)[::-1]):
+            np.random.default_rng(seed).standard_normal(out=noise)
+        rounds.setflags(write=False) # shared between callers
+        _keystream_cache.put(cache_key, rounds)
+    return rounds
 
 def encrypt_latent(latent: list, key: str, num_rounds: int = 8) -> np.ndarray:
     encrypted = np.array(latent)
-    for i in range(num_rounds):
-        seed = int(hashlib.sha256(f"{key}_{i}".encode()).hexdigest(), 16) % (2**32)
-        rng = np.random.default_rng(seed)
-        noise = rng.standard_normal(size=encrypted.shape)
-        encrypted += noise
-    return encrypted
+    return _apply_keystream(encrypted, key, num_rounds, 1)
 
 
 def decrypt_latent(encrypted_latent: np.ndarray, key: str, num_rounds: int = 8) -> np.ndarray:
-    decrypted = encrypted_latent.copy()
-    for i in reversed(range(num_rounds)):
-        seed = int(hashlib.sha256(f"{key}_{i}".encode()).hexdigest(), 16) % (2**32)
-        rng = np.random.default_rng(seed)
-        noise = rng.standard_normal(size=decrypted.shape)
-        decrypted -= noise
-    return decrypted
\ No newline at end of file
+    """Remove the round noises. The result is always float32, what the ONNX decoder takes."""
+    # A float16 wire latent is upcast first, the rounds are removed in at least float32
+    decrypted = encrypted_latent.astype(np.promote_types(encrypted_latent.dtype, np.float32))
+    if _keystream_cache.max_size <= 0:
+        _apply_keystream(decrypted, key, num_rounds, -1)
+        return decrypted.astype(np.float32, copy=False)
+
+    # Re-rendering a chat decrypts the same (seed, shape) pairs again and again, so the
+    # round noises are cached and only the subtractions are repeated, in the same order
+    for noise in _cached_rounds(key, encrypted_latent.shape, num_rounds):
+        np.subtract(decrypted, noise, out=decrypted, casting="same_kind")
+    return decrypted.astype(np.float32, copy=False)
@@ -1,4 +1,5 @@
 import io
+import ast
 import base64
 from PIL import Image
 import numpy as np
@@ -24,6 +25,38 @@ def image_to_base64(image: Image.Image | None) -> str:
     image.save(buffered, format="PNG")
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
+def bytes_to_image(image_bytes: bytes | None) -> Image.Image:
+    if image_bytes is None:
+        return None
+    return Image.open(io.BytesIO(image_bytes))
+
+def image_to_bytes(image: Image.Image | None) -> bytes:
+    if image is None:
+        return None
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+def npy_bytes_to_array(buffer: bytes | bytearray | memoryview) -> np.ndarray:
+    """View the array of an in-memory .npy file without copying its data, unlike np.load(io.BytesIO(...))."""
+    view = memoryview(buffer)
+    if bytes(view[:6]) != b"\x93NUMPY":
+        raise ValueError("Not a .npy buffer")
+    major = view[6]
+    if major == 1:
+        header_len, header_start = int.from_bytes(view[8:10], "little"), 10
+    else:
+        header_len, header_start = int.from_bytes(view[8:12], "little"), 12
+    header = ast.literal_eval(bytes(view[header_start:header_start + header_len]).decode("latin1"))
+
+    dtype = np.dtype(header["descr"])
+    if dtype.hasobject:
+        raise ValueError("Object arrays are not supported")
+    shape = header["shape"]
+    count = int(np.prod(shape))
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=header_start + header_len)
+    return array.reshape(shape, order="F" if header["fortran_order"] else "C")
+
 def latent_to_gray_image(latent: np.ndarray) -> Image.Image:
     if latent.ndim == 4 and latent.shape[0] == 1:
         latent = latent[0]  # shape: (C, H, W)
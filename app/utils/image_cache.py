@@ -0,0 +1,58 @@
+import os
+import hashlib
+import numpy as np
+from PIL import Image
+from utils.lru_cache import LRUCache
+
+THUMBNAILS_DB_PATH = "db/thumbnails/"
+THUMBNAIL_SIZE = 256
+MEMORY_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# Decoded images keyed by content hash, bounded by their raw pixel size
+_memory_cache = LRUCache(MEMORY_CACHE_MAX_BYTES, sizeof=lambda image: image.width * image.height * len(image.getbands()))
+
+def _content_key(enc_latent_array: np.ndarray, seed_string: str) -> str:
+    latent = np.ascontiguousarray(enc_latent_array)
+    digest = hashlib.sha256()
+    digest.update(seed_string.encode('utf-8'))
+    digest.update(f"{latent.dtype.str}{latent.shape}".encode('utf-8'))
+    digest.update(latent.data)
+    return digest.hexdigest()
+
+def _thumbnail_path(key: str) -> str:
+    return os.path.join(THUMBNAILS_DB_PATH, key[:2], f"{key}.png")
+
+def get_decoded_image(enc_latent_array: np.ndarray, seed_string: str, decode) -> Image.Image:
+    """
+    Return the decoded image of an encrypted latent, running `decode(enc_latent_array, seed_string)`
+    only when neither the in-memory tier nor the PNG tier under db/thumbnails has it.
+    """
+    key = _content_key(enc_latent_array, seed_string)
+
+    image = _memory_cache.get(key)
+    if image is not None:
+        return image
+
+    path = _thumbnail_path(key)
+    if os.path.exists(path):
+        with Image.open(path) as cached:
+            image = cached.convert("RGB")
+    else:
+        image = decode(enc_latent_array, seed_string)
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+
+        # Write to a temporary file first so a crash never leaves a truncated PNG behind
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, path)
+
+    _memory_cache.put(key, image)
+    return image
+
+def peek_decoded_image(enc_latent_array: np.ndarray, seed_string: str) -> Image.Image | None:
+    """In-memory lookup only, cheap enough to call on the Tk main thread."""
+    return _memory_cache.get(_content_key(enc_latent_array, seed_string))
+
+def image_cache_stats() -> dict:
+    return _memory_cache.stats()
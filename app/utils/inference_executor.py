@@ -0,0 +1,92 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+NUM_WORKERS = 1 # a single ONNX session run already uses every core / the GPU
+MAX_QUEUE_SIZE = 16 # per priority, background decodes cannot crowd out what the user asked for
+POLL_INTERVAL_MS = 30
+
+class InferenceExecutor:
+    _instance = None
+    _initialized = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, num_workers=NUM_WORKERS, max_queue_size=MAX_QUEUE_SIZE):
+        if not InferenceExecutor._initialized:
+            super().__init__()
+            self._init_state(num_workers, max_queue_size)
+            InferenceExecutor._initialized = True
+
+    def _init_state(self, num_workers, max_queue_size):
+        self._max_queue_size = max_queue_size
+        self._interactive = deque()
+        self._background = deque()
+        self._cond = threading.Condition()
+        for _ in range(num_workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Queue a user-initiated `fn(*args, **kwargs)`, it runs before any background job. Fails fast with queue.Full."""
+        return self._submit(self._interactive, fn, args, kwargs)
+
+    def submit_background(self, fn, *args, **kwargs) -> Future:
+        """Queue speculative work such as decoding rows scrolled into view. Fails fast with queue.Full."""
+        return self._submit(self._background, fn, args, kwargs)
+
+    def _submit(self, jobs: deque, fn, args, kwargs) -> Future:
+        future = Future()
+        with self._cond:
+            if len(jobs) >= self._max_queue_size:
+                future.set_exception(queue.Full("Too many images are being processed, try again shortly"))
+                return future
+            # A job cancelled while queued gives up its slot right away, not once a worker reaches it
+            future.add_done_callback(self._discard)
+            jobs.append((future, fn, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def _discard(self, future: Future):
+        if not future.cancelled():
+            return
+        with self._cond:
+            for jobs in (self._interactive, self._background):
+                for i, job in enumerate(jobs):
+                    if job[0] is future:
+                        del jobs[i]
+                        return
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._interactive and not self._background:
+                    self._cond.wait()
+                future, fn, args, kwargs = (self._interactive or self._background).popleft()
+            # Skips jobs that were cancelled after being taken off the queue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def on_future_done(widget, future: Future, callback, poll_interval_ms: int = POLL_INTERVAL_MS):
+    """
+    Call `callback(future)` on the Tk main thread once `future` finishes.
+    Tk is not thread-safe, so completion is polled with `after()` instead of
+    being called from the worker thread. Cancelled futures and destroyed widgets are ignored.
+    """
+    def poll():
+        if not widget.winfo_exists() or future.cancelled():
+            return
+        if future.done():
+            callback(future)
+        else:
+            widget.after(poll_interval_ms, poll)
+
+    widget.after(poll_interval_ms, poll)
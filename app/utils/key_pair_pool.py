@@ -0,0 +1,52 @@
+import threading
+from collections import deque
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+KEY_POOL_SIZE = 64
+KEY_POOL_LOW_WATERMARK = 16 # refilling starts once fewer pairs are left
+
+def generate_key_pair() -> tuple:
+    """Raw (private, public) X25519 key bytes."""
+    private_key = X25519PrivateKey.generate()
+    return private_key.private_bytes_raw(), private_key.public_key().public_bytes_raw()
+
+class KeyPairPool:
+    _instance = None
+    _initialized = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not KeyPairPool._initialized:
+            super().__init__()
+            self._init_state()
+            KeyPairPool._initialized = True
+
+    def _init_state(self):
+        self._pairs = deque()
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._refill.set()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def take(self) -> tuple:
+        """A fresh ephemeral key pair, generated in the background ahead of time."""
+        with self._lock:
+            pair = self._pairs.popleft() if self._pairs else None
+            low = len(self._pairs) < KEY_POOL_LOW_WATERMARK
+        if low:
+            self._refill.set()
+        # Only an exhausted pool pays for the key generation inline
+        return pair or generate_key_pair()
+
+    def _run(self):
+        while True:
+            self._refill.wait()
+            self._refill.clear()
+            while len(self._pairs) < KEY_POOL_SIZE:
+                pair = generate_key_pair()
+                with self._lock:
+                    self._pairs.append(pair)
@@ -0,0 +1,85 @@
+import os
+import time
+import zlib
+import hashlib
+
+CHUNKED_FORMAT = "chunked" # peer reassembles latent_chunk frames
+CHUNK_SIZE = 64 * 1024
+CHUNK_THRESHOLD = 128 * 1024 # smaller payloads still go in a single frame
+CHUNK_MAX_RETRIES = 5
+PARTIAL_DB_PATH = "db/latents/.partial/"
+DONE_MARKER_TTL_S = 7 * 24 * 3600 # finished transfers are remembered this long to ack late resends
+
+def transfer_id_of(binary_bytes: bytes) -> str:
+    # Derived from the content, so a resent payload continues the same partial file
+    return hashlib.sha256(binary_bytes).hexdigest()[:32]
+
+def iter_chunks(json_dict: dict, binary_bytes: bytes, binary_type: str, start: int = 0):
+    """Yield (offset, chunk frame, chunk bytes) for `binary_bytes` from byte `start` on."""
+    view = memoryview(binary_bytes)
+    transfer_id = transfer_id_of(binary_bytes)
+    for offset in range(start, len(view), CHUNK_SIZE):
+        chunk = view[offset:offset + CHUNK_SIZE]
+        yield offset, {
+            "type": "latent_chunk",
+            "data": {
+                "transfer_id": transfer_id,
+                "seq": offset // CHUNK_SIZE,
+                "offset": offset,
+                "total_size": len(view),
+                "crc32": zlib.crc32(chunk),
+                "frame": json_dict,
+                "binary_type": binary_type
+            }
+        }, chunk
+
+def _spool_path(spool_dir: str, transfer_id: str, suffix: str) -> str:
+    # transfer_id comes from the peer, only a hex digest may name a file
+    if len(transfer_id) != 32 or not all(c in "0123456789abcdef" for c in transfer_id):
+        raise ValueError(f"Invalid transfer id: {transfer_id!r}")
+    return os.path.join(spool_dir, f"{transfer_id}{suffix}")
+
+def receive_chunk(data: dict, chunk_bytes: bytes, spool_dir: str) -> tuple | None:
+    """
+    Append one chunk to its partial file under `spool_dir`.
+    Returns (json_dict, binary_bytes, binary_type) of the original frame once the last chunk is in,
+    the caller calls finish_transfer() after handling it. Chunks of a finished transfer return None.
+    """
+    if zlib.crc32(chunk_bytes) != data["crc32"]:
+        raise ValueError(f"Checksum mismatch in chunk {data['seq']} of {data['transfer_id']}")
+
+    # The ack of the last chunk was lost and the sender resent it, the frame was already handled
+    if os.path.exists(_spool_path(spool_dir, data["transfer_id"], ".done")):
+        return None
+
+    os.makedirs(spool_dir, exist_ok=True)
+    path = _spool_path(spool_dir, data["transfer_id"], ".part")
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    offset = data["offset"]
+    if offset > size:
+        raise ValueError(f"Chunk {data['seq']} of {data['transfer_id']} is past the received {size} bytes")
+
+    # Chunks already on disk (a resend after reconnect) are skipped
+    if offset == size:
+        with open(path, "ab") as f:
+            f.write(chunk_bytes)
+        size += len(chunk_bytes)
+
+    if size < data["total_size"]:
+        return None
+
+    # The partial file stays until the frame was handled, a failed handling is retried on the next resend
+    binary_bytes = bytearray(data["total_size"])
+    with open(path, "rb") as f:
+        f.readinto(binary_bytes)
+    return data["frame"], binary_bytes, data["binary_type"]
+
+def finish_transfer(transfer_id: str, spool_dir: str):
+    """Replace the partial file of a handled transfer with an empty marker and drop expired markers."""
+    open(_spool_path(spool_dir, transfer_id, ".done"), "wb").close()
+    os.remove(_spool_path(spool_dir, transfer_id, ".part"))
+
+    expired = time.time() - DONE_MARKER_TTL_S
+    for entry in os.scandir(spool_dir):
+        if entry.name.endswith(".done") and entry.stat().st_mtime < expired:
+            os.remove(entry.path)
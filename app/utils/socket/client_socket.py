@@ -1,11 +1,46 @@
-import json
-import socket
-import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.socket.connection_pool import ConnectionPool, encode_frame
+from utils.socket.chunked_transfer import CHUNK_MAX_RETRIES, iter_chunks
+
+BROADCAST_WORKERS = 16
+
+def _with_binary_header(json_dict, binary_bytes, binary_type):
+    # 바이너리 여부에 따라 JSON 확장
+    if binary_bytes is not None:
+        json_dict["has_binary"] = True
+        json_dict["binary_length"] = len(binary_bytes)
+        json_dict["binary_type"] = binary_type
+    else:
+        json_dict["has_binary"] = False
+    return json_dict
+
+def broadcast(peers: list, json_dict, binary_bytes=None, binary_type=None) -> list:
+    """
+    Send the same frame to every (ip, port) in `peers` concurrently, on a bounded pool.
+    The frame is encoded once and every peer gets one short connect attempt, so offline
+    peers do not hold up the reachable ones. Returns the peers it did not reach, for the caller to retry.
+    """
+    frame = encode_frame(_with_binary_header(json_dict, binary_bytes, binary_type))
+
+    def send(peer):
+        try:
+            ConnectionPool().send(*peer, frame, binary_bytes, fail_fast=True)
+            return None
+        except (OSError, RuntimeError) as e:
+            print(f"[ClientSocket] Broadcast to {peer[0]}:{peer[1]} failed: {e}")
+            return peer
+
+    if not peers:
+        return []
+    with ThreadPoolExecutor(max_workers=min(BROADCAST_WORKERS, len(peers))) as executor:
+        return [peer for peer in executor.map(send, peers) if peer is not None]
 
 class ClientSocket:
-    def __init__(self, ip: str, port: int):
+    def __init__(self, ip: str, port: int, fail_fast: bool = False):
         self.ip = ip
         self.port = port
+        self.fail_fast = fail_fast # one short connect attempt, for callers that retry on their own
 
     # def send(self, data: dict):
     #     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -15,22 +50,36 @@ class ClientSocket:
     #         s.close()
 
     def send(self, json_dict, binary_bytes=None, binary_type=None):
-        # 바이너리 여부에 따라 JSON 확장
-        if binary_bytes is not None:
-            json_dict["has_binary"] = True
-            json_dict["binary_length"] = len(binary_bytes)
-            json_dict["binary_type"] = binary_type
-        else:
-            json_dict["has_binary"] = False
-
         # JSON 직렬화
-        json_bytes = json.dumps(json_dict).encode("utf-8")
-        json_len = struct.pack("!I", len(json_bytes))
+        frame = encode_frame(_with_binary_header(json_dict, binary_bytes, binary_type))
 
         # print("[Client] Sending data to server...", json_dict, 
         #       f"{'with binary data' if binary_bytes else 'without binary data'}")
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((self.ip, self.port))
-            s.sendall(json_len + json_bytes)
-            if binary_bytes:
-                s.sendall(binary_bytes)
+        # Reuses the kept-alive connection to this peer and waits for its ack
+        ConnectionPool().send(self.ip, self.port, frame, binary_bytes, self.fail_fast)
+
+    def send_chunked(self, json_dict, binary_bytes, binary_type, start=0, on_progress=None):
+        # Sends the binary as checksummed chunks from `start`, the offset the peer acknowledged last.
+        # When the connection drops, sending resumes from the last acknowledged offset instead of from
+        # zero. `on_progress(offset)` lets the caller persist it, so a later attempt resumes there too.
+        acked = start
+        retries = 0
+        while True:
+            try:
+                for offset, chunk_dict, chunk in iter_chunks(json_dict, binary_bytes, binary_type, acked):
+                    self.send(chunk_dict, chunk, "chunk")
+                    acked = offset + len(chunk)
+                    if on_progress:
+                        on_progress(acked)
+                return
+            except (OSError, RuntimeError) as e:
+                if isinstance(e, RuntimeError) and acked:
+                    # The peer rejected a chunk, e.g. it no longer has the partial file. Starting over
+                    # is safe, chunks it already has are skipped on its side
+                    acked = 0
+                    if on_progress:
+                        on_progress(acked)
+                retries += 1
+                if retries > CHUNK_MAX_RETRIES:
+                    raise
+                time.sleep(min(0.2 * 2 ** retries, 5))
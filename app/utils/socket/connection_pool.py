@@ -0,0 +1,186 @@
+import json
+import time
+import socket
+import select
+import struct
+import threading
+
+CONNECT_TIMEOUT_S = 5
+FAIL_FAST_CONNECT_TIMEOUT_S = 2 # single attempt for callers that retry on their own schedule
+ACK_TIMEOUT_S = 30
+HEARTBEAT_INTERVAL_S = 15 # must stay below the server's IDLE_TIMEOUT_S
+MAX_IDLE_S = 300 # connections unused for this long are closed instead of kept alive
+RECONNECT_BACKOFF_S = (0.2, 0.5, 1, 2)
+
+HEARTBEAT_FRAME = {"type": "heartbeat", "has_binary": False}
+
+def encode_frame(json_dict: dict) -> bytes:
+    json_bytes = json.dumps(json_dict).encode("utf-8")
+    return struct.pack("!I", len(json_bytes)) + json_bytes
+
+class _PeerConnection:
+    def __init__(self, address: tuple):
+        self.address = address
+        self.sock = None
+        self.last_used = time.monotonic()
+        # Frames of one peer are written and acked one at a time over the same socket
+        self.lock = threading.Lock()
+
+    def _connect(self, fail_fast: bool = False):
+        # fail_fast: one short attempt, an unreachable peer must not hold up e.g. an outbox worker for ~30s
+        delays = (None,) if fail_fast else (*RECONNECT_BACKOFF_S, None)
+        timeout = FAIL_FAST_CONNECT_TIMEOUT_S if fail_fast else CONNECT_TIMEOUT_S
+        for delay in delays:
+            try:
+                sock = socket.create_connection(self.address, timeout=timeout)
+                break
+            except OSError:
+                if delay is None:
+                    raise
+                time.sleep(delay)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(ACK_TIMEOUT_S)
+        self.sock = sock
+
+    def _is_dropped(self) -> bool:
+        # Nothing is expected from the peer between acks, a readable idle socket means it was closed
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+    def _write(self, frame: bytes, binary_bytes: bytes | None):
+        self.sock.sendall(frame)
+        if binary_bytes:
+            self.sock.sendall(binary_bytes)
+
+    def _read_ack(self):
+        ack = b""
+        while len(ack) < 2:
+            chunk = self.sock.recv(2 - len(ack))
+            if not chunk:
+                raise ConnectionError(f"Connection to {self.address} closed before ack")
+            ack += chunk
+        if ack == b"ER":
+            # The frame arrived but the peer failed to handle it, the connection itself is fine
+            raise RuntimeError(f"Peer {self.address} failed to handle the frame")
+        if ack == b"BY":
+            # The peer is up but cannot take frames yet (nobody logged in), like an unreachable one it is retried
+            raise ConnectionRefusedError(f"Peer {self.address} is not accepting frames yet")
+        if ack != b"OK":
+            raise ConnectionError(f"Unexpected ack from {self.address}: {ack!r}")
+
+    def _write_and_ack(self, frame: bytes, binary_bytes: bytes | None):
+        self._write(frame, binary_bytes)
+        self._read_ack()
+
+    def send(self, frame: bytes, binary_bytes: bytes | None = None, fail_fast: bool = False):
+        with self.lock:
+            if self.sock is not None and self._is_dropped():
+                self.close()
+            reused = self.sock is not None
+            if not reused:
+                self._connect(fail_fast)
+            try:
+                self._write(frame, binary_bytes)
+            except OSError:
+                self.close()
+                # A kept-alive socket may still have been dropped by the peer, the frame was not
+                # written completely so it is retried once on a fresh connection. Failures on a fresh one are not.
+                if not reused:
+                    raise
+                self._connect(fail_fast)
+                try:
+                    self._write(frame, binary_bytes)
+                except OSError:
+                    self.close()
+                    raise
+            try:
+                self._read_ack()
+            except OSError:
+                # The peer may have handled the frame already (e.g. an ack timeout), resending it
+                # here could deliver it twice, so the caller decides
+                self.close()
+                raise
+            self.last_used = time.monotonic()
+
+    def heartbeat(self):
+        # Skipped while a send holds the connection, that already proves liveness
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.sock is not None:
+                self._write_and_ack(encode_frame(HEARTBEAT_FRAME), None)
+        except OSError:
+            self.close()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+class ConnectionPool:
+    _instance = None
+    _initialized = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not ConnectionPool._initialized:
+            super().__init__()
+            self._init_state()
+            ConnectionPool._initialized = True
+
+    def _init_state(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def get(self, ip: str, port: int) -> _PeerConnection:
+        address = (ip, port)
+        with self._lock:
+            connection = self._connections.get(address)
+            if connection is None:
+                connection = _PeerConnection(address)
+                self._connections[address] = connection
+            return connection
+
+    def send(self, ip: str, port: int, frame: bytes, binary_bytes: bytes | None = None, fail_fast: bool = False):
+        """
+        Send one encoded frame (and its binary body) to a peer and wait for its ack.
+        With `fail_fast` a new connection gets one short attempt instead of several with backoff.
+        """
+        self.get(ip, port).send(frame, binary_bytes, fail_fast)
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            with connection.lock:
+                connection.close()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL_S)
+            with self._lock:
+                connections = list(self._connections.values())
+
+            now = time.monotonic()
+            for connection in connections:
+                if now - connection.last_used >= MAX_IDLE_S:
+                    with self._lock:
+                        if self._connections.get(connection.address) is connection:
+                            del self._connections[connection.address]
+                    with connection.lock:
+                        connection.close()
+                else:
+                    connection.heartbeat()
@@ -0,0 +1,81 @@
+import yaml
+import struct
+import numpy as np
+from utils.core import latent_codec
+
+with open("config.yaml", "r") as file:
+    config = yaml.safe_load(file)
+    latent_wire_dtype = config.get("LATENT_WIRE_DTYPE", "float32") # "float16" or "float32"
+    # Lossless "raw" unless a lossy "int8" / "int4" is opted into. The codec sees the encrypted latent,
+    # whose keystream rounds widen every channel's range ~3x. On unit-variance latents with 8 rounds the
+    # decrypted error is ~0.022 RMS for int8 and ~0.38 for int4 (0.007 / 0.13 on the plain latent), so the
+    # receiver sees a different image than the sender's local copy. benchmark_codec.py measures the PSNR.
+    latent_wire_codec = config.get("LATENT_WIRE_CODEC", "raw")
+
+LATENT_FRAME_TYPE = "latent-v1"
+LATENT_CODEC_FORMAT = "latent-codec" # peer decodes quantized latent-v1 bodies
+LATENT_FRAME_MAGIC = b"LTNT"
+LATENT_FRAME_VERSION = 1
+CODEC_RAW = 0
+_CODEC_IDS = {"raw": CODEC_RAW, "int8": 1, "int4": 2}
+_CODEC_NAMES = {codec_id: name for name, codec_id in _CODEC_IDS.items()}
+
+# magic, version, dtype code, codec, ndim, timestamp, seed ciphertext length; then ndim uint32 dims,
+# the seed ciphertext and the little-endian body
+_HEADER = struct.Struct("<4sBBBBdH")
+_DTYPE_CODES = {np.dtype("<f2"): 1, np.dtype("<f4"): 2, np.dtype("<f8"): 3}
+_DTYPES = {code: dtype for dtype, code in _DTYPE_CODES.items()}
+
+def encode_latent_frame(latent_array: np.ndarray, enc_seed_bytes: bytes, timestamp: float,
+                        dtype: str = latent_wire_dtype, codec: str = "raw", entropy: str = "zlib") -> bytes:
+    """
+    Pack a latent into a "latent-v1" binary frame. The encrypted latent is float64 after
+    encrypt_latent, the wire dtype keeps it at the model's float32 (or float16) instead.
+    Any other codec than "raw" quantizes and entropy-codes the body, see latent_codec.
+    """
+    wire_dtype = np.dtype(dtype).newbyteorder("<")
+    if wire_dtype not in _DTYPE_CODES:
+        raise ValueError(f"Unsupported wire dtype: {dtype}")
+    if codec not in _CODEC_IDS:
+        raise ValueError(f"Unknown latent codec: {codec}")
+    body = np.ascontiguousarray(latent_array, dtype=wire_dtype)
+
+    header = _HEADER.pack(LATENT_FRAME_MAGIC, LATENT_FRAME_VERSION, _DTYPE_CODES[wire_dtype], _CODEC_IDS[codec],
+                          body.ndim, timestamp, len(enc_seed_bytes))
+    shape = struct.pack(f"<{body.ndim}I", *body.shape)
+    if codec == "raw":
+        return b"".join((header, shape, enc_seed_bytes, memoryview(body).cast("B")))
+    return b"".join((header, shape, enc_seed_bytes, latent_codec.encode_latent(body, codec, entropy)))
+
+def decode_latent_frame(buffer: bytes | bytearray | memoryview) -> dict:
+    """
+    Parse a "latent-v1" frame. Raw float32/float64 latents are a view over `buffer`, not a copy.
+    A float16 wire latent is widened to float32, what is stored and what the ONNX decoder takes.
+    """
+    view = memoryview(buffer)
+    magic, version, dtype_code, codec, ndim, timestamp, seed_len = _HEADER.unpack_from(view, 0)
+    if magic != LATENT_FRAME_MAGIC or version != LATENT_FRAME_VERSION:
+        raise ValueError("Not a latent-v1 frame")
+    if dtype_code not in _DTYPES:
+        raise ValueError(f"Unknown latent dtype code: {dtype_code}")
+    if codec not in _CODEC_NAMES:
+        raise ValueError(f"Unknown latent codec: {codec}")
+
+    offset = _HEADER.size
+    shape = struct.unpack_from(f"<{ndim}I", view, offset)
+    offset += 4 * ndim
+    enc_seed_bytes = bytes(view[offset:offset + seed_len])
+    offset += seed_len
+
+    wire_dtype = _DTYPES[dtype_code]
+    dtype = np.promote_types(wire_dtype, np.float32)
+    if codec == CODEC_RAW:
+        latent_array = np.frombuffer(buffer, dtype=wire_dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        latent_array = latent_array.astype(dtype, copy=False)
+    else:
+        latent_array = latent_codec.decode_latent(view[offset:], shape).astype(dtype, copy=False)
+    return {
+        "enc_latent_array": latent_array,
+        "enc_seed_bytes": enc_seed_bytes,
+        "timestamp": timestamp
+    }
@@ -0,0 +1,124 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from api import outbox_api
+from utils.socket.client_socket import ClientSocket
+
+OUTBOX_WORKERS = 4 # peers drained in parallel, an unreachable one fails fast and is retried with backoff
+OUTBOX_POLL_S = 1
+OUTBOX_BACKOFF_BASE_S = 1
+OUTBOX_BACKOFF_MAX_S = 300
+OUTBOX_MAX_REJECTIONS = 3 # a frame the peer received but failed to handle this often is dead-lettered
+OUTBOX_COALESCE_S = 0.005 # frames queued within this window after a notify go out together
+OUTBOX_BATCH_MAX = 64
+BATCH_FORMAT = "batch" # peer accepts a batch frame carrying several queued text_message frames and their binaries
+
+class OutboxSender:
+    _instance = None
+    _initialized = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not OutboxSender._initialized:
+            super().__init__()
+            self._init_state()
+            OutboxSender._initialized = True
+
+    def _init_state(self):
+        self.callbacks = []
+        self._wakeup = threading.Event()
+        self._draining = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=OUTBOX_WORKERS)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add_callback(self, callback):
+        """`callback(item)` runs on a sender thread after a queued frame was acked by its peer."""
+        if callable(callback):
+            self.callbacks.append(callback)
+        else:
+            raise ValueError("Callback must be a callable function")
+
+    def notify(self):
+        # New frames were queued
+        self._wakeup.set()
+
+    def wake_peer(self, user_id: str, friend_id: str):
+        # The peer was just seen online, retry its frames now instead of after the backoff
+        if outbox_api.wake_peer(user_id, friend_id)["data"]["count"]:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            # Nagle-style, a burst of sends is left to accumulate briefly so it can be batched
+            if self._wakeup.wait(OUTBOX_POLL_S):
+                time.sleep(OUTBOX_COALESCE_S)
+            self._wakeup.clear()
+            try:
+                peers = outbox_api.get_due_peers(time.time())["data"]["peers"]
+            except Exception as e:
+                print(f"[OutboxSender] Failed to read the outbox: {e}")
+                continue
+
+            for peer in peers:
+                with self._lock:
+                    if peer in self._draining:
+                        continue
+                    self._draining.add(peer)
+                self._executor.submit(self._drain_peer, *peer)
+
+    def _drain_peer(self, ip: str, port: int):
+        try:
+            while True:
+                items = outbox_api.get_peer_batch(ip, port, OUTBOX_BATCH_MAX)["data"]["items"]
+                if not items or items[0]["next_attempt"] > time.time():
+                    return
+                item = items[0]
+
+                try:
+                    socket = ClientSocket(ip, port, fail_fast=True)
+                    if len(items) > 1:
+                        # Binary sections are concatenated, binary_sizes splits them again
+                        binaries = [batched["binary"] or b"" for batched in items]
+                        socket.send({
+                            "type": "batch",
+                            "data": {
+                                "sender_id": item["user_id"],
+                                "frames": [batched["json_dict"] for batched in items],
+                                "binary_sizes": [len(binary) for binary in binaries]
+                            }
+                        }, binary_bytes=b"".join(binaries) if item["binary_type"] else None, binary_type=item["binary_type"])
+                    elif item["chunked"]:
+                        socket.send_chunked(item["json_dict"], item["binary"], item["binary_type"], item["chunk_offset"],
+                                            lambda offset: outbox_api.set_chunk_offset(item["id"], offset))
+                    else:
+                        socket.send(item["json_dict"], binary_bytes=item["binary"], binary_type=item["binary_type"])
+                except (OSError, RuntimeError) as e:
+                    # An unreachable peer is retried until it is back. A frame it rejected (acked "ER")
+                    # is only retried a few times, the frames behind it must not wait on it forever.
+                    attempts = item["attempts"] + 1
+                    rejections = item["rejections"] + isinstance(e, RuntimeError)
+                    if rejections >= OUTBOX_MAX_REJECTIONS and len(items) == 1:
+                        outbox_api.dead_letter(item["id"])
+                        print(f"[OutboxSender] {ip}:{port} rejected frame {item['id']} {rejections} times, dead-lettered")
+                        continue
+                    # Later frames of this peer wait behind this one to keep their order
+                    delay = min(OUTBOX_BACKOFF_BASE_S * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX_S)
+                    outbox_api.reschedule(item["id"], attempts, time.time() + delay, rejections)
+                    print(f"[OutboxSender] Delivery to {ip}:{port} failed ({e}), retrying in {delay}s")
+                    return
+
+                outbox_api.mark_delivered([delivered["id"] for delivered in items], [delivered["message_id"] for delivered in items])
+                for delivered in items:
+                    for callback in self.callbacks:
+                        try:
+                            callback(delivered)
+                        except Exception as e:
+                            print(f"[OutboxSender] Callback error: {e}")
+        finally:
+            with self._lock:
+                self._draining.discard((ip, port))
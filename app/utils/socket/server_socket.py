@@ -1,6 +1,8 @@
 import socket
 import struct
+import asyncio
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 import json
 import numpy as np
@@ -10,6 +12,11 @@ with open("config.yaml", "r") as file:
     config = yaml.safe_load(file)
     server_socket_ip = get_my_ip()  # Use the local IP address
     server_socket_port = config.get("SERVER_SOCKET_PORT", 5000)
+    server_socket_mode = config.get("SERVER_SOCKET_MODE", "threaded") # "threaded" or "asyncio"
+
+IDLE_TIMEOUT_S = 60 # peers send a heartbeat well within this, see connection_pool
+DISPATCH_WORKERS = 4
+READ_CHUNK_SIZE = 256 * 1024
 
 class ServerSocket:
     _instance = None
@@ -39,15 +46,21 @@ class ServerSocket:
             raise ValueError("Callback must be a callable function")
 
     def start(self):
-        threading.Thread(target=self._run, daemon=True).start()
+        if server_socket_mode == "asyncio":
+            threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True).start()
+        else:
+            threading.Thread(target=self._run, daemon=True).start()
 
     def _recv_exact(self, conn, n):
-        buf = b""
-        while len(buf) < n:
-            chunk = conn.recv(n - len(buf))
-            if not chunk:
+        # The kernel copies straight into one buffer sized up front
+        buf = bytearray(n)
+        view = memoryview(buf)
+        received = 0
+        while received < n:
+            count = conn.recv_into(view[received:], n - received)
+            if not count:
                 raise ConnectionError("Connection closed prematurely")
-            buf += chunk
+            received += count
         return buf
 
     def _run(self):
@@ -85,11 +98,20 @@ class ServerSocket:
 
             while True:
                 conn, addr = s.accept()
-                with conn:
-                    # print(f"[Server] Connection from {addr}")
-
+                # Peers keep their connection open, each one is served by its own thread
+                threading.Thread(target=self._handle_connection, args=(conn, addr), daemon=True).start()
+
+    def _handle_connection(self, conn, addr):
+        with conn:
+            # print(f"[Server] Connection from {addr}")
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            conn.settimeout(IDLE_TIMEOUT_S)
+            try:
+                while True:
                     # Json length
-                    header = self._recv_exact(conn, 4)
+                    header = self._recv_header(conn)
+                    if header is None:
+                        return
                     json_len = struct.unpack("!I", header)[0]
 
                     # Json data
@@ -104,8 +126,95 @@ class ServerSocket:
                         binary_type = json_dict["binary_type"]
                         # print(f"[Server] Received binary ({binary_type}, {len(binary_data)} bytes)")
 
-                    for callback in self.callbacks:
-                        callback(json_dict, binary_data, binary_type)
+                    ack = b"OK"
+                    if json_dict.get("type") != "heartbeat":
+                        ack = self._dispatch(json_dict, binary_data, binary_type)
 
                     # 4. 응답
-                    conn.sendall(b"OK")
\ No newline at end of file
+                    conn.sendall(ack)
+            except (OSError, ValueError) as e:
+                print(f"[ServerSocket] Connection from {addr} dropped: {e}")
+
+    def _recv_header(self, conn):
+        # None when the peer closed the connection or went quiet between frames
+        try:
+            first = conn.recv(4)
+        except socket.timeout:
+            return None
+        if not first:
+            return None
+        if len(first) < 4:
+            first += self._recv_exact(conn, 4 - len(first))
+        return first
+
+    def _dispatch(self, json_dict, binary_data, binary_type) -> bytes:
+        # The ack for the frame: b"ER" when a callback failed to handle it, b"BY" when a callback cannot take
+        # frames right now (it raised ConnectionRefusedError, e.g. nobody is logged in) and the peer should retry later
+        ack = b"OK"
+        for callback in self.callbacks:
+            try:
+                callback(json_dict, binary_data, binary_type)
+            except ConnectionRefusedError as e:
+                print(f"[ServerSocket] Frame deferred: {e}")
+                ack = b"BY"
+            except Exception as e:
+                print(f"[ServerSocket] Callback error: {e}")
+                if ack == b"OK":
+                    ack = b"ER"
+        return ack
+
+    # asyncio mode: every peer is a coroutine on one event loop, callbacks run on a worker pool
+    async def _serve(self):
+        self._executor = ThreadPoolExecutor(max_workers=DISPATCH_WORKERS)
+        server = await asyncio.start_server(self._handle_stream, self.ip, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_stream(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # Json length
+                try:
+                    header = await asyncio.wait_for(reader.readexactly(4), IDLE_TIMEOUT_S)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    return
+                json_len = struct.unpack("!I", header)[0]
+
+                # Json data
+                json_data = await reader.readexactly(json_len)
+                json_dict = json.loads(json_data.decode("utf-8"))
+
+                # Binary data
+                binary_data = None
+                binary_type = None
+                if json_dict.get("has_binary"):
+                    binary_data = await self._read_exact_into(reader, json_dict["binary_length"])
+                    binary_type = json_dict["binary_type"]
+
+                # Frames of one peer stay in order, other peers are served in the meantime
+                ack = b"OK"
+                if json_dict.get("type") != "heartbeat":
+                    ack = await loop.run_in_executor(self._executor, self._dispatch, json_dict, binary_data, binary_type)
+
+                writer.write(ack)
+                await writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            print(f"[ServerSocket] Connection from {addr} dropped: {e}")
+        finally:
+            writer.close()
+
+    async def _read_exact_into(self, reader, n) -> bytearray:
+        # Fills one buffer sized from binary_length instead of concatenating chunks
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        received = 0
+        while received < n:
+            chunk = await reader.read(min(n - received, READ_CHUNK_SIZE))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", n)
+            view[received:received + len(chunk)] = chunk
+            received += len(chunk)
+        return buffer
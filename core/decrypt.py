@@ -3,9 +3,43 @@ import PIL.Image
 import numpy as np
 import hashlib
 import argparse
+import glob
 import os
 
 from models.Decoder import Decoder
+from utils.basic import output_paths
+
+LATENT_EXTENSIONS = (".pt",)
+
+def decrypt_latent(enc_latent, user_key, num_rounds=8):
+    """
+    Remove the key-derived noise rounds from a single encrypted latent
+
+    Args:
+        enc_latent (torch.Tensor): Encrypted latent tensor (1, C, H, W)
+        user_key (str): Decryption key
+        num_rounds (int): Number of decryption rounds
+
+    Returns:
+        torch.Tensor: Decrypted latent tensor
+    """
+    dec_latent = enc_latent.clone()
+    for i in reversed(range(num_rounds)):
+        round_key = f"{user_key}_{i}"
+        seed = int(hashlib.sha256(round_key.encode('utf-8')).hexdigest(), 16) % (2**32)
+        g = torch.Generator(device=enc_latent.device).manual_seed(seed)
+        noise = torch.randn(enc_latent.shape, generator=g, device=enc_latent.device)
+        dec_latent = dec_latent - noise
+    return dec_latent
+
+
+def _to_pil(decoded):
+    """Convert a decoded (C, H, W) tensor in [-1, 1] to a PIL image"""
+    image_np = decoded.cpu().permute(1, 2, 0).numpy()
+    image_np = (image_np + 1.0) / 2.0
+    image_np = (image_np * 255).clip(0, 255).astype(np.uint8)
+    return PIL.Image.fromarray(image_np)
+
 
 def decrypt_image(encrypted_latent_path, user_key, num_rounds=8):
     """
@@ -38,42 +72,118 @@ def decrypt_image(encrypted_latent_path, user_key, num_rounds=8):
     enc_latent = enc_latent.to(torch_device)
     
     # Decrypt
-    dec_latent = enc_latent.clone()
-    for i in reversed(range(num_rounds)):
-        round_key = f"{user_key}_{i}"
-        seed = int(hashlib.sha256(round_key.encode('utf-8')).hexdigest(), 16) % (2**32)
-        g = torch.Generator(device=enc_latent.device).manual_seed(seed)
-        noise = torch.randn(enc_latent.shape, generator=g, device=enc_latent.device)
-        dec_latent = dec_latent - noise
+    dec_latent = decrypt_latent(enc_latent, user_key, num_rounds)
     
     # Decode decrypted latent
     with torch.no_grad():
         decoded = decoder(dec_latent)
     
     # Save reconstructed image
-    image_np = decoded.cpu().squeeze(0).permute(1, 2, 0).numpy()
-    image_np = (image_np + 1.0) / 2.0
-    image_np = (image_np * 255).clip(0, 255).astype(np.uint8)
-    image_pil = PIL.Image.fromarray(image_np)
+    image_pil = _to_pil(decoded.squeeze(0))
     image_pil.save("reconstructed_image.png")
     print("Reconstructed image saved as reconstructed_image.png")
     
     return decoded
 
 
+def collect_latent_paths(pattern):
+    """
+    Expand a directory or glob pattern into a sorted list of encrypted latent paths
+
+    Args:
+        pattern (str): Directory path or glob pattern (e.g. "encrypted/*.pt")
+
+    Returns:
+        list: Encrypted latent file paths
+    """
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+    else:
+        paths = glob.glob(pattern)
+    return sorted(p for p in paths if os.path.isfile(p) and p.lower().endswith(LATENT_EXTENSIONS))
+
+
+def decrypt_images(encrypted_latent_paths, user_key, num_rounds=8, batch_size=8, output_dir="."):
+    """
+    Decrypt many encrypted latents with a single Decoder instance
+
+    Latents are decrypted one by one, bucketed by shape and decoded in
+    batches of `batch_size`. One PNG is written per input file.
+
+    Args:
+        encrypted_latent_paths (list): Paths to encrypted latent PT files
+        user_key (str): Decryption key
+        num_rounds (int): Number of decryption rounds
+        batch_size (int): Number of latents per decoder forward pass
+        output_dir (str): Directory for the reconstructed PNG files
+
+    Returns:
+        list: Paths of the saved reconstructed images
+
+    Raises:
+        ValueError: If two latents would be saved to the same file
+    """
+    print(f"Starting batch decryption of {len(encrypted_latent_paths)} latents")
+    save_paths = output_paths(encrypted_latent_paths, output_dir, ".png")
+
+    # Load Decoder once for the whole run
+    decoder = Decoder()
+    torch_device = "cuda" if torch.cuda.is_available() else "cpu"
+    decoder.to(torch_device)
+
+    # Latents are small, so they are decrypted up front and grouped by shape
+    buckets = {}
+    for path in encrypted_latent_paths:
+        enc_latent = torch.load(path).to(torch_device)
+        dec_latent = decrypt_latent(enc_latent, user_key, num_rounds)
+        buckets.setdefault(tuple(dec_latent.shape), []).append((path, dec_latent))
+
+    saved_paths = []
+    for shape, items in buckets.items():
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            print(f"Decoding batch of {len(batch)} latents {shape}")
+
+            # Decode decrypted latents
+            with torch.no_grad():
+                decoded = decoder(torch.cat([latent for _, latent in batch]))
+
+            # Save one reconstructed image per input
+            for (path, _), image in zip(batch, decoded):
+                save_path = save_paths[path]
+                os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+                _to_pil(image).save(save_path)
+                saved_paths.append(save_path)
+
+    print(f"Reconstructed images saved to {output_dir}")
+    return saved_paths
+
+
 def main():
     parser = argparse.ArgumentParser(description='Image Decryption')
-    parser.add_argument('encrypted_latent_path', help='Path to encrypted latent PT file')
+    parser.add_argument('encrypted_latent_path', help='Path to encrypted latent PT file, or a directory / glob pattern for batch mode')
     parser.add_argument('--key', required=True, help='Decryption key')
     parser.add_argument('--rounds', type=int, default=8, help='Number of decryption rounds (default: 8)')
+    parser.add_argument('--batch-size', type=int, default=8, help='Latents per decoder pass in batch mode (default: 8)')
+    parser.add_argument('--output-dir', default='decrypted', help='Output directory in batch mode (default: decrypted)')
     
     args = parser.parse_args()
     
-    if not os.path.exists(args.encrypted_latent_path):
+    if os.path.isfile(args.encrypted_latent_path):
+        decrypt_image(args.encrypted_latent_path, args.key, args.rounds)
+        print("Decryption completed!")
+        return
+
+    latent_paths = collect_latent_paths(args.encrypted_latent_path)
+    if not latent_paths:
         print(f"Error: Encrypted latent file not found: {args.encrypted_latent_path}")
         return
     
-    decrypt_image(args.encrypted_latent_path, args.key, args.rounds)
+    try:
+        decrypt_images(latent_paths, args.key, args.rounds, args.batch_size, args.output_dir)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
     print("Decryption completed!")
 
 
@@ -3,10 +3,36 @@ import torch
 import numpy as np
 import hashlib
 import argparse
+import glob
 import os
 
+from PIL import Image
 from models.Encoder import Encoder
-from utils.basic import preprocess_image
+from utils.basic import preprocess_image, output_paths
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+
+def encrypt_latent(latents, user_key, num_rounds=8):
+    """
+    Add the key-derived noise rounds to a single latent
+
+    Args:
+        latents (torch.Tensor): Latent tensor (1, C, H, W)
+        user_key (str): Encryption key
+        num_rounds (int): Number of encryption rounds
+
+    Returns:
+        torch.Tensor: Encrypted latent tensor
+    """
+    enc_latent = latents.clone()
+    for i in range(num_rounds):
+        round_key = f"{user_key}_{i}"
+        seed = int(hashlib.sha256(round_key.encode('utf-8')).hexdigest(), 16) % (2**32)
+        g = torch.Generator(device=latents.device).manual_seed(seed)
+        noise = torch.randn(latents.shape, generator=g, device=latents.device)
+        enc_latent = enc_latent + noise
+    return enc_latent
+
 
 def encrypt_image(image_path, user_key, image_size=None, num_rounds=8):
     """
@@ -36,13 +62,7 @@ def encrypt_image(image_path, user_key, image_size=None, num_rounds=8):
         _, _, latents, _ = encoder(input_image)  # (1, C, H, W)
     
     # Encrypt
-    enc_latent = latents.clone()
-    for i in range(num_rounds):
-        round_key = f"{user_key}_{i}"
-        seed = int(hashlib.sha256(round_key.encode('utf-8')).hexdigest(), 16) % (2**32)
-        g = torch.Generator(device=latents.device).manual_seed(seed)
-        noise = torch.randn(latents.shape, generator=g, device=latents.device)
-        enc_latent = enc_latent + noise
+    enc_latent = encrypt_latent(latents, user_key, num_rounds)
     
     # Save encrypted latent as PT file
     torch.save(enc_latent.cpu(), "encrypted_latent.pt")
@@ -51,22 +71,120 @@ def encrypt_image(image_path, user_key, image_size=None, num_rounds=8):
     return enc_latent
 
 
+def collect_image_paths(pattern):
+    """
+    Expand a directory or glob pattern into a sorted list of image paths
+
+    Args:
+        pattern (str): Directory path or glob pattern (e.g. "images/*.png")
+
+    Returns:
+        list: Image file paths
+    """
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+    else:
+        paths = glob.glob(pattern)
+    return sorted(p for p in paths if os.path.isfile(p) and p.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def _bucket_by_size(image_paths, image_size=None):
+    """Group image paths by their preprocessed (H, W) so every batch can be stacked"""
+    buckets = {}
+    for path in image_paths:
+        if image_size:
+            size = (image_size, image_size)
+        else:
+            # Only the header is read here, pixels are decoded when the batch is built
+            with Image.open(path) as img:
+                size = (img.height, img.width)
+        buckets.setdefault(size, []).append(path)
+    return buckets
+
+
+def encrypt_images(image_paths, user_key, image_size=None, num_rounds=8, batch_size=8, output_dir="."):
+    """
+    Encrypt many images with a single Encoder instance
+
+    Images are bucketed by size and encoded in batches of `batch_size`.
+    Every latent is encrypted on its own, so each output file is identical
+    in format to the one produced by `encrypt_image`.
+
+    Args:
+        image_paths (list): Paths to images to encrypt
+        user_key (str): Encryption key
+        image_size (int): Image Size, if None use original size
+        num_rounds (int): Number of encryption rounds
+        batch_size (int): Number of images per encoder forward pass
+        output_dir (str): Directory for the encrypted latent PT files
+
+    Returns:
+        list: Paths of the saved encrypted latent files
+
+    Raises:
+        ValueError: If two images would be saved to the same file (e.g. a.png and a.jpg)
+    """
+    print(f"Starting batch encryption of {len(image_paths)} images")
+    save_paths = output_paths(image_paths, output_dir, ".pt")
+
+    # Load Encoder once for the whole run
+    encoder = Encoder()
+    torch_device = "cuda" if torch.cuda.is_available() else "cpu"
+    encoder.to(torch_device)
+
+    saved_paths = []
+    for size, paths in _bucket_by_size(image_paths, image_size).items():
+        for start in range(0, len(paths), batch_size):
+            batch_paths = paths[start:start + batch_size]
+            print(f"Encoding batch of {len(batch_paths)} images ({size[0]}x{size[1]})")
+            input_images = torch.cat(
+                [preprocess_image(path, img_size=image_size) for path in batch_paths]
+            ).to(torch_device)
+
+            # Encode to latent
+            with torch.no_grad():
+                _, _, latents, _ = encoder(input_images)  # (B, C, H, W)
+
+            # Encrypt and save one file per input
+            for path, latent in zip(batch_paths, latents.split(1)):
+                enc_latent = encrypt_latent(latent, user_key, num_rounds)
+                save_path = save_paths[path]
+                os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+                torch.save(enc_latent.cpu(), save_path)
+                saved_paths.append(save_path)
+
+    print(f"Encrypted latents saved to {output_dir}")
+    return saved_paths
+
+
 def main():
     parser = argparse.ArgumentParser(description='Image Encryption')
-    parser.add_argument('image_path', help='Path to image to encrypt')
+    parser.add_argument('image_path', help='Path to image to encrypt, or a directory / glob pattern for batch mode')
     parser.add_argument('--key', required=True, help='Encryption key')
     parser.add_argument('--size', type=int, default=None, help='Image Size, if None use original size')
     parser.add_argument('--rounds', type=int, default=8, help='Number of encryption rounds (default: 8)')
-    
+    parser.add_argument('--batch-size', type=int, default=8, help='Images per encoder pass in batch mode (default: 8)')
+    parser.add_argument('--output-dir', default='encrypted', help='Output directory in batch mode (default: encrypted)')
+
     args = parser.parse_args()
-    
-    if not os.path.exists(args.image_path):
+
+    if os.path.isfile(args.image_path):
+        encrypt_image(args.image_path, args.key, args.size, args.rounds)
+        print("Encryption completed!")
+        return
+
+    image_paths = collect_image_paths(args.image_path)
+    if not image_paths:
         print(f"Error: Image file not found: {args.image_path}")
         return
-    
-    encrypt_image(args.image_path, args.key, args.size, args.rounds)
+
+    try:
+        encrypt_images(image_paths, args.key, args.size, args.rounds, args.batch_size, args.output_dir)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
     print("Encryption completed!")
 
 
 if __name__ == "__main__":
-    main() 
+    main()
@@ -25,6 +25,7 @@ SOFTWARE.
 Authors: Sanghong Kim, Byungho Lee, Gunwoo Kim, Kyunghyun Yoo, Seungjoo Lee
 """
 
+import os
 import torch
 import numpy as np
 import random
@@ -92,4 +93,32 @@ def preprocess_image(img_path, img_size=None):
     img = Image.open(img_path).convert('RGB')
     img_tensor = transform(img).unsqueeze(0)
     
-    return img_tensor
\ No newline at end of file
+    return img_tensor
+
+def output_paths(input_paths, output_dir, extension):
+    """
+    Map every input to a file in `output_dir`, keeping its path relative to the inputs' common directory
+
+    Args:
+        input_paths (list): Input file paths
+        output_dir (str): Output directory
+        extension (str): Extension of the output files (e.g. ".pt")
+
+    Returns:
+        dict: Input path -> output path
+
+    Raises:
+        ValueError: If two inputs would be written to the same output file
+    """
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in input_paths]) if input_paths else ""
+    mapping = {}
+    outputs = {}
+    for path in input_paths:
+        relative = os.path.relpath(os.path.abspath(path), root)
+        save_path = os.path.join(output_dir, os.path.splitext(relative)[0] + extension)
+        # e.g. a.png and a.jpg, checked up front so nothing is overwritten halfway through a run
+        if save_path in outputs:
+            raise ValueError(f"{outputs[save_path]} and {path} would both be saved as {save_path}")
+        outputs[save_path] = path
+        mapping[path] = save_path
+    return mapping